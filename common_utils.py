@@ -28,23 +28,680 @@ def changeConfVar(varName, varValue, file="config/scipion.conf", escapeSlash=Fal
 # *****************************************************************************
 #               DYNAMIC TEST FACTORY
 # *****************************************************************************
+import hashlib
+import json
+import os
+import time
+
 from buildbot.plugins import steps, util
 from buildbot.process import buildstep, logobserver
+from buildbot.process.results import worst_status
 from twisted.internet import defer
 from settings import timeOutExecute
 
 
+STAGE_ORDER_LONGEST_FIRST = 'longestFirst'
+STAGE_ORDER_SHORTEST_FIRST = 'shortestFirst'
+STAGE_ORDER_DISCOVERY = 'discovery'
+
+
+class JsonStore(object):
+    """ Dict persisted as a json file in the master basedir. The file is
+    re-written (atomically) on every save. """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._data = json.load(f)
+        return self._data
+
+    def save(self):
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(tmpPath, self.path)
+
+
+class StageHistory(JsonStore):
+    """ Wall-clock duration (in seconds) of the last STAGE_HISTORY_SIZE
+    successful runs of every test stage, keyed by group and test class. """
+
+    def addDuration(self, groupId, stage, duration):
+        durations = self.data.setdefault(groupId, {}).setdefault(stage, [])
+        durations.append(round(duration, 1))
+        del durations[:-settings.STAGE_HISTORY_SIZE]
+        self.save()
+
+    def getDuration(self, groupId, stage):
+        """ Mean duration of the stage or None if it has never been run.
+        The duration of a batch of stages ('A B C') is the sum of theirs. """
+        if ' ' in stage.strip():
+            durations = [self.getDuration(groupId, part) for part in stage.split()]
+            return None if None in durations else sum(durations)
+        durations = self.data.get(groupId, {}).get(stage)
+        if durations:
+            return sum(durations) / len(durations)
+        return None
+
+    def sortStages(self, groupId, stages, order):
+        """ Sort the stages following one of the STAGE_ORDER policies.
+        Stages without history are taken as the longest ones. """
+        if order == STAGE_ORDER_DISCOVERY:
+            return list(stages)
+        durations = {stage: self.getDuration(groupId, stage) for stage in stages}
+        unknown = [stage for stage in stages if durations[stage] is None]
+        known = sorted([stage for stage in stages if durations[stage] is not None],
+                       key=lambda stage: durations[stage],
+                       reverse=(order == STAGE_ORDER_LONGEST_FIRST))
+        if order == STAGE_ORDER_SHORTEST_FIRST:
+            return known + unknown
+        return unknown + known
+
+
+stageHistory = StageHistory(settings.STAGE_HISTORY_FILE)
+
+
+class StageMethods(JsonStore):
+    """ Test methods of the test classes, as seen in their last whole run,
+    {groupId: {stage: {'methods', 'time'}}} """
+
+    def setMethods(self, groupId, stage, methods):
+        self.data.setdefault(groupId, {})[stage] = {'methods': sorted(methods),
+                                                    'time': time.time()}
+        self.save()
+
+    def getMethods(self, groupId, stage):
+        """ Methods of the class, None if unknown or older than
+        STAGE_METHODS_MAX_AGE days """
+        entry = self.data.get(groupId, {}).get(stage)
+        if entry and time.time() - entry['time'] < settings.STAGE_METHODS_MAX_AGE * 24 * 3600:
+            return entry['methods']
+        return None
+
+
+stageMethods = StageMethods(settings.STAGE_METHODS_FILE)
+
+
+class StageOutcomes(JsonStore):
+    """ Pass (1) or fail (0) of the last STAGE_OUTCOMES_SIZE runs of every
+    test stage, {groupId: {stage: [0, 1, ...]}}. Retries are not recorded,
+    so a flaky stage keeps its flips. """
+
+    def addOutcome(self, groupId, stage, passed):
+        outcomes = self.data.setdefault(groupId, {}).setdefault(stage, [])
+        outcomes.append(1 if passed else 0)
+        del outcomes[:-settings.STAGE_OUTCOMES_SIZE]
+        self.save()
+
+    def getFlips(self, groupId, stage):
+        outcomes = self.data.get(groupId, {}).get(stage, [])
+        return len([1 for a, b in zip(outcomes, outcomes[1:]) if a != b])
+
+    def isFlaky(self, groupId, stage):
+        return self.getFlips(groupId, stage) >= settings.STAGE_FLAKY_FLIPS
+
+    def isQuarantined(self, groupId, stage):
+        return self.getFlips(groupId, stage) >= settings.STAGE_QUARANTINE_FLIPS
+
+    def getFailedStages(self, groupId, stages):
+        """ The stages whose last run failed, or any of their methods
+        when they were split (see planStages) """
+        outcomes = self.data.get(groupId, {})
+        failed = set(name for name, results in outcomes.items()
+                     if results and not results[-1])
+        return [stage for stage in stages
+                if stage in failed or any(name.startswith(stage + '.') for name in failed)]
+
+
+stageOutcomes = StageOutcomes(settings.STAGE_OUTCOMES_FILE)
+
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+# lines printed by 'scipion3 test' for each test method, e.g.
+# [ RUN   OK ] TestRelionClassify2D.testRelion2D (34.250 secs)
+TEST_RESULT_RE = re.compile(r'\[\s*(RUN\s+OK|OK|FAILED|ERROR)\s*\]\s+(\w+)\.(\w+)'
+                            r'(?:\s+\(([\d.]+) secs\))?')
+
+
+def parseTestResults(output):
+    """ {(className, method): (ok, secs)} of the test methods in the
+    output of a 'scipion3 test' run """
+    tests = {}
+    for line in ANSI_RE.sub('', output).split('\n'):
+        match = TEST_RESULT_RE.search(line)
+        if match:
+            status, className, method, secs = match.groups()
+            tests[(className, method)] = (status.endswith('OK'),
+                                          float(secs) if secs else None)
+    return tests
+
+
+def parseDatasetUses(output):
+    """ {className: [datasets]} of the datasets downloaded by the test
+    classes in the output of a 'scipion3 test' run, from the 'scipion
+    testdata' commands of DataSet.getDataSet. They are run by setUpClass, so
+    a dataset belongs to the class of the next test result (None if there
+    is none, e.g. the class failed in setUpClass). """
+    uses = {}
+    pending = []
+    for line in ANSI_RE.sub('', output).split('\n'):
+        match = TEST_RESULT_RE.search(line)
+        if match:
+            uses.setdefault(match.group(2), [])
+            uses[match.group(2)] += [name for name in pending
+                                     if name not in uses[match.group(2)]]
+            pending = []
+            continue
+        words = line.split()
+        if 'testdata' not in words:
+            continue
+        args = words[words.index('testdata') + 1:]
+        while args and args[0].startswith('-'):
+            # options, with the value of the url one
+            args = args[2:] if args[0] in ('-u', '--url') else args[1:]
+        if args and args[0] not in pending:
+            pending.append(args[0])
+    if pending:
+        uses[None] = pending
+    return uses
+
+
+class StageDatasets(JsonStore):
+    """ Test datasets used by the test classes in their last run,
+    {groupId: {stage: [datasets]}}, plus the ones declared in STAGE_DATASETS """
+
+    def setDatasets(self, groupId, stage, datasets, replace=True):
+        """ With replace False (e.g. a failed run, that may have stopped
+        early) the datasets are added to the known ones """
+        known = self.data.get(groupId, {}).get(stage, [])
+        if not replace:
+            datasets = known + [name for name in datasets if name not in known]
+        if datasets != known:
+            self.data.setdefault(groupId, {})[stage] = datasets
+            self.save()
+
+    def getDatasets(self, groupId, stage):
+        """ Datasets of a stage: a class, a method of a class or a batch of
+        classes ('A B C') """
+        if ' ' in stage.strip():
+            datasets = []
+            for part in stage.split():
+                datasets += [name for name in self.getDatasets(groupId, part)
+                             if name not in datasets]
+            return datasets
+        learned = self.data.get(groupId, {})
+        datasets = list(learned.get(stage, learned.get(stage.rsplit('.', 1)[0], [])))
+        for pattern, names in sorted(settings.STAGE_DATASETS.items()):
+            if re.match(pattern, stage):
+                datasets += [name for name in names if name not in datasets]
+        return datasets
+
+
+stageDatasets = StageDatasets(settings.STAGE_DATASETS_FILE)
+
+
+def addDatasetPrefetch(groupId, specs, ahead=None):
+    """ Set in each stage spec (see getStageSpec), in run order, the
+    datasets of the next 'ahead' (TEST_DATASETS_PREFETCH) stages that it
+    doesn't use itself, to be prefetched while it runs """
+    ahead = settings.TEST_DATASETS_PREFETCH if ahead is None else ahead
+    if ahead <= 0:
+        return specs
+    datasets = [stageDatasets.getDatasets(groupId, ' '.join(spec.get('stages') or [spec['name']]))
+                for spec in specs]
+    for i, spec in enumerate(specs):
+        prefetch = []
+        for names in datasets[i + 1:i + 1 + ahead]:
+            prefetch += [name for name in names
+                         if name not in datasets[i] and name not in prefetch]
+        if prefetch:
+            spec['prefetch'] = prefetch
+    return specs
+
+
+@defer.inlineCallbacks
+def makeSideCommand(step, command, **kwargs):
+    """ Remote command of a ShellMixin step running another command than the
+    one of the step. makeRemoteShellCommand keeps the command it is given in
+    step.command, so the step command is restored afterwards. """
+    stepCommand = step.command
+    try:
+        cmd = yield step.makeRemoteShellCommand(command=command, **kwargs)
+    finally:
+        step.command = stepCommand
+    defer.returnValue(cmd)
+
+
+@defer.inlineCallbacks
+def startDatasetPrefetch(step, datasets, logName):
+    """ Start in the worker of the step the background prefetch of the
+    datasets of the next stages. It doesn't change the result of the step. """
+    if datasets:
+        cmd = yield makeSideCommand(step, datasetsCmd('prefetch', datasets),
+                                    timeout=settings.timeOutShort,
+                                    stdioLogName=logName)
+        yield step.runCommand(cmd)
+
+
+def isFlakyStage(groupId, spec):
+    return any(stageOutcomes.isFlaky(groupId, stage)
+               for stage in spec.get('stages') or [spec['name']])
+
+
+def recordStageRun(groupId, spec, result, duration, output, retry=False):
+    """ Record in the stage history the durations (and the methods) of the
+    classes run by a stage, and their outcomes unless it is a retry. For
+    batches of classes, return a StageResult step for each class, with the
+    result of that class. """
+    tests = parseTestResults(output)
+    recordDatasetUses(groupId, spec, result, output)
+    if not spec.get('stages'):
+        if not retry:
+            stageOutcomes.addOutcome(groupId, spec['name'],
+                                     result in (util.SUCCESS, util.WARNINGS))
+        if result in (util.SUCCESS, util.WARNINGS):
+            stageHistory.addDuration(groupId, spec['name'], duration)
+        methods = [method for className, method in tests
+                   if spec['name'].endswith('.' + className)]
+        if methods:
+            stageMethods.setMethods(groupId, spec['name'], methods)
+        return []
+
+    resultSteps = []
+    for stage in spec['stages']:
+        className = stage.rsplit('.', 1)[-1]
+        classTests = [value for (name, _), value in tests.items() if name == className]
+        if classTests:
+            stageResult = (util.SUCCESS if all(ok for ok, _ in classTests)
+                           else util.FAILURE)
+        else:
+            # the batch didn't get to print its results
+            stageResult = (util.SUCCESS if result in (util.SUCCESS, util.WARNINGS)
+                           else util.FAILURE)
+        if not retry:
+            stageOutcomes.addOutcome(groupId, stage, stageResult == util.SUCCESS)
+        if stageResult == util.SUCCESS:
+            secs = [secs for _, secs in classTests if secs is not None]
+            stageHistory.addDuration(groupId, stage,
+                                     sum(secs) if secs else duration / len(spec['stages']))
+        resultSteps.append(makeStageResult(stage, stageResult))
+    return resultSteps
+
+
+def recordDatasetUses(groupId, spec, result, output):
+    """ Learn from its output the datasets of the classes run by a stage """
+    uses = parseDatasetUses(output)
+    passed = result in (util.SUCCESS, util.WARNINGS)
+    if spec.get('stages'):
+        # a batch: only the datasets followed by the results of their class
+        for stage in spec['stages']:
+            className = stage.rsplit('.', 1)[-1]
+            if className in uses:
+                stageDatasets.setDatasets(groupId, stage, uses[className], replace=passed)
+        return
+    datasets = []
+    for names in uses.values():
+        datasets += [name for name in names if name not in datasets]
+    stage = spec['name']
+    if stage.rsplit('.', 1)[-1].startswith('test'):
+        # a method of a split class (see planStages) only adds to its class
+        stageDatasets.setDatasets(groupId, stage.rsplit('.', 1)[0], datasets, replace=False)
+    else:
+        stageDatasets.setDatasets(groupId, stage, datasets, replace=passed)
+
+
+class DiscoveryCache(JsonStore):
+    """ Output of the test discovery commands,
+    {name: {'key', 'stdout', 'time'}}. An entry is fresh while its key
+    (plugin commit, environment hash and pattern) doesn't change. """
+
+    def get(self, name, key):
+        """ (stdout, fresh) of the entry, (None, False) if there is none """
+        entry = self.data.get(name)
+        if entry is None:
+            return None, False
+        return entry['stdout'], entry['key'] == key
+
+    def put(self, name, key, stdout):
+        self.data[name] = {'key': key, 'stdout': stdout, 'time': time.time()}
+        self.save()
+
+
+discoveryCache = DiscoveryCache(settings.DISCOVERY_CACHE_FILE)
+
+
+def mergeRetryResults(resultSteps, retryResult, retrySteps):
+    """ Result and StageResult steps of a stage retried after failing: a
+    class that only passed on the retry is a warning (a flaky pass) """
+    failed = set(step.name for step in resultSteps if step.result != util.SUCCESS)
+    mergedSteps = [makeStageResult(step.name, util.WARNINGS)
+                   if step.result == util.SUCCESS and step.name in failed else step
+                   for step in retrySteps]
+    return (util.WARNINGS if retryResult == util.SUCCESS else retryResult), mergedSteps
+
+
+def quarantineResult(result):
+    """ Failures of the stages in the quarantine lane only warn """
+    return util.WARNINGS if result in (util.FAILURE, util.EXCEPTION) else result
+
+
+def quarantineSteps(resultSteps):
+    """ StageResult steps of a stage in the quarantine lane """
+    return [makeStageResult(step.name, quarantineResult(step.result))
+            for step in resultSteps]
+
+
+class TestStageCommand(buildstep.ShellMixin, steps.BuildStep):
+    """ Run one of the test stages generated by GenerateStagesCommand and
+    record its duration in the stage history. A failing flaky stage is run
+    once more, and a quarantined one only warns on failure. The prefetch
+    datasets (those of the next stages) are prefetched while it runs. """
+
+    def __init__(self, groupId='', stages=None, quarantined=False, prefetch=None, **kwargs):
+        self.groupId = groupId
+        self.stages = stages
+        self.quarantined = quarantined
+        self.prefetch = prefetch or []
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def runAttempt(self, logName, retry=False):
+        observer = logobserver.BufferLogObserver(wantStderr=True)
+        self.addLogObserver(logName, observer)
+        start = time.time()
+        cmd = yield self.makeRemoteShellCommand(stdioLogName=logName)
+        # makeRemoteShellCommand only takes the env of the step
+        cmd.args['env'].update(self.stageEnv)
+        yield self.runCommand(cmd)
+        result = cmd.results()
+        resultSteps = recordStageRun(self.groupId, {'name': self.name, 'stages': self.stages},
+                                     result, time.time() - start,
+                                     observer.getStdout() + observer.getStderr(),
+                                     retry=retry)
+        defer.returnValue((result, resultSteps))
+
+    @defer.inlineCallbacks
+    def run(self):
+        workername = self.getProperty('workername')
+        device = None
+        self.stageEnv = {}
+        if needsGpuSlot(self.env):
+            device = yield gpuSlots.acquire(workername)
+            self.stageEnv['CUDA_VISIBLE_DEVICES'] = device
+        try:
+            yield startDatasetPrefetch(self, self.prefetch, 'prefetch')
+            result, resultSteps = yield self.runAttempt('stdio')
+            if (result == util.FAILURE and not self.stopped and
+                    isFlakyStage(self.groupId, {'name': self.name, 'stages': self.stages})):
+                retryResult, retrySteps = yield self.runAttempt('retry', retry=True)
+                result, resultSteps = mergeRetryResults(resultSteps, retryResult, retrySteps)
+                self.descriptionSuffix = ['(flaky, retried)']
+        finally:
+            if device is not None:
+                gpuSlots.release(workername, device)
+        if self.quarantined:
+            result = quarantineResult(result)
+            resultSteps = quarantineSteps(resultSteps)
+        if resultSteps:
+            self.build.addStepsAfterCurrentStep(resultSteps)
+        defer.returnValue(result)
+
+
+class ParallelStagesCommand(buildstep.ShellMixin, steps.BuildStep):
+    """ Run several test stages at once (up to maxParallel) in the same
+    worker. Each stage writes its own log and keeps its own env and timeout.
+    When all of them are done, a StageResult step per stage is added to the
+    build with the result of that stage, so a failing stage flunks the build
+    as a sequential TestStageCommand would. Flaky and quarantined stages are
+    handled as TestStageCommand does. """
+
+    def __init__(self, specs=None, maxParallel=1, groupId='', **kwargs):
+        self.specs = specs or []
+        self.maxParallel = maxParallel
+        self.groupId = groupId
+        self.runningCmds = []
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def runAttempt(self, spec, env, logName, retry=False):
+        observer = logobserver.BufferLogObserver(wantStderr=True)
+        self.addLogObserver(logName, observer)
+        start = time.time()
+        cmd = yield self.makeRemoteShellCommand(command=spec['command'],
+                                                timeout=spec['timeout'],
+                                                stdioLogName=logName)
+        # makeRemoteShellCommand only takes the env of the step
+        cmd.args['env'].update(env)
+        self.runningCmds.append(cmd)
+        try:
+            yield self.runCommand(cmd)
+        finally:
+            self.runningCmds.remove(cmd)
+        result = cmd.results()
+        resultSteps = recordStageRun(self.groupId, spec, result, time.time() - start,
+                                     observer.getStdout() + observer.getStderr(),
+                                     retry=retry)
+        defer.returnValue((result, resultSteps))
+
+    @defer.inlineCallbacks
+    def runStage(self, spec, env):
+        if self.stopped:
+            defer.returnValue((util.CANCELLED, 0))
+        start = time.time()
+        yield startDatasetPrefetch(self, spec.get('prefetch'), spec['name'] + ' (prefetch)')
+        result, resultSteps = yield self.runAttempt(spec, env, spec['name'])
+        if result == util.FAILURE and not self.stopped and isFlakyStage(self.groupId, spec):
+            retryResult, retrySteps = yield self.runAttempt(spec, env,
+                                                            spec['name'] + ' (retry)',
+                                                            retry=True)
+            result, resultSteps = mergeRetryResults(resultSteps, retryResult, retrySteps)
+        if spec.get('quarantined'):
+            result = quarantineResult(result)
+            resultSteps = quarantineSteps(resultSteps)
+        self.classResults[spec['name']] = resultSteps
+        defer.returnValue((result, time.time() - start))
+
+    @defer.inlineCallbacks
+    def runGpuStage(self, spec, semaphore):
+        """ Wait for a GPU slot before queueing the stage, so CPU stages
+        don't wait behind stages waiting for a GPU """
+        workername = self.getProperty('workername')
+        device = yield gpuSlots.acquire(workername)
+        try:
+            env = dict(spec['env'], CUDA_VISIBLE_DEVICES=device)
+            stageResult = yield semaphore.run(self.runStage, spec, env)
+        finally:
+            gpuSlots.release(workername, device)
+        defer.returnValue(stageResult)
+
+    @defer.inlineCallbacks
+    def run(self):
+        # StageResult steps of the classes of the batch stages
+        self.classResults = {}
+        semaphore = defer.DeferredSemaphore(self.maxParallel)
+        stageResults = yield defer.gatherResults(
+            [self.runGpuStage(spec, semaphore) if needsGpuSlot(spec['env'])
+             else semaphore.run(self.runStage, spec, spec['env'])
+             for spec in self.specs])
+
+        resultSteps = []
+        worst = util.SUCCESS
+        for spec, (result, duration) in zip(self.specs, stageResults):
+            worst = worst_status(worst, result)
+            if self.classResults.get(spec['name']):
+                resultSteps += self.classResults[spec['name']]
+                continue
+            resultSteps.append(StageResult(result=result,
+                                           name=spec['name'],
+                                           description=spec['description'],
+                                           descriptionDone='%s (%ds)' % (spec['descriptionDone'],
+                                                                         duration)))
+        self.build.addStepsAfterCurrentStep(resultSteps)
+        self.descriptionDone = '%d stages, %d failed' % (
+            len(self.specs),
+            len([r for r, _ in stageResults if r not in (util.SUCCESS, util.WARNINGS)]))
+        defer.returnValue(worst)
+
+    def interrupt(self, reason):
+        steps.BuildStep.interrupt(self, reason)
+        for cmd in self.runningCmds:
+            cmd.interrupt(reason)
+
+
+class StageResult(steps.BuildStep):
+    """ Report the result of a stage run by ParallelStagesCommand (its log
+    is in that step) """
+
+    def __init__(self, result=util.SUCCESS, **kwargs):
+        self.result = result
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        return defer.succeed(self.result)
+
+
+def makeStageResult(stage, result):
+    """ StageResult step of a class. Steps can't be changed once created
+    (buildbot >= 3), so a different result needs a new one. """
+    className = stage.rsplit('.', 1)[-1]
+    return StageResult(result=result,
+                       name=stage,
+                       description='Testing %s' % className,
+                       descriptionDone=className)
+
+
+def makeStageCommand(spec, groupId):
+    """ Step running the stage described by spec (see getStageSpec) """
+    return TestStageCommand(groupId=groupId, **spec)
+
+
+def makeStageCommands(specs, groupId, maxParallel=1):
+    """ Steps running the stages: one per stage or, if maxParallel > 1, a
+    single ParallelStagesCommand. The datasets script is downloaded first
+    when any stage prefetches datasets (see addDatasetPrefetch). """
+    stageSteps = []
+    if any(spec.get('prefetch') for spec in specs):
+        stageSteps.append(downloadWorkerScript('datasets.py'))
+    if maxParallel > 1 and len(specs) > 1:
+        return stageSteps + [
+            ParallelStagesCommand(specs=specs,
+                                  maxParallel=maxParallel,
+                                  groupId=groupId,
+                                  name='Run %d stages' % len(specs),
+                                  description='Running %d stages (%d at once)'
+                                              % (len(specs), maxParallel),
+                                  descriptionDone='%d stages' % len(specs))]
+    return stageSteps + [makeStageCommand(spec, groupId) for spec in specs]
+
+
+def balanceShards(groupId, stages, n):
+    """ Split the stages in (at most) n shards of similar duration. The
+    longest stages are placed first, each one in the lightest shard so far.
+    Stages without history weigh the mean of the known ones, which means
+    that without any history the shards are balanced by count. """
+    durations = {stage: stageHistory.getDuration(groupId, stage) for stage in stages}
+    known = [d for d in durations.values() if d is not None]
+    default = sum(known) / len(known) if known else 1
+    weights = {stage: default if d is None else d for stage, d in durations.items()}
+
+    shards = [[] for _ in range(min(n, len(stages)))]
+    loads = [0] * len(shards)
+    for stage in sorted(stages, key=lambda stage: weights[stage], reverse=True):
+        lightest = loads.index(min(loads))
+        shards[lightest].append(stage)
+        loads[lightest] += weights[stage]
+    return shards
+
+def splitDiscoveryOutput(stdout, targetTestSets):
+    """ Split the output of a test discovery over all the plugins
+    ('scipion3 test --show --mode onlyclasses') in the output that the
+    discovery of each targetTestSet ('--grep <targetTestSet>') would print """
+    outputs = {targetTestSet: [] for targetTestSet in targetTestSets}
+    for line in stdout.split('\n'):
+        words = line.strip().split(' ')
+        for targetTestSet, lines in outputs.items():
+            if (words[-1].split('.', 1)[0] == targetTestSet or
+                    ('Error' in line and targetTestSet in line)):
+                lines.append(line)
+    return {targetTestSet: '\n'.join(lines) for targetTestSet, lines in outputs.items()}
+
+
+class DiscoverPluginTests(buildstep.ShellMixin, steps.BuildStep):
+    """ Run the test discovery of all the installed plugins at once and keep
+    its output, split by targetTestSet, in the PLUGINS_DISCOVERED_TESTS
+    property, to hand it to the plugin builds (see pluginDiscoveredTests).
+    It runs before the plugin builds, so it sees the plugins installed by
+    the previous runs. """
+
+    def __init__(self, targetTestSets, **kwargs):
+        self.targetTestSets = targetTestSets
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.results() == util.SUCCESS:
+            self.setProperty('PLUGINS_DISCOVERED_TESTS',
+                             splitDiscoveryOutput(cmd.stdout, self.targetTestSets),
+                             'DiscoverPluginTests')
+        defer.returnValue(cmd.results())
+
+
+def pluginDiscoveredTests(targetTestSet):
+    """ Renderable with the output of DiscoverPluginTests for a plugin """
+    return util.Transform(lambda outputs: (outputs or {}).get(targetTestSet),
+                          util.Property('PLUGINS_DISCOVERED_TESTS'))
+
+
+@util.renderer
+def discoveredTestsIfUnchanged(props):
+    """ DISCOVERED_TESTS of the plugin builds whose install was skipped: the
+    plugin didn't change since that discovery """
+    if props.getProperty('PLUGIN_INSTALL_SKIPPED', False):
+        return props.getProperty('DISCOVERED_TESTS')
+    return None
+
+
 class GenerateStagesCommand(buildstep.ShellMixin, steps.BuildStep):
 
+    renderables = ['stageEnvs', 'discovered']
+
     def __init__(self, **kwargs):
+        self.initKwargs = dict(kwargs)
+        self.groupId = kwargs.pop('groupId', '')
+        self.stageOrder = kwargs.pop('stageOrder', settings.STAGE_ORDER)
         self.rootName = kwargs.pop('rootName', '')
         self.targetTestSet = kwargs.pop('targetTestSet', 'pyworkflow')
+        self.shards = kwargs.pop('shards',
+                                 settings.STAGE_SHARDS.get(self.targetTestSet, 1))
+        self.maxParallelStages = kwargs.pop('maxParallelStages',
+                                            settings.MAX_PARALLEL_STAGES)
+        self.needsGpu = kwargs.pop('needsGpu', False)
         self.blacklist = kwargs.pop('blacklist', [])
         self.stageEnvs = kwargs.pop('stageEnvs', {})
         self.env = kwargs.pop('env', {})
         self.pattern = kwargs.pop('pattern', '')
         self.stagePrefix = kwargs.pop('stagePrefix', [])
         self.failOnEmptyTestStages = kwargs.pop('failOnEmptyTestStages', True)
+        self.testImpact = kwargs.pop('testImpact', None)
+        self.discoveryCache = kwargs.pop('discoveryCache', False)
+        # output of a discovery already run (e.g. by DiscoverPluginTests), and
+        # property where the output of this step discovery is kept
+        self.discovered = kwargs.pop('discovered', None)
+        self.discoveredProperty = kwargs.pop('discoveredProperty', None)
+        # stages already run from an outdated discovery cache entry
+        self.revalidate = kwargs.pop('revalidate', None)
+        self.warmRunner = kwargs.pop('warmRunner', settings.WARM_TEST_RUNNER)
         kwargs = self.setupShellMixin(kwargs)
         steps.BuildStep.__init__(self, **kwargs)
         self.observer = logobserver.BufferLogObserver()
@@ -81,44 +738,1689 @@ class GenerateStagesCommand(buildstep.ShellMixin, steps.BuildStep):
                                             stages.append(steps[-1])
         return stages
 
+    def getStageSpec(self, stage, warm=False, quarantined=False):
+        """ Everything needed to run a stage, as a plain (json) dict so that
+        it can also be sent to a shard build. With warm, the stage is run by
+        the warm test runner of the build. """
+        env = {}
+        env.update(self.env)
+        if self.needsGpu:
+            env['CUDA_VISIBLE_DEVICES'] = settings.GPU_SLOT
+        env.update(self.stageEnvs.get(stage, {}))
+        command = self.stagePrefix + stage.strip().split()
+        if warm:
+            command = (testServerCmd('run', self.getTestServerSocket(),
+                                     fallback=self.stagePrefix, envVars=env) +
+                       stage.strip().split())
+
+        # if settings.SCIPION_CMD in self.stagePrefix:
+        #     command = ["bash", "-c",
+        #                settings.CONDA_ACTIVATION_CMD +
+        #                " ; " + "./scipion3 test" + " " +
+        #                stage.strip()]
+
+        if self.rootName == settings.XMIPP_CMD:
+            command = ["bash", "-c", settings.DEVEL_ENV_ACTIVATION +
+                       " && source build/xmipp.bashrc && ../scipion3 run "
+                       + stage.strip()]
+
+        spec = {'name': stage,
+                'command': command,
+                'description': "Testing %s" % self.rootName + stage.split('.')[-1],
+                'descriptionDone': self.rootName + stage.split('.')[-1],
+                'timeout': self.timeout,
+                'env': env}
+        if ' ' in stage.strip():
+            # a batch of classes (see planStages)
+            classes = stage.split()
+            spec['name'] = 'Batch of %d: %s' % (len(classes),
+                                                ' '.join(c.split('.')[-1] for c in classes))
+            spec['description'] = 'Testing %d classes' % len(classes)
+            spec['descriptionDone'] = '%d classes' % len(classes)
+            spec['stages'] = classes
+        if quarantined:
+            spec['quarantined'] = True
+            spec['description'] += ' (quarantined)'
+            spec['descriptionDone'] += ' (quarantined)'
+        return spec
+
+    def planStages(self, stages):
+        """ Adapt the stages to their recorded durations: classes shorter
+        than STAGE_MERGE_BELOW are merged in batches ('A B C', run by a single
+        'scipion3 test A B C') and classes longer than STAGE_SPLIT_ABOVE are
+        split in a stage per test method. """
+        if (not settings.STAGE_ADAPTIVE or not self.stagePrefix or
+                self.rootName == settings.XMIPP_CMD):
+            return stages
+        planned, small = [], []
+        for stage in stages:
+            duration = stageHistory.getDuration(self.groupId, stage)
+            methods = stageMethods.getMethods(self.groupId, stage)
+            if duration is not None and duration > settings.STAGE_SPLIT_ABOVE and methods:
+                planned += ['%s.%s' % (stage, method) for method in methods]
+            elif (duration is not None and duration < settings.STAGE_MERGE_BELOW and
+                  stage not in self.stageEnvs):
+                small.append((duration, stage))
+            else:
+                planned.append(stage)
+
+        # first fit decreasing
+        batches = []
+        for duration, stage in sorted(small, reverse=True):
+            for batch in batches:
+                if batch[0] + duration <= settings.STAGE_BATCH_TARGET:
+                    batch[0] += duration
+                    batch[1].append(stage)
+                    break
+            else:
+                batches.append([duration, [stage]])
+        return planned + [' '.join(batchStages) for _, batchStages in batches]
+
+    def getStageCommands(self, stages, warm=False, quarantined=False):
+        """ Create a step for each stage, sorted by the stageOrder policy """
+        stages = stageHistory.sortStages(self.groupId, stages, self.stageOrder)
+        specs = addDatasetPrefetch(self.groupId, [self.getStageSpec(stage, warm, quarantined)
+                                                  for stage in stages])
+        return makeStageCommands(specs, self.groupId, self.maxParallelStages)
+
+    def selectFailedStages(self, stages):
+        """ Stages that failed in their last run (RERUN_FAILED builds) """
+        failed = stageOutcomes.getFailedStages(self.groupId, stages)
+        self.descriptionDone = ('rerunning %d failed of %d %s test stages'
+                                % (len(failed), len(stages), self.targetTestSet))
+        return failed
+
+    def useWarmRunner(self):
+        """ Whether the stages run in the warm test runner: only scipion
+        test classes, as the xmipp binaries don't start a python """
+        return (self.warmRunner and self.rootName != settings.XMIPP_CMD and
+                self.stagePrefix[-1:] == ['test'])
+
+    def getTestServerSocket(self):
+        builder = re.sub(r'\W+', '_', self.getProperty('buildername', ''))[:40]
+        return os.path.join(settings.WARM_TEST_RUNNER_DIR, 'scipion-tests-%s-%s.sock'
+                            % (builder, self.getProperty('buildnumber', 0)))
+
+    def getTestServerSteps(self):
+        """ Steps starting the warm test runner of the build before the
+        stages, and stopping it after them """
+        socket = self.getTestServerSocket()
+        start = [downloadWorkerScript('testserver.py'),
+                 steps.ShellCommand(
+                     command=testServerCmd('serve', socket, scipionCmd=self.stagePrefix[0]),
+                     name='Start %s test runner' % self.targetTestSet,
+                     description='Starting %s test runner' % self.targetTestSet,
+                     descriptionDone='Started %s test runner' % self.targetTestSet,
+                     timeout=settings.timeOutShort,
+                     # the stages run without it
+                     flunkOnFailure=False,
+                     warnOnFailure=True)]
+        stop = steps.ShellCommand(
+            command=testServerCmd('stop', socket),
+            name='Stop %s test runner' % self.targetTestSet,
+            description='Stopping %s test runner' % self.targetTestSet,
+            descriptionDone='Stopped %s test runner' % self.targetTestSet,
+            timeout=settings.timeOutShort,
+            flunkOnFailure=False,
+            alwaysRun=True)
+        return start, stop
+
+    def getShardTrigger(self, stages):
+        """ Split the stages in self.shards balanced shards and create the
+        step triggering a shard build for each of them. """
+        shards = [addDatasetPrefetch(self.groupId,
+                                     [self.getStageSpec(stage) for stage in
+                                      stageHistory.sortStages(self.groupId, shard,
+                                                              self.stageOrder)])
+                  for shard in balanceShards(self.groupId, stages, self.shards)]
+        return ShardTrigger(
+            schedulerNames=[settings.TEST_SHARD_PREFIX + self.groupId],
+            shards=shards,
+            maxParallelStages=self.maxParallelStages,
+            name="Run %s test shards" % self.targetTestSet,
+            description="Running %s test shards" % self.targetTestSet,
+            descriptionDone="%s test shards" % self.targetTestSet,
+            waitForFinish=True)
+
     @defer.inlineCallbacks
-    def run(self):
+    def selectImpactedStages(self, stages):
+        """ Stages of the test modules affected by the plugin changes, or
+        None when the full suite has to be run """
+        cmd = yield makeSideCommand(self, testImpactCmd('select', self.testImpact, self.groupId,
+                                                        self.getProperty('PLUGIN_COMMIT')),
+                                    collectStdout=True,
+                                    stdioLogName='test impact')
+        yield self.runCommand(cmd)
+        affected = [line.strip() for line in cmd.stdout.splitlines()
+                    if line.strip() and not line.startswith('#')]
+        if cmd.results() != util.SUCCESS or TEST_IMPACT_ALL in affected:
+            defer.returnValue(None)
+        selected = [stage for stage in stages
+                    if stage.rsplit('.', 1)[0] in affected]
+        self.descriptionDone = ('%d of %d %s test classes affected'
+                                % (len(selected), len(stages), self.targetTestSet))
+        defer.returnValue(selected)
+
+    def getTestImpactMapStep(self):
+        """ Step recording the test impact map of the plugin after a
+        green full run """
+        return steps.ShellCommand(
+            command=testImpactCmd('map', self.testImpact, self.groupId,
+                                  self.getProperty('PLUGIN_COMMIT')),
+            name='Record %s test impact map' % self.targetTestSet,
+            description='Recording %s test impact map' % self.targetTestSet,
+            descriptionDone='Recorded %s test impact map' % self.targetTestSet,
+            doStepIf=isTestImpactMapToRecord,
+            timeout=settings.timeOutShort,
+            flunkOnFailure=False,
+            warnOnFailure=True)
+
+    @defer.inlineCallbacks
+    def getDiscoveryKey(self):
+        """ (name, key) of the discovery cache entry of this step, (None,
+        None) if it can not be cached """
+        commit = self.getProperty('PLUGIN_COMMIT')
+        if not (self.discoveryCache and commit):
+            defer.returnValue((None, None))
+        name = '%s %s' % (self.groupId, ' '.join(self.command))
+        cmd = yield makeSideCommand(self, envHashCmd(self.stagePrefix[0]),
+                                    collectStdout=True,
+                                    stdioLogName='environment hash')
+        yield self.runCommand(cmd)
+        if cmd.results() != util.SUCCESS:
+            defer.returnValue((None, None))
+        key = '%s %s %s' % (commit, cmd.stdout.strip(), self.pattern)
+        defer.returnValue((name, key))
+
+    @defer.inlineCallbacks
+    def discover(self):
+        """ (stdout, result) of the discovery command, from the discovery
+        cache when its key didn't change. self.stale is set when an outdated
+        entry is used. """
+        self.stale = False
+        if self.discovered is not None and self.revalidate is None:
+            yield self.addCompleteLog('discovered stages', self.discovered)
+            self.descriptionDone = '%s test stages (already discovered)' % self.targetTestSet
+            defer.returnValue((self.discovered, util.SUCCESS))
+
+        name, key = yield self.getDiscoveryKey()
+        if key is not None and self.revalidate is None:
+            stdout, fresh = discoveryCache.get(name, key)
+            if stdout is not None and (fresh or settings.DISCOVERY_STALE_WHILE_REVALIDATE):
+                yield self.addCompleteLog('cached stages', stdout)
+                self.stale = not fresh
+                self.descriptionDone = ('%s test stages (%s cache)'
+                                        % (self.targetTestSet,
+                                           'stale' if self.stale else 'from'))
+                defer.returnValue((stdout, util.SUCCESS))
+
         # run './build.sh --list-stages' to generate the list of stages
         cmd = yield self.makeRemoteShellCommand()
         yield self.runCommand(cmd)
+        stdout = self.observer.getStdout()
+        if cmd.results() == util.SUCCESS and key is not None:
+            discoveryCache.put(name, key, stdout)
+        if cmd.results() == util.SUCCESS and self.discoveredProperty:
+            self.setProperty(self.discoveredProperty, stdout, 'GenerateStagesCommand')
+        defer.returnValue((stdout, cmd.results()))
+
+    def getRevalidateStep(self, stages, warm):
+        """ Step running the discovery again after the stages from a stale
+        cache entry, to refresh it and run the new stages (in the warm test
+        runner of this step if warm) """
+        kwargs = dict(self.initKwargs, revalidate=stages, warmRunner=warm)
+        kwargs['name'] = 'Revalidate %s test stages' % self.targetTestSet
+        kwargs['description'] = 'Revalidating %s test stages' % self.targetTestSet
+        kwargs['descriptionDone'] = 'Revalidated %s test stages' % self.targetTestSet
+        return GenerateStagesCommand(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        stdout, result = yield self.discover()
 
         # if the command passes extract the list of stages
-        result = cmd.results()
         if result == util.SUCCESS:
-            # create a ShellCommand for each stage and add them to the build
-            testShellCommands = []
-            env = {}
-            env.update(self.env)
-            for stage in self.extract_stages(self.observer.getStdout(),
-                                             self.rootName):
-                env.update(self.stageEnvs.get(stage, {}))
-                command = self.stagePrefix + stage.strip().split()
-
-                # if settings.SCIPION_CMD in self.stagePrefix:
-                #     command = ["bash", "-c",
-                #                settings.CONDA_ACTIVATION_CMD +
-                #                " ; " + "./scipion3 test" + " " +
-                #                stage.strip()]
-
-                if self.rootName == settings.XMIPP_CMD:
-                    command = ["bash", "-c", settings.DEVEL_ENV_ACTIVATION +
-                               " && source build/xmipp.bashrc && ../scipion3 run "
-                               + stage.strip()]
-
-                testShellCommands.append(steps.ShellCommand(
-                    command=command,
-                    name=stage,
-                    description="Testing %s" % self.rootName + stage.split('.')[-1],
-                    descriptionDone=self.rootName + stage.split('.')[-1],
-                    timeout=self.timeout,
-                    env=env))
-            if len(testShellCommands) == 0 and self.failOnEmptyTestStages:
+            stages = self.extract_stages(stdout, self.rootName)
+            selected = None
+            useTestImpact = (self.testImpact and self.getProperty('PLUGIN_COMMIT')
+                             and self.getProperty('TEST_IMPACT', False))
+            if self.getProperty('RERUN_FAILED', False):
+                selected = self.selectFailedStages(stages)
+            elif useTestImpact:
+                selected = yield self.selectImpactedStages(stages)
+            if self.revalidate is not None:
+                # only the stages missing in the stale cache entry
+                stages = [stage for stage in (stages if selected is None else selected)
+                          if stage not in self.revalidate]
+                if stages:
+                    self.build.addStepsAfterCurrentStep(
+                        self.getStageCommands(self.planStages(stages),
+                                              self.useWarmRunner()))
+                self.descriptionDone = ('%d new %s test stages'
+                                        % (len(stages), self.targetTestSet))
+                defer.returnValue(result)
+            if selected is not None:
+                # nothing affected (or failed) is fine, the full run found the stages
+                stages = selected
+            elif len(stages) == 0 and self.failOnEmptyTestStages:
                 defer.returnValue(util.FAILURE)
-            self.build.addStepsAfterCurrentStep(testShellCommands)
+            discoveredStages = stages
+            # flaky stages run apart, after the others
+            quarantined = [stage for stage in stages
+                           if stageOutcomes.isQuarantined(self.groupId, stage)]
+            stages = self.planStages([stage for stage in stages if stage not in quarantined])
+            quarantined = self.planStages(quarantined)
+            # the shard builds don't use the runner
+            warm = (self.useWarmRunner() and bool(stages or quarantined) and
+                    not (self.shards > 1 and len(stages) > 1))
+            if self.shards > 1 and len(stages) > 1:
+                # run the stages in shard builds
+                stageSteps = [self.getShardTrigger(stages)]
+            else:
+                # create a ShellCommand for each stage and add them to the build
+                stageSteps = self.getStageCommands(stages, warm)
+            if quarantined:
+                stageSteps += self.getStageCommands(quarantined, warm, quarantined=True)
+            if self.stale:
+                stageSteps.append(self.getRevalidateStep(discoveredStages, warm))
+            if warm:
+                # the revalidation stages use the same runner
+                start, stop = self.getTestServerSteps()
+                stageSteps = start + stageSteps + [stop]
+            if selected is None and self.testImpact and self.getProperty('PLUGIN_COMMIT'):
+                stageSteps.append(self.getTestImpactMapStep())
+            self.build.addStepsAfterCurrentStep(stageSteps)
+
+        defer.returnValue(result)
+
+
+# *****************************************************************************
+#               DEPENDENCY-AWARE PLUGIN TRIGGER
+# *****************************************************************************
+from buildbot import config
+from buildbot.process.results import SUCCESS, CANCELLED, EXCEPTION
+from twisted.python.failure import Failure
+try:
+    from buildbot.reporters.utils import getURLForBuildrequest
+except ImportError:
+    # buildbot < 3 (no reporters helper, master.status was removed later)
+    def getURLForBuildrequest(master, brid):
+        return master.status.getURLForBuildrequest(brid)
+
+
+def sortPluginsByDependencies(plugins):
+    """ Return the plugin names of the plugins dict (as read from the plugins
+    json file) sorted so that every plugin comes after the plugins listed in
+    its 'dependsOn' field. Plugins without dependencies keep the json order.
+    Dependencies on plugins that are not in the dict are ignored, they are
+    installed somewhere else (e.g. scipion-em-tomo in the install builder).
+    """
+    ordered = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError("Circular plugin dependency: %s"
+                             % ' -> '.join(path + [name]))
+        visiting.add(name)
+        for dep in plugins[name].get('dependsOn', []):
+            if dep in plugins:
+                visit(dep, path + [name])
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in plugins:
+        visit(name, [])
+    return ordered
+
+
+def getPluginDependencies(plugins):
+    """ Return a dict with the (known) dependencies of each plugin. """
+    return {name: [dep for dep in plugin.get('dependsOn', []) if dep in plugins]
+            for name, plugin in plugins.items()}
+
+
+class DependencyTrigger(steps.Trigger):
+    """ Trigger step that starts the given schedulers following a dependency
+    graph: a scheduler is triggered only when all the schedulers it depends on
+    have finished, and no more than maxParallel of them run at the same time.
+    schedulerProperties adds properties to the builds of some schedulers.
+    With resumeGroup, the result of each scheduler is recorded for the
+    orchestrator resume, and in a RESUMING run the schedulers still green
+    are skipped unless one of their dependencies runs again.
+    With pipelineInstalls, the install of a build overlaps the tests of the
+    others: a build tells when its install steps are done (PluginInstalled
+    step), then the next one is triggered and the schedulers depending on
+    it are ready. One build installs at a time, and it counts in the
+    maxParallel builds running.
+    Usage example:
+    DependencyTrigger(schedulerNames=['eman2_devel', 'locscale_devel'],
+                      dependencies={'locscale_devel': ['eman2_devel']},
+                      maxParallel=4,
+                      waitForFinish=True,
+                      set_properties=props,
+                      schedulerProperties={'eman2_devel': {'A': 1}})
+    """
+
+    renderables = ['schedulerProperties']
+
+    def __init__(self, dependencies=None, maxParallel=1, schedulerProperties=None,
+                 resumeGroup=None, pipelineInstalls=False, **kwargs):
+        self.dependencies = dependencies or {}
+        self.resumeGroup = resumeGroup
+        self.pipelineInstalls = pipelineInstalls
+        self.maxParallel = max(1, maxParallel)
+        self.schedulerProperties = schedulerProperties or {}
+        steps.Trigger.__init__(self, **kwargs)
+        if not kwargs.get('waitForFinish', False):
+            config.error("DependencyTrigger needs waitForFinish=True")
+        try:
+            sortPluginsByDependencies({name: {'dependsOn': self.dependencies.get(name, [])}
+                                       for name in self.schedulerNames})
+        except ValueError as e:
+            config.error(str(e))
+
+    def isReady(self, schedulerName, finished):
+        return all(dep in finished or dep not in self.schedulerNames
+                   for dep in self.dependencies.get(schedulerName, []))
+
+    def hasFreeSlot(self, running, installing):
+        if self.pipelineInstalls and installing:
+            return False
+        return running < self.maxParallel
+
+    def getInstallKey(self, schedulerName):
+        return '%s %s' % (self.build.buildid, schedulerName)
+
+    @defer.inlineCallbacks
+    def triggerScheduler(self, schedulerName, sourceStamps, props, onFinished):
+        """ Trigger the scheduler, onFinished gets its results (a deferred
+        can not be the result of an inlineCallbacks function) """
+        sch = self.getSchedulerByName(schedulerName)
+        idsDeferred, resultsDeferred = sch.trigger(
+            waited_for=True, sourcestamps=sourceStamps,
+            set_props=self.createTriggerProperties(props),
+            parent_buildid=self.build.buildid,
+            parent_relationship=self.parent_relationship)
+        resultsDeferred.addBoth(onFinished)
+        _, brids = yield idsDeferred
+        self.brids.extend(brids.values())
+        for brid in brids.values():
+            url = getURLForBuildrequest(self.master, brid)
+            yield self.addURL("%s #%s" % (sch.name, brid), url)
+            self._add_results(brid)
+
+    @defer.inlineCallbacks
+    def run(self):
+        sourceStamps = self.prepareSourcestampListForTrigger()
+        pending = list(self.schedulerNames)
+        finished = set()
+        running = 0
+        rclist = []
+        results = SUCCESS
+        finishedQueue = defer.DeferredQueue()
+        self.running = True
+        self.triggeredNames = []
+        skipped = []
+        # with pipelineInstalls, the dependencies only need to be installed
+        installed = set() if self.pipelineInstalls else finished
+        installing = 0
 
+        while pending or running:
+            for schedulerName in list(pending):
+                if self.ended or not self.hasFreeSlot(running, installing):
+                    break
+                if not self.isReady(schedulerName, installed):
+                    continue
+                pending.remove(schedulerName)
+                if (self.resumeGroup and
+                        not any(dep in self.triggeredNames
+                                for dep in self.dependencies.get(schedulerName, [])) and
+                        isResumeSkippable(self, self.resumeGroup, schedulerName)):
+                    skipped.append(schedulerName)
+                    finished.add(schedulerName)
+                    installed.add(schedulerName)
+                    continue
+                try:
+                    props = dict(self.set_properties)
+                    props.update(self.schedulerProperties.get(schedulerName, {}))
+                    if self.pipelineInstalls:
+                        props['INSTALL_PIPELINE'] = self.getInstallKey(schedulerName)
+                        installPipeline.wait(props['INSTALL_PIPELINE']).addCallback(
+                            lambda _, name=schedulerName: finishedQueue.put((name, None)))
+                    yield self.triggerScheduler(schedulerName, sourceStamps, props,
+                                                lambda res, name=schedulerName:
+                                                finishedQueue.put((name, res)))
+                except Exception as e:
+                    yield self.addLogWithException(e)
+                    results = EXCEPTION
+                    finished.add(schedulerName)
+                    installed.add(schedulerName)
+                    installPipeline.forget(self.getInstallKey(schedulerName))
+                    continue
+                running += 1
+                if self.pipelineInstalls:
+                    installing += 1
+                self.triggeredNames.append(schedulerName)
+                self.updateSummary()
+            if self.ended:
+                defer.returnValue(CANCELLED)
+            if not running:
+                break
+            schedulerName, res = yield finishedQueue.get()
+            if self.pipelineInstalls and schedulerName not in installed:
+                # installed, or finished without telling it (e.g. a failed install)
+                installing -= 1
+                installed.add(schedulerName)
+                installPipeline.forget(self.getInstallKey(schedulerName))
+                if res is None:
+                    continue
+            running -= 1
+            finished.add(schedulerName)
+            rclist.append((not isinstance(res, Failure), res))
+            if self.resumeGroup:
+                recordTriggerResult(self, self.resumeGroup, schedulerName, res)
+
+        if skipped:
+            yield self.addCompleteLog('green in the last run', '\n'.join(skipped))
+        if self.resumeGroup and self.triggeredNames:
+            self.setProperty('RESUME_RERUN', True, 'DependencyTrigger')
+        yield self.addBuildUrls(rclist)
+        results = yield self.worstStatus(results, rclist, [])
+        defer.returnValue(results)
+
+
+class InstallPipeline(object):
+    """ Pipelined DependencyTrigger steps waiting for the install steps of
+    the builds they triggered, {INSTALL_PIPELINE key: Deferred} """
+
+    def __init__(self):
+        self.waiting = {}
+
+    def wait(self, key):
+        self.waiting[key] = defer.Deferred()
+        return self.waiting[key]
+
+    def done(self, key):
+        d = self.waiting.pop(key, None)
+        if d is not None:
+            d.callback(None)
+
+    def forget(self, key):
+        self.waiting.pop(key, None)
+
+
+installPipeline = InstallPipeline()
+
+
+class PluginInstalled(steps.BuildStep):
+    """ Tell the trigger of the build (INSTALL_PIPELINE property) that the
+    plugin is installed, it can start the next install during the tests """
+
+    def run(self):
+        if self.getProperty('INSTALL_PIPELINE'):
+            installPipeline.done(self.getProperty('INSTALL_PIPELINE'))
+        return defer.succeed(util.SUCCESS)
+
+
+def installLock(groupId):
+    """ Exclusive access to the environment of the group in the worker,
+    for the steps installing in it (pip is not safe to run concurrently) """
+    return util.WorkerLock('install_%s' % groupId).access('exclusive')
+
+
+# *****************************************************************************
+#               ORCHESTRATOR RESUME
+# *****************************************************************************
+RESUME_GREEN = (SUCCESS, util.WARNINGS)
+
+
+class OrchestratorRuns(JsonStore):
+    """ Last orchestrator run of each group, {groupId: {'envHash',
+    'triggers': {schedulerName: {'result', 'commit'}}}}. envHash is the hash
+    of the environment at the end of the run. """
+
+    def reset(self, groupId):
+        self.data[groupId] = {'envHash': None, 'triggers': {}}
+        self.save()
+
+    def getEnvHash(self, groupId):
+        return self.data.get(groupId, {}).get('envHash')
+
+    def setEnvHash(self, groupId, envHash):
+        self.data.setdefault(groupId, {'triggers': {}})['envHash'] = envHash
+        self.save()
+
+    def getTrigger(self, groupId, schedulerName):
+        return self.data.get(groupId, {}).get('triggers', {}).get(schedulerName)
+
+    def recordTrigger(self, groupId, schedulerName, result, commit):
+        group = self.data.setdefault(groupId, {'envHash': None, 'triggers': {}})
+        group['triggers'][schedulerName] = {'result': result, 'commit': commit}
+        self.save()
+
+
+orchestratorRuns = OrchestratorRuns(settings.ORCHESTRATOR_RUNS_FILE)
+
+
+def resumeStateCmd(scipionCmd, urls):
+    """ Command printing the environment hash and then a 'name commit' line
+    for each {name: pluginSourceUrl} in urls.
+    downloadWorkerScript('envhash.py') must be run before. """
+    lines = [' '.join(envHashCmd(scipionCmd))]
+    for name, url in sorted(urls.items()):
+        repo, ref = splitSourceUrl(url)
+        lines.append('echo "%s $(git ls-remote %s %s | head -1 | cut -f1)"'
+                     % (name, repo, ref))
+    return ['bash', '-c', ' ; '.join(lines)]
+
+
+class CheckResume(buildstep.ShellMixin, steps.BuildStep):
+    """ First step of the orchestrators. Resolves the commits of the plugins
+    (RESUME_COMMITS property, recorded with the trigger results) and, when
+    the build is forced with RESUME and the environment hash is the one at
+    the end of the last run, sets RESUMING so that the triggers that were
+    green with the same commit are skipped (see isResumeSkippable). Any
+    other run starts a new record. urls is {schedulerName: pluginSourceUrl}. """
+
+    def __init__(self, groupId, urls=None, scipionCmd=settings.SCIPION_CMD, **kwargs):
+        self.groupId = groupId
+        self.urls = urls or {}
+        kwargs['command'] = resumeStateCmd(scipionCmd, self.urls)
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(collectStdout=True)
+        yield self.runCommand(cmd)
+        lines = cmd.stdout.strip().splitlines() or ['']
+        envHash = lines[0].strip() if cmd.results() == SUCCESS else ''
+        commits = dict((line.split() + [''])[:2] for line in lines[1:] if line.strip())
+        self.setProperty('RESUME_COMMITS', commits, 'CheckResume')
+
+        resuming = (self.getProperty('RESUME', False) and bool(envHash) and
+                    envHash == orchestratorRuns.getEnvHash(self.groupId))
+        self.setProperty('RESUMING', resuming, 'CheckResume')
+        if resuming:
+            self.descriptionDone = 'resuming the last %s run' % self.groupId
+        else:
+            if self.getProperty('RESUME', False):
+                self.descriptionDone = 'environment changed, running everything'
+            orchestratorRuns.reset(self.groupId)
+        defer.returnValue(SUCCESS)
+
+
+class RecordResumeState(buildstep.ShellMixin, steps.BuildStep):
+    """ Last step of the orchestrators: record the environment hash at the
+    end of the run. downloadWorkerScript('envhash.py') must be run before. """
+
+    def __init__(self, groupId, scipionCmd=settings.SCIPION_CMD, **kwargs):
+        self.groupId = groupId
+        kwargs['command'] = envHashCmd(scipionCmd)
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand(collectStdout=True)
+        yield self.runCommand(cmd)
+        envHash = cmd.stdout.strip() if cmd.results() == SUCCESS else None
+        orchestratorRuns.setEnvHash(self.groupId, envHash)
+        defer.returnValue(cmd.results())
+
+
+def isResumeSkippable(step, groupId, schedulerName):
+    """ Whether the trigger of schedulerName can be skipped in a RESUMING
+    run: it was green in the last run, with the same plugin commit, and no
+    trigger before it has run in this one (RESUME_RERUN) """
+    if not step.getProperty('RESUMING', False) or step.getProperty('RESUME_RERUN', False):
+        return False
+    last = orchestratorRuns.getTrigger(groupId, schedulerName)
+    commit = step.getProperty('RESUME_COMMITS', {}).get(schedulerName)
+    return (last is not None and last['result'] in RESUME_GREEN and
+            last['commit'] == commit)
+
+
+def recordTriggerResult(step, groupId, schedulerName, res):
+    """ Record the result of a triggered build (res as given by the
+    scheduler: (result, brids) or a Failure) """
+    result = res[0] if isinstance(res, tuple) else EXCEPTION
+    orchestratorRuns.recordTrigger(groupId, schedulerName, result,
+                                   step.getProperty('RESUME_COMMITS', {}).get(schedulerName))
+
+
+class ResumableTrigger(steps.Trigger):
+    """ Trigger of a single scheduler in an orchestrator, skipped when the
+    run resumes the last one and the scheduler was green there """
+
+    def __init__(self, groupId, **kwargs):
+        self.groupId = groupId
+        steps.Trigger.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        schedulerName = self.schedulerNames[0]
+        if isResumeSkippable(self, self.groupId, schedulerName):
+            self.descriptionDone = '%s green in the last run' % schedulerName
+            defer.returnValue(util.SKIPPED)
+        self.setProperty('RESUME_RERUN', True, 'ResumableTrigger')
+        result = yield steps.Trigger.run(self)
+        recordTriggerResult(self, self.groupId, schedulerName, (result, {}))
         defer.returnValue(result)
+
+
+# *****************************************************************************
+#               WORKER POOLS
+# *****************************************************************************
+# Last known load of the workers, {workername: {'cpus', 'load', 'freeDisk', 'time'}}.
+# It is refreshed by the WorkerLoadProbe step at the beginning of every
+# orchestrator build.
+workersLoad = {}
+
+
+def getRunningBuilds(workerforbuilder):
+    return len([wfb for wfb in workerforbuilder.worker.workerforbuilders.values()
+                if wfb.isBusy()])
+
+
+def getWorkerLoadKey(workerforbuilder):
+    load = workersLoad.get(workerforbuilder.worker.workername, {})
+    freeCpus = load.get('cpus', 1) - load.get('load', 0)
+    return (getRunningBuilds(workerforbuilder), -freeCpus, -load.get('freeDisk', 0))
+
+
+GROUP_PROPERTIES = ['SCIPION_HOME', 'SCIPION_LOCAL_CONFIG', 'BUILD_GROUP_HOME']
+
+
+class GroupHomes(JsonStore):
+    """ Worker and GROUP_PROPERTIES of the last orchestrator build of each
+    group: {groupId: {'worker', 'SCIPION_HOME', ...}} """
+
+    def record(self, groupId, worker, properties):
+        self.data[groupId] = dict(properties, worker=worker)
+        self.save()
+
+    def getWorker(self, groupId):
+        return self.data.get(groupId, {}).get('worker')
+
+    def getProperties(self, groupId):
+        return {name: value for name, value in self.data.get(groupId, {}).items()
+                if name in GROUP_PROPERTIES}
+
+
+groupHomes = GroupHomes(settings.GROUP_HOMES_FILE)
+
+
+class RecordGroupHome(steps.BuildStep):
+    """ Keep the worker and the GROUP_PROPERTIES of an orchestrator build """
+
+    def __init__(self, groupId, **kwargs):
+        self.groupId = groupId
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        groupHomes.record(self.groupId, self.getProperty('workername'),
+                          {name: self.getProperty(name) for name in GROUP_PROPERTIES})
+        return defer.succeed(util.SUCCESS)
+
+
+class SetGroupProperties(steps.BuildStep):
+    """ Set the GROUP_PROPERTIES of builds not triggered by an orchestrator
+    (pushes, forced builds) from the last orchestrator build of the group,
+    which must have run in the same worker. """
+
+    def __init__(self, groupId, **kwargs):
+        self.groupId = groupId
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        if self.getProperty('SCIPION_HOME'):
+            return defer.succeed(util.SUCCESS)
+        properties = groupHomes.getProperties(self.groupId)
+        if (not properties or
+                groupHomes.getWorker(self.groupId) != self.getProperty('workername')):
+            self.descriptionDone = '%s is not installed in this worker' % self.groupId
+            return defer.succeed(util.FAILURE)
+        for name, value in properties.items():
+            self.setProperty(name, value, 'SetGroupProperties')
+        self.descriptionDone = 'SCIPION_HOME of the last %s build' % self.groupId
+        return defer.succeed(util.SUCCESS)
+
+
+def nextWorker(builder, workers, buildrequest):
+    """ nextWorker policy of the builders using the WORKER_POOLS. Builds
+    triggered by an orchestrator stay in the orchestrator worker (the one
+    where SCIPION_HOME is installed), builds of a BUILD_GROUP in the worker
+    of its last orchestrator build. Otherwise, the least loaded worker is
+    picked: fewer running builds first, then more free CPUs and disk.
+    """
+    orchestratorWorker = (buildrequest.properties.getProperty('ORCHESTRATOR_WORKER') or
+                          groupHomes.getWorker(buildrequest.properties.getProperty('BUILD_GROUP')))
+    if orchestratorWorker:
+        workers = [wfb for wfb in workers
+                   if wfb.worker.workername == orchestratorWorker]
+    if not workers:
+        return None
+    return min(workers, key=getWorkerLoadKey)
+
+
+def canStartBuild(builder, workerforbuilder, buildrequest):
+    """ Don't start builds on a worker running out of disk under
+    BUILD_GROUP_HOME (WORKER_MIN_FREE_DISK, in GB), but the disk janitor.
+    The orchestrators are not gated, their WorkerLoadProbe refreshes the
+    reading, and readings older than WORKER_LOAD_MAX_AGE seconds are
+    ignored, so a worker is never locked out by an old one. """
+    if builder.name.startswith(settings.DISK_JANITOR_PREFIX):
+        # it is the one freeing the disk
+        return True
+    load = workersLoad.get(workerforbuilder.worker.workername, {})
+    if time.time() - load.get('time', 0) > settings.WORKER_LOAD_MAX_AGE:
+        return True
+    return load.get('freeDisk', settings.WORKER_MIN_FREE_DISK) >= settings.WORKER_MIN_FREE_DISK
+
+
+class WorkerLoadProbe(buildstep.ShellMixin, steps.BuildStep):
+    """ Measure the CPUs, load average and free disk (under path) of the
+    worker running the build and keep them in workersLoad. """
+
+    renderables = ['path']
+
+    def __init__(self, path='.', **kwargs):
+        self.path = path
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        command = ['bash', '-c', 'nproc && cut -d" " -f1 /proc/loadavg && '
+                                 'df -Pk %s | tail -1 | awk \'{print $4}\'' % self.path]
+        cmd = yield self.makeRemoteShellCommand(command=command, collectStdout=True)
+        yield self.runCommand(cmd)
+        result = cmd.results()
+        if result == util.SUCCESS:
+            cpus, load, freeKb = cmd.stdout.split()[:3]
+            workersLoad[self.getProperty('workername')] = {
+                'cpus': int(cpus),
+                'load': float(load),
+                'freeDisk': int(freeKb) // (1024 * 1024),
+                'time': time.time()}
+        defer.returnValue(result)
+
+
+class DiskJanitor(buildstep.ShellMixin, steps.BuildStep):
+    """ Free disk in the worker evicting the least recently used items of
+    all the groups installed in it (see groupHomes and diskJanitorCmd). The
+    trees of groupId are kept. Warns if the free space target is not met. """
+
+    def __init__(self, groupId, **kwargs):
+        self.groupId = groupId
+        kwargs.setdefault('decodeRC', {0: util.SUCCESS, 2: util.WARNINGS})
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        worker = self.getProperty('workername')
+        homes = {groupId: groupHomes.getProperties(groupId).get('BUILD_GROUP_HOME')
+                 for groupId in groupHomes.data
+                 if groupHomes.getWorker(groupId) == worker}
+        groupHome = self.getProperty('BUILD_GROUP_HOME') or homes.get(self.groupId)
+        homes[self.groupId] = groupHome
+        usedPaths = []
+        if groupHome:
+            usedPaths = [os.path.join(groupHome, tree)
+                         for tree in settings.DISK_JANITOR_GROUP_TREES]
+        if self.getProperty('SCIPION_HOME'):
+            usedPaths.append(self.getProperty('SCIPION_HOME'))
+        command = diskJanitorCmd([home for home in homes.values() if home],
+                                 usedPaths, groupHome or '~')
+        cmd = yield self.makeRemoteShellCommand(command=command)
+        yield self.runCommand(cmd)
+        defer.returnValue(cmd.results())
+
+
+# *****************************************************************************
+#               TEST SHARDS
+# *****************************************************************************
+# Properties of the parent build forwarded to the shard builds
+SHARD_PROPERTIES = ['SCIPION_HOME', 'SCIPION_LOCAL_CONFIG', 'BUILD_GROUP_HOME',
+                    'BUILD_GROUP']
+
+
+class ShardTrigger(steps.Trigger):
+    """ Trigger one build of the (single) scheduler for each shard of test
+    stages. Shards run in the worker of the parent build (ORCHESTRATOR_WORKER,
+    see nextWorker), the one where its SCIPION_HOME is installed. The step
+    result is the worst of the shards. """
+
+    def __init__(self, shards=None, maxParallelStages=1, **kwargs):
+        self.shards = shards or []
+        self.maxParallelStages = maxParallelStages
+        steps.Trigger.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def getSchedulersAndProperties(self):
+        workdir = yield self.build.render(self.workdir)
+        props = {prop: self.getProperty(prop) for prop in SHARD_PROPERTIES
+                 if self.getProperty(prop) is not None}
+        props['ORCHESTRATOR_WORKER'] = self.getProperty('workername')
+        props['SHARD_WORKDIR'] = workdir
+        props['SHARD_MAX_PARALLEL'] = self.maxParallelStages
+        schedulers = []
+        for i, shard in enumerate(self.shards):
+            shardProps = dict(props)
+            shardProps['SHARD_STAGES'] = shard
+            shardProps['SHARD_INDEX'] = '%d/%d' % (i + 1, len(self.shards))
+            schedulers.append({'sched_name': self.schedulerNames[0],
+                               'props_to_set': shardProps,
+                               'unimportant': False})
+        defer.returnValue(schedulers)
+
+
+class RunShardStages(steps.BuildStep):
+    """ Add a step for each of the stages in the SHARD_STAGES property """
+
+    def __init__(self, groupId='', **kwargs):
+        self.groupId = groupId
+        steps.BuildStep.__init__(self, **kwargs)
+
+    def run(self):
+        stages = self.getProperty('SHARD_STAGES') or []
+        self.build.addStepsAfterCurrentStep(
+            makeStageCommands(stages, self.groupId,
+                              self.getProperty('SHARD_MAX_PARALLEL', 1)))
+        self.descriptionDone = '%d stages' % len(stages)
+        return defer.succeed(util.SUCCESS)
+
+
+# *****************************************************************************
+#               GPU SLOTS
+# *****************************************************************************
+def needsGpuSlot(env):
+    return env.get('CUDA_VISIBLE_DEVICES') == settings.GPU_SLOT
+
+
+class GpuSlots(object):
+    """ Counting lock per worker over its GPU_SLOTS. Each holder gets a
+    different slot (the CUDA_VISIBLE_DEVICES value to use) and the ones
+    asking for a slot when there are none free wait in order. """
+
+    def __init__(self, slots, defaultSlots):
+        self.slots = slots
+        self.defaultSlots = defaultSlots
+        self.free = {}
+        self.waiting = {}
+
+    def getFree(self, workername):
+        if workername not in self.free:
+            self.free[workername] = list(self.slots.get(workername,
+                                                        self.defaultSlots))
+        return self.free[workername]
+
+    def acquire(self, workername):
+        """ Deferred firing with a slot of the worker """
+        free = self.getFree(workername)
+        if free:
+            return defer.succeed(free.pop(0))
+        d = defer.Deferred()
+        self.waiting.setdefault(workername, []).append(d)
+        return d
+
+    def release(self, workername, slot):
+        waiting = self.waiting.get(workername)
+        if waiting:
+            waiting.pop(0).callback(slot)
+        else:
+            self.getFree(workername).append(slot)
+
+
+gpuSlots = GpuSlots(settings.GPU_SLOTS, settings.GPU_DEFAULT_SLOTS)
+
+
+# *****************************************************************************
+#               SCIPION CONFIG
+# *****************************************************************************
+def renderConfig(content, keys):
+    """ Set the keys in the content of a scipion config file, replacing
+    their lines (and dropping repeated ones) or appending them at the end.
+    Keys with None values are left as they are. """
+    lines = content.splitlines()
+    for key, value in keys.items():
+        if value is None:
+            continue
+        line = '%s = %s' % (key, value)
+        regex = re.compile(r'^%s\s*=' % re.escape(key))
+        found = [i for i, l in enumerate(lines) if regex.match(l)]
+        if found:
+            lines[found[0]] = line
+            for i in reversed(found[1:]):
+                del lines[i]
+        else:
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+class ScipionConfigStep(buildstep.ShellMixin, steps.BuildStep):
+    """ Set the keys of the scipion config files in one go. configs is a
+    list of (path, keys). If the files already have those keys nothing is
+    done, otherwise command (scipion config --overwrite) regenerates them
+    and each file is written at once with its keys. The hash of the files
+    is kept in the SCIPION_CONFIG_HASH property. """
+
+    renderables = ['configs']
+
+    def __init__(self, configs=None, **kwargs):
+        self.configs = configs or []
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def readConfig(self, path):
+        """ Content of the config file or None if it doesn't exist """
+        cmd = yield makeSideCommand(self, ['bash', '-c', 'cat %s' % path],
+                                    collectStdout=True,
+                                    stdioLogName=None)
+        yield self.runCommand(cmd)
+        defer.returnValue(cmd.stdout if cmd.results() == util.SUCCESS else None)
+
+    @defer.inlineCallbacks
+    def run(self):
+        contents = []
+        for path, keys in self.configs:
+            content = yield self.readConfig(path)
+            if content is None or renderConfig(content, keys) != content:
+                break
+            contents.append(content)
+        else:
+            self.descriptionDone = 'Scipion config unchanged'
+
+        if len(contents) < len(self.configs):
+            cmd = yield self.makeRemoteShellCommand()
+            yield self.runCommand(cmd)
+            if cmd.results() != util.SUCCESS:
+                defer.returnValue(cmd.results())
+
+            contents = []
+            for path, keys in self.configs:
+                content = yield self.readConfig(path)
+                contents.append(renderConfig(content or '', keys))
+                cmd = yield makeSideCommand(self, ['bash', '-c', 'cat > %s' % path],
+                                            initialStdin=contents[-1])
+                yield self.runCommand(cmd)
+                if cmd.results() != util.SUCCESS:
+                    defer.returnValue(cmd.results())
+
+        configHash = hashlib.sha1(''.join(contents).encode()).hexdigest()
+        self.setProperty('SCIPION_CONFIG_HASH', configHash, 'ScipionConfigStep')
+        defer.returnValue(util.SUCCESS)
+
+
+# *****************************************************************************
+#               PLUGIN INSTALL LEDGER
+# *****************************************************************************
+def splitSourceUrl(url):
+    """ 'https://github.com/scipion-em/scipion-em-relion.git@devel' ->
+    ('https://github.com/scipion-em/scipion-em-relion.git', 'devel') """
+    repo, sep, ref = url.rpartition('@')
+    if not sep or '/' in ref:
+        return url, 'HEAD'
+    return repo, ref
+
+
+def normalizeRepoUrl(url):
+    """ Comparable form of a repository url, e.g. 'git+https://github.com/a/b.git',
+    'https://github.com/a/b' (github hook) -> 'github.com/a/b' """
+    url = url.strip().rstrip('/')
+    for prefix in ['git+', 'file://']:
+        if url.startswith(prefix):
+            url = url[len(prefix):]
+    url = url.split('://', 1)[-1]
+    if url.startswith('git@'):
+        url = url[len('git@'):].replace(':', '/', 1)
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url.lower()
+
+
+def isLocalRepo(url):
+    return url.startswith(('/', 'file://'))
+
+
+def isPluginInstallNeeded(step):
+    return not step.getProperty('PLUGIN_INSTALL_SKIPPED', False)
+
+
+def isPluginInstallToRecord(step):
+    """ Record the plugin commit only after a green install """
+    return (isPluginInstallNeeded(step) and
+            bool(step.getProperty('PLUGIN_COMMIT')) and
+            step.build.results in (util.SUCCESS, util.WARNINGS))
+
+
+class CheckPluginInstall(buildstep.ShellMixin, steps.BuildStep):
+    """ Resolve the ref of the plugin source url to a commit and compare it
+    with the one of the last green install in the PLUGIN_INSTALL_LEDGER of
+    the worker. Sets the PLUGIN_COMMIT and PLUGIN_INSTALL_SKIPPED properties,
+    the install steps are skipped (see isPluginInstallNeeded) when the
+    plugin is still installed from the same commit. Otherwise the
+    DISCOVERED_TESTS of the orchestrator are dropped. """
+
+    def __init__(self, pluginName, url, scipionCmd=settings.SCIPION_CMD, **kwargs):
+        self.pluginName = pluginName
+        self.url = url
+        self.scipionCmd = scipionCmd
+        kwargs = self.setupShellMixin(kwargs)
+        steps.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        repo, ref = splitSourceUrl(self.url)
+        command = ('git ls-remote %(repo)s %(ref)s | head -1 | cut -f1 ; '
+                   'if %(scipion)s python -m pip show %(plugin)s > /dev/null 2>&1 ; then '
+                   'grep "^%(plugin)s " %(ledger)s 2>/dev/null | cut -d" " -f2 ; fi'
+                   % {'repo': repo, 'ref': ref, 'scipion': self.scipionCmd,
+                      'plugin': self.pluginName,
+                      'ledger': settings.PLUGIN_INSTALL_LEDGER})
+        cmd = yield self.makeRemoteShellCommand(command=['bash', '-c', command],
+                                                collectStdout=True)
+        yield self.runCommand(cmd)
+        if cmd.results() != util.SUCCESS:
+            defer.returnValue(cmd.results())
+
+        commits = cmd.stdout.split() + ['', '']
+        commit, installedCommit = commits[0], commits[1]
+        skip = (bool(commit) and commit == installedCommit and
+                not self.getProperty('FORCE_PLUGIN_INSTALL', False))
+        self.setProperty('PLUGIN_COMMIT', commit, 'CheckPluginInstall')
+        self.setProperty('PLUGIN_INSTALL_SKIPPED', skip, 'CheckPluginInstall')
+        if not skip:
+            # found before the install by the orchestrator (see pluginsDiscovery)
+            self.setProperty('DISCOVERED_TESTS', None, 'CheckPluginInstall')
+        self.descriptionDone = ('%s unchanged (%s)' % (self.pluginName, commit[:8])
+                                if skip else '%s at %s' % (self.pluginName, commit[:8]))
+        defer.returnValue(util.SUCCESS)
+
+
+def recordPluginInstallCmd(pluginName):
+    """ Command saving PLUGIN_COMMIT as the installed commit of the plugin """
+    ledger = settings.PLUGIN_INSTALL_LEDGER
+    return ['bash', '-c', util.Interpolate(
+        'touch %(ledger)s && (grep -v "^%(plugin)s " %(ledger)s ; '
+        'echo "%(plugin)s %%(prop:PLUGIN_COMMIT)s") > %(ledger)s.tmp && '
+        'mv %(ledger)s.tmp %(ledger)s' % {'ledger': ledger, 'plugin': pluginName})]
+
+
+# *****************************************************************************
+#               WORKER SCRIPTS
+# *****************************************************************************
+WORKER_SCRIPTS_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'workerscripts')
+
+
+def workerScript(name):
+    """ Path of a script of workerscripts/ in the worker """
+    return os.path.join(settings.WORKER_SCRIPTS_DIR, name)
+
+
+def downloadWorkerScript(name):
+    """ Step copying a script of workerscripts/ to the worker """
+    return steps.FileDownload(mastersrc=os.path.join(WORKER_SCRIPTS_SRC, name),
+                              workerdest=workerScript(name),
+                              mode=0o755,
+                              name='Download %s' % name,
+                              description='Downloading %s' % name,
+                              descriptionDone='Downloaded %s' % name,
+                              haltOnFailure=True)
+
+
+def cachedInstallbCmd(scipionCmd, binary, args=('-j', '8')):
+    """ 'scipion installb' command going through the EM packages cache.
+    downloadWorkerScript('emcache.py') must be run before. """
+    return (['python3', workerScript('emcache.py'), 'installb',
+             '--cache', settings.EM_CACHE_DIR,
+             '--budget', str(settings.EM_CACHE_BUDGET),
+             '--link', settings.EM_CACHE_LINK,
+             '--name', binary, '--',
+             scipionCmd, 'installb', binary] + list(args))
+
+
+def envHashCmd(scipionCmd):
+    """ Command printing the hash of the environment of scipionCmd.
+    downloadWorkerScript('envhash.py') must be run before. """
+    return ['python3', workerScript('envhash.py'), '--scipion', scipionCmd,
+            '--extra', settings.PLUGIN_INSTALL_LEDGER]
+
+
+def condaEnvCmd(action, envName, condaInit, spec):
+    """ Command saving ('save') or restoring ('reset') a conda environment
+    through its snapshots cache. downloadWorkerScript('condaenv.py') must be
+    run before. spec is the install command of the environment. """
+    cmd = ['python3', workerScript('condaenv.py'), action,
+           '--cache', settings.CONDA_ENV_CACHE_DIR,
+           '--env', envName,
+           '--conda-init', condaInit,
+           '--spec', ' '.join(spec)]
+    if action == 'save':
+        cmd += ['--keep', str(settings.CONDA_ENV_CACHE_KEEP)]
+    else:
+        cmd += ['--max-age', str(settings.CONDA_ENV_CACHE_MAX_AGE)]
+    return cmd
+
+
+def testServerCmd(action, socket, scipionCmd=None, fallback=(), envVars=()):
+    """ testserver.py command starting ('serve') or stopping ('stop') the
+    warm test runner listening on socket, or running ('run') test classes
+    with it (they are appended to the command). 'serve' needs the scipionCmd
+    whose python is kept warm, and 'run' the fallback command used when the
+    server is not running and the envVars passed to the test run.
+    downloadWorkerScript('testserver.py') must be run before. """
+    if action == 'serve':
+        return [scipionCmd, 'python', workerScript('testserver.py'), 'serve',
+                '--socket', socket, '--daemon',
+                '--idle', str(settings.WARM_TEST_RUNNER_IDLE)]
+    cmd = ['python3', workerScript('testserver.py'), action, '--socket', socket]
+    if action == 'run':
+        cmd += ['--fallback', ' '.join(fallback)]
+        if envVars:
+            cmd += ['--env'] + sorted(envVars)
+        cmd += ['--']
+    return cmd
+
+
+def datasetsCmd(action, names=(), local=False):
+    """ datasets.py command syncing ('sync') or checking ('verify') the test
+    datasets names (and, with local, those already in TEST_DATASETS_DIR)
+    through the shared store, or prefetching them in the background
+    ('prefetch'). downloadWorkerScript('datasets.py') must be run before. """
+    cmd = ['python3', workerScript('datasets.py'), action,
+           '--store', settings.TEST_DATASETS_STORE,
+           '--tests', settings.TEST_DATASETS_DIR]
+    if action in ['sync', 'prefetch']:
+        cmd += ['--url', settings.TEST_DATASETS_URL,
+                '--jobs', str(settings.TEST_DATASETS_JOBS)]
+    if action == 'prefetch':
+        cmd += ['--cache', str(settings.TEST_DATASETS_PREFETCH_CACHE), '--detach']
+    if action == 'sync':
+        if local:
+            cmd += ['--local']
+    return cmd + ['--'] + list(names)
+
+
+def diskJanitorCmd(groupHomesOfWorker, usedPaths, path):
+    """ diskjanitor.py command freeing DISK_JANITOR_FREE GB under path, its
+    items are the trees and test projects of groupHomesOfWorker (the
+    BUILD_GROUP_HOME of the groups installed in the worker), the scratch and
+    the CryoSPARC projects. downloadWorkerScript('diskjanitor.py') must be
+    run before. """
+    items = []
+    for home in sorted(groupHomesOfWorker):
+        items += [os.path.join(home, tree) for tree in settings.DISK_JANITOR_GROUP_TREES]
+        items.append(os.path.join(home, 'ScipionUserData', 'projects', '*'))
+    items.append(os.path.join(settings.SCIPION_SCRATCH, '*'))
+    items.append(os.path.join(settings.CRYOSPARC_DIR, 'scipion_projects', '*'))
+    cmd = ['python3', workerScript('diskjanitor.py'), 'run',
+           '--state', settings.DISK_JANITOR_STATE,
+           '--path', path,
+           '--free', str(settings.DISK_JANITOR_FREE),
+           '--min-age', str(settings.DISK_JANITOR_MIN_AGE)]
+    if usedPaths:
+        cmd += ['--use'] + list(usedPaths)
+    return cmd + ['--'] + items
+
+
+# *****************************************************************************
+#               TEST IMPACT
+# *****************************************************************************
+TEST_IMPACT_ALL = 'ALL'
+
+
+def isTestImpactMapToRecord(step):
+    return step.build.results in (util.SUCCESS, util.WARNINGS)
+
+
+def testImpactCmd(action, testImpact, groupId, commit):
+    """ testimpact.py command recording ('map') or reading ('select') the
+    test impact map of a plugin. testImpact is a dict with the 'package',
+    the source 'url' and the 'scipionCmd' of the plugin.
+    downloadWorkerScript('testimpact.py') must be run before. """
+    mapFile = os.path.join(settings.TEST_IMPACT_DIR, groupId,
+                           '%s.json' % testImpact['package'])
+    cmd = ['python3', workerScript('testimpact.py'), action,
+           '--map', mapFile, '--commit', commit]
+    if action == 'map':
+        cmd += ['--scipion', testImpact['scipionCmd'],
+                '--package', testImpact['package']]
+    else:
+        cmd += ['--repo', splitSourceUrl(testImpact['url'])[0],
+                '--mirrors', os.path.join(settings.TEST_IMPACT_DIR, 'repos'),
+                '--max-age', str(settings.TEST_IMPACT_MAX_AGE)]
+    return cmd
+
+
+# *****************************************************************************
+#               LOG ARCHIVE
+# *****************************************************************************
+# Logs older than LOG_ARCHIVE_AFTER days leave the database for a per-build
+# archive: <buildid>.gz, a gzip member per chunk of LOG_ARCHIVE_CHUNK_LINES
+# lines, and <buildid>.json, {logid: [[firstLine, lastLine, offset, size]]}.
+import gzip
+
+import sqlalchemy as sa
+from buildbot.util import service
+from twisted.application import strports
+from twisted.internet import task, threads
+from twisted.python import log
+from twisted.web import resource, server
+
+
+def sqlSelect(*columns):
+    """ SELECT of columns, with the list argument of SQLAlchemy < 1.4 (the
+    one of buildbot 2) or the positional ones of SQLAlchemy 1.4 and 2 """
+    if tuple(int(v) for v in sa.__version__.split('.')[:2]) < (1, 4):
+        return sa.select(list(columns))
+    return sa.select(*columns)
+
+
+def archivePaths(archiveDir, buildid):
+    base = os.path.join(archiveDir, str(buildid))
+    return base + '.gz', base + '.json'
+
+
+def readArchiveIndex(indexPath):
+    if not os.path.exists(indexPath):
+        return {}
+    with open(indexPath) as f:
+        return json.load(f)
+
+
+def appendArchiveChunks(archiveDir, buildid, logid, chunks):
+    """ Append the chunks [(firstLine, lastLine, content)] of a log to the
+    archive of its build """
+    dataPath, indexPath = archivePaths(archiveDir, buildid)
+    if not os.path.isdir(archiveDir):
+        os.makedirs(archiveDir)
+    index = readArchiveIndex(indexPath)
+    entries = []
+    with open(dataPath, 'ab') as f:
+        for first, last, content in chunks:
+            data = gzip.compress(content.encode('utf-8'))
+            entries.append([first, last, f.tell(), len(data)])
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    index[str(logid)] = entries
+    with open(indexPath + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(indexPath + '.tmp', indexPath)
+
+
+def readArchivedLines(archiveDir, buildid, logid, firstLine, lastLine):
+    """ Lines firstLine..lastLine of an archived log (as getLogLines gives
+    them), None if the log is not in the archive """
+    dataPath, indexPath = archivePaths(archiveDir, buildid)
+    entries = readArchiveIndex(indexPath).get(str(logid))
+    if entries is None or not os.path.exists(dataPath):
+        return None
+    lines = []
+    with open(dataPath, 'rb') as f:
+        for first, last, offset, size in entries:
+            if last < firstLine or first > lastLine:
+                continue
+            f.seek(offset)
+            chunkLines = gzip.decompress(f.read(size)).decode('utf-8').splitlines(True)
+            lines += chunkLines[max(0, firstLine - first):lastLine - first + 1]
+    return ''.join(lines)
+
+
+def pruneArchive(archiveDir, budget):
+    """ Remove the archives of the oldest builds until they take less than
+    budget bytes. Returns the logids removed. """
+    if not os.path.isdir(archiveDir):
+        return []
+    builds = sorted(int(name[:-len('.gz')]) for name in os.listdir(archiveDir)
+                    if name.endswith('.gz') and name[:-len('.gz')].isdigit())
+    sizes = {buildid: os.path.getsize(archivePaths(archiveDir, buildid)[0])
+             for buildid in builds}
+    total = sum(sizes.values())
+    removed = []
+    for buildid in builds:
+        if total <= budget:
+            break
+        dataPath, indexPath = archivePaths(archiveDir, buildid)
+        removed += [int(logid) for logid in readArchiveIndex(indexPath)]
+        for path in [indexPath, dataPath]:
+            if os.path.exists(path):
+                os.remove(path)
+        total -= sizes[buildid]
+    return removed
+
+
+class ArchivedLogResource(resource.Resource):
+    """ /<logid>: text of an archived log (404 if it is not in the archive) """
+
+    isLeaf = True
+
+    def __init__(self, archiver):
+        resource.Resource.__init__(self)
+        self.archiver = archiver
+
+    def render_GET(self, request):
+        path = request.postpath[0] if request.postpath else b''
+        if not path.isdigit():
+            request.setResponseCode(404)
+            return b'Unknown log\n'
+        d = self.archiver.getArchivedLog(int(path))
+
+        def send(text):
+            if text is None:
+                request.setResponseCode(404)
+                text = 'Log %s is not in the archive\n' % int(path)
+            request.setHeader(b'content-type', b'text/plain; charset=utf-8')
+            request.write(text.encode('utf-8'))
+            request.finish()
+
+        def failed(failure):
+            log.err(failure, 'LogArchiver: serving log %s' % path)
+            request.setResponseCode(500)
+            request.finish()
+
+        d.addCallbacks(send, failed)
+        return server.NOT_DONE_YET
+
+
+class LogArchiver(service.BuildbotService):
+    """ Every interval seconds, move the logs of the steps started more than
+    `after` days ago from the database to the log archive, and remove the
+    oldest archives beyond budget GB (their logs are marked as deleted).
+    The archived logs are served at url (<url><logid>) by a web server on
+    port, and each archived log gets a link to it in its step. """
+
+    name = 'LogArchiver'
+
+    def checkConfig(self, archiveDir, after=2, budget=50, interval=3600,
+                    chunkLines=10000, batch=200, port=None, url=None, **kwargs):
+        if after <= 0 or budget <= 0 or chunkLines <= 0:
+            config.error('LogArchiver: after, budget and chunkLines must be positive')
+        if port and not url:
+            config.error('LogArchiver: the url of port is needed to link the archived logs')
+
+    def reconfigService(self, archiveDir, after=2, budget=50, interval=3600,
+                        chunkLines=10000, batch=200, port=None, url=None, **kwargs):
+        self.archiveDir = archiveDir
+        self.url = url
+        if port and getattr(self, 'site', None) is None:
+            # a new port needs a master restart
+            self.site = server.Site(ArchivedLogResource(self))
+            strports.service('tcp:%d' % port, self.site).setServiceParent(self)
+        self.after = after
+        self.budget = budget * 1024 ** 3
+        self.chunkLines = chunkLines
+        self.batch = batch
+        self.interval = interval
+        if getattr(self, 'loop', None) is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = task.LoopingCall(self.archive)
+        if self.running:
+            self.loop.start(interval, now=False)
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        if not self.loop.running:
+            self.loop.start(self.interval, now=False)
+
+    def stopService(self):
+        if self.loop.running:
+            self.loop.stop()
+        return service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def getArchivedLog(self, logid):
+        """ Text of an archived log, None if it is not in the archive """
+        logDict = yield self.master.data.get(('logs', logid))
+        if not logDict or not logDict['num_lines']:
+            defer.returnValue(None)
+        step = yield self.master.data.get(('steps', logDict['stepid']))
+        text = yield threads.deferToThread(readArchivedLines, self.archiveDir,
+                                           step['buildid'], logid,
+                                           0, logDict['num_lines'] - 1)
+        defer.returnValue(text)
+
+    def getLogsToArchive(self):
+        """ [(logid, num_lines, buildid, stepid, name)] of (up to batch) logs
+        still in the database whose steps started before the archive threshold """
+        threshold = int(time.time() - self.after * 24 * 3600)
+        db = self.master.db
+
+        def thd(conn):
+            model = db.model
+            chunks = sqlSelect(model.logchunks.c.logid).distinct()
+            q = (sqlSelect(model.logs.c.id, model.logs.c.num_lines, model.steps.c.buildid,
+                           model.logs.c.stepid, model.logs.c.name)
+                 .select_from(model.logs.join(model.steps,
+                                              model.logs.c.stepid == model.steps.c.id))
+                 .where(model.steps.c.started_at < threshold)
+                 .where(model.steps.c.complete_at.isnot(None))
+                 .where(model.logs.c.type != 'd')
+                 .where(model.logs.c.id.in_(chunks))
+                 .order_by(model.logs.c.id)
+                 .limit(self.batch))
+            return [tuple(row) for row in conn.execute(q).fetchall()]
+        return db.pool.do(thd)
+
+    def deleteLogChunks(self, logids, markDeleted=False):
+        db = self.master.db
+
+        def thd(conn):
+            model = db.model
+            for i in range(0, len(logids), 500):
+                ids = logids[i:i + 500]
+                conn.execute(model.logchunks.delete().where(model.logchunks.c.logid.in_(ids)))
+                if markDeleted:
+                    conn.execute(model.logs.update().where(model.logs.c.id.in_(ids))
+                                 .values(type='d'))
+        return db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def archiveLog(self, logid, numLines, buildid):
+        chunks = []
+        for first in range(0, numLines, self.chunkLines):
+            last = min(first + self.chunkLines, numLines) - 1
+            content = yield self.master.db.logs.getLogLines(logid, first, last)
+            chunks.append((first, last, content))
+        yield threads.deferToThread(appendArchiveChunks, self.archiveDir, buildid,
+                                    logid, chunks)
+
+    @defer.inlineCallbacks
+    def archive(self):
+        try:
+            logs = yield self.getLogsToArchive()
+            archived = []
+            for logid, numLines, buildid, stepid, logName in logs:
+                yield self.archiveLog(logid, numLines, buildid)
+                archived.append(logid)
+                if self.url:
+                    yield self.master.data.updates.addStepURL(
+                        stepid, '%s (archived)' % logName, '%s%d' % (self.url, logid))
+            if archived:
+                yield self.deleteLogChunks(archived)
+            removed = yield threads.deferToThread(pruneArchive, self.archiveDir, self.budget)
+            if removed:
+                yield self.deleteLogChunks(removed, markDeleted=True)
+            if archived or removed:
+                log.msg('LogArchiver: %d logs archived, %d removed from the archive'
+                        % (len(archived), len(removed)))
+        except Exception:
+            log.err(None, 'LogArchiver failed')
+
+
+# *****************************************************************************
+#               DATABASE JANITOR
+# *****************************************************************************
+class DbJanitor(service.BuildbotService):
+    """ Once a day, at hour, vacuum the database (sqlite or postgresql) so that
+    the space freed by the buildbot janitor and the LogArchiver is reused. """
+
+    name = 'DbJanitor'
+
+    def checkConfig(self, hour=3, **kwargs):
+        if not 0 <= hour < 24:
+            config.error('DbJanitor: hour must be in 0..23')
+
+    def reconfigService(self, hour=3, **kwargs):
+        self.hour = hour
+        if getattr(self, 'loop', None) is None:
+            self.lastRun = None
+            self.loop = task.LoopingCall(self.checkHour)
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        if not self.loop.running:
+            self.loop.start(600, now=False)
+
+    def stopService(self):
+        if self.loop.running:
+            self.loop.stop()
+        return service.BuildbotService.stopService(self)
+
+    def checkHour(self):
+        now = time.localtime()
+        if now.tm_hour == self.hour and self.lastRun != now.tm_yday:
+            self.lastRun = now.tm_yday
+            return self.clean()
+
+    def vacuum(self):
+        db = self.master.db
+
+        def thd(conn):
+            dialect = conn.engine.dialect.name
+            if dialect == 'sqlite':
+                conn.execute(sa.text('VACUUM'))
+            elif dialect == 'postgresql':
+                conn.execution_options(isolation_level='AUTOCOMMIT').execute(
+                    sa.text('VACUUM ANALYZE'))
+            else:
+                return None
+            return dialect
+        return db.pool.do(thd)
+
+    @defer.inlineCallbacks
+    def clean(self):
+        try:
+            start = time.time()
+            dialect = yield self.vacuum()
+            log.msg('DbJanitor: %s in %ds'
+                    % ('vacuumed' if dialect else 'not vacuumed', time.time() - start))
+        except Exception:
+            log.err(None, 'DbJanitor failed')
+
+
+# *****************************************************************************
+#               PLUGIN REGISTRY
+# *****************************************************************************
+# master.cfg reads the plugins json files again on every reconfig. The builder
+# and scheduler configs of the plugins whose entry didn't change are re-used:
+# their factories are not built again and buildbot leaves their schedulers
+# running (a ForceScheduler built again never compares equal to the running
+# one, so it would be stopped and started again).
+from collections import OrderedDict
+from types import MappingProxyType
+
+
+class PluginRegistry(object):
+    """ Immutable content of the plugins json files, {key: path}. Each entry
+    is kept as its json text and parsed again when asked for, so callers get
+    copies they are free to change. """
+
+    def __init__(self, paths):
+        files = {}
+        for key, path in paths.items():
+            with open(path) as f:
+                # in order, it takes into account the dependencies in between plugins
+                data = json.load(f, object_pairs_hook=OrderedDict)
+            files[key] = tuple((name, json.dumps(entry, sort_keys=True))
+                               for name, entry in data.items())
+        self._files = MappingProxyType(files)
+        self._texts = MappingProxyType({(key, name): text
+                                        for key, entries in files.items()
+                                        for name, text in entries})
+        self.hash = hashlib.sha1(json.dumps(sorted(self._texts.items())).encode()).hexdigest()[:12]
+
+    def names(self, key):
+        return [name for name, _ in self._files[key]]
+
+    def entry(self, key, name):
+        return json.loads(self._texts[(key, name)], object_pairs_hook=OrderedDict)
+
+    def entryHash(self, key, name):
+        return hashlib.sha1(self._texts[(key, name)].encode()).hexdigest()[:12]
+
+    def plugins(self, key, exclude=()):
+        return OrderedDict((name, self.entry(key, name))
+                           for name in self.names(key) if name not in exclude)
+
+    def diff(self, other):
+        """ (added, removed, changed) (key, name) entries since other """
+        old = other._texts if other is not None else {}
+        added = set(self._texts) - set(old)
+        removed = set(old) - set(self._texts)
+        changed = {k for k in set(self._texts) & set(old) if self._texts[k] != old[k]}
+        return added, removed, changed
+
+
+class ConfigCache(object):
+    """ Configs (builders, schedulers) kept from one reconfig to the next,
+    by key, while their version is the same """
+
+    def __init__(self):
+        self.entries = {}
+        self.begin()
+
+    def begin(self):
+        self.used = set()
+        self.built = 0
+        self.reused = 0
+
+    def get(self, key, version, build):
+        self.used.add(key)
+        cached = self.entries.get(key)
+        if cached is not None and cached[0] == version:
+            self.reused += 1
+            return cached[1]
+        self.built += 1
+        value = build()
+        self.entries[key] = (version, value)
+        return value
+
+    def end(self):
+        """ Forget the configs not asked for in this reconfig """
+        for key in set(self.entries) - self.used:
+            del self.entries[key]
+
+
+configCache = ConfigCache()
+
+
+class ReconfigTimer(service.BuildbotService):
+    """ Logs how long it took from the start of master.cfg (start) until
+    buildbot finished applying the new config """
+
+    name = 'ReconfigTimer'
+
+    def reconfigService(self, start=None, summary='', **kwargs):
+        self.start = start
+        self.summary = summary
+        self.logWhenDone()
+        return defer.succeed(None)
+
+    def logWhenDone(self):
+        if self.master.reconfig_active:
+            self.master.reactor.callLater(0.1, self.logWhenDone)
+            return
+        log.msg('Config applied in %0.2f secs: %s' % (time.time() - self.start, self.summary))
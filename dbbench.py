@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+""" Replay the database writes of a recorded nightly against several backends.
+
+'record' reads from the master database the builds of an orchestrator run
+(the build and all the builds it triggered, recursively) and saves when
+their steps started and finished and the log chunks they wrote (spread over
+the step duration, the database doesn't keep their time). 'replay' creates
+the buildbot tables in each target database and repeats those writes, as
+fast as --speed allows, from --threads threads like the master db pool (one
+for sqlite, as the master), and
+prints the latency of each kind of write. Use scratch databases as targets.
+
+Usage (with the python of the master):
+    dbbench.py record --db sqlite:///state.sqlite --build 1234 --out nightly.json
+    dbbench.py replay --trace nightly.json --speed 600 \\
+        --db sqlite:////tmp/bench.sqlite --db postgresql://bb:bb@localhost/bench
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as sa
+from buildbot.db.model import Model
+
+STEP_START = 'stepStart'
+LOG_CHUNK = 'logChunk'
+STEP_FINISH = 'stepFinish'
+
+
+def select(*columns):
+    """ SELECT of columns for SQLAlchemy < 1.4 (a list) and >= 1.4 (positional) """
+    if tuple(int(v) for v in sa.__version__.split('.')[:2]) < (1, 4):
+        return sa.select(list(columns))
+    return sa.select(*columns)
+
+
+# *****************************************************************************
+#               RECORD
+# *****************************************************************************
+def childBuilds(conn, buildIds):
+    m = Model
+    q = (select(m.builds.c.id)
+         .select_from(m.builds
+                      .join(m.buildrequests, m.builds.c.buildrequestid == m.buildrequests.c.id)
+                      .join(m.buildsets, m.buildrequests.c.buildsetid == m.buildsets.c.id))
+         .where(m.buildsets.c.parent_buildid.in_(buildIds)))
+    return [row[0] for row in conn.execute(q)]
+
+
+def record(args):
+    engine = sa.create_engine(args.db)
+    m = Model
+    events = []
+    with engine.connect() as conn:
+        builds, frontier = [], [args.build]
+        while frontier:
+            builds += frontier
+            frontier = childBuilds(conn, frontier)
+        steps = conn.execute(select(m.steps.c.id, m.steps.c.buildid,
+                                    m.steps.c.started_at, m.steps.c.complete_at)
+                             .where(m.steps.c.buildid.in_(builds))
+                             .where(m.steps.c.started_at.isnot(None))).fetchall()
+        start = min([step[2] for step in steps] or [0])
+        for stepId, buildId, startedAt, completeAt in steps:
+            completeAt = completeAt or startedAt
+            events.append([startedAt - start, STEP_START, stepId, buildId])
+            chunks = conn.execute(
+                select(m.logchunks.c.last_line - m.logchunks.c.first_line + 1,
+                       sa.func.length(m.logchunks.c.content))
+                .select_from(m.logchunks.join(m.logs, m.logchunks.c.logid == m.logs.c.id))
+                .where(m.logs.c.stepid == stepId)
+                .order_by(m.logchunks.c.logid, m.logchunks.c.first_line)).fetchall()
+            for i, (lines, size) in enumerate(chunks):
+                t = startedAt + (completeAt - startedAt) * (i + 1) / (len(chunks) + 1)
+                events.append([t - start, LOG_CHUNK, stepId, lines, size])
+            events.append([completeAt - start, STEP_FINISH, stepId])
+    events.sort(key=lambda e: e[0])
+    with open(args.out, 'w') as f:
+        json.dump({'build': args.build, 'builds': sorted(set(builds)), 'events': events}, f)
+    print('Recorded %d events of %d builds (%d steps) in %s'
+          % (len(events), len(set(builds)), len(steps), args.out))
+    return 0
+
+
+# *****************************************************************************
+#               REPLAY
+# *****************************************************************************
+class Replayer(object):
+    """ Repeat the writes of a trace in a database """
+
+    def __init__(self, url, threads):
+        self.url = url
+        kwargs = {}
+        if url.startswith('sqlite'):
+            # as the master: a single connection, sqlite serialises the writes anyway
+            kwargs['connect_args'] = {'timeout': 60, 'check_same_thread': False}
+            threads = 1
+        else:
+            kwargs['pool_size'] = threads
+        self.engine = sa.create_engine(url, **kwargs)
+        self.threads = threads
+        self.latencies = {STEP_START: [], LOG_CHUNK: [], STEP_FINISH: []}
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def createTables(self, builds):
+        m = Model
+        m.metadata.drop_all(self.engine)
+        m.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(m.masters.insert().values(id=1, name='bench', name_hash='bench',
+                                                   active=1, last_active=0))
+            conn.execute(m.builders.insert().values(id=1, name='bench', name_hash='bench'))
+            conn.execute(m.workers.insert().values(id=1, name='bench', info={}))
+            for i, buildId in enumerate(builds):
+                conn.execute(m.buildsets.insert().values(
+                    id=i + 1, submitted_at=0, complete=0, reason='bench', results=-1,
+                    external_idstring=''))
+                conn.execute(m.buildrequests.insert().values(
+                    id=i + 1, buildsetid=i + 1, builderid=1, priority=0, complete=0,
+                    results=-1, submitted_at=0, waited_for=0))
+                conn.execute(m.builds.insert().values(
+                    id=buildId, number=i + 1, builderid=1, buildrequestid=i + 1, workerid=1,
+                    masterid=1, started_at=0, state_string='bench'))
+
+    def write(self, event):
+        m = Model
+        kind, stepId = event[1], event[2]
+        with self.engine.begin() as conn:
+            if kind == STEP_START:
+                conn.execute(m.steps.insert().values(
+                    id=stepId, number=stepId, name='step%d' % stepId, buildid=event[3],
+                    started_at=int(time.time()), state_string='running', urls_json='[]',
+                    hidden=0))
+                conn.execute(m.logs.insert().values(
+                    id=stepId, name='stdio', slug='stdio', stepid=stepId, complete=0,
+                    num_lines=0, type='s'))
+            elif kind == LOG_CHUNK:
+                lines, size = event[3], event[4]
+                numLines = conn.execute(select(m.logs.c.num_lines)
+                                        .where(m.logs.c.id == stepId)).fetchone()[0]
+                conn.execute(m.logchunks.insert().values(
+                    logid=stepId, first_line=numLines, last_line=numLines + lines - 1,
+                    content=os.urandom(size), compressed=1))
+                conn.execute(m.logs.update().where(m.logs.c.id == stepId)
+                             .values(num_lines=numLines + lines))
+            else:
+                conn.execute(m.logs.update().where(m.logs.c.id == stepId)
+                             .values(complete=1))
+                conn.execute(m.steps.update().where(m.steps.c.id == stepId)
+                             .values(complete_at=int(time.time()), results=0,
+                                     state_string='done'))
+
+    def runEvent(self, event, previous):
+        if previous is not None:
+            # the writes of a step are done in order, as in the master
+            previous.result()
+        start = time.time()
+        try:
+            self.write(event)
+        except Exception as e:
+            with self.lock:
+                self.errors.append('%s: %s' % (event[1], e))
+            return
+        with self.lock:
+            self.latencies[event[1]].append(time.time() - start)
+
+    def replay(self, trace, speed):
+        self.createTables(trace['builds'])
+        lastFuture = {}
+        start = time.time()
+        with ThreadPoolExecutor(self.threads) as pool:
+            for event in trace['events']:
+                delay = event[0] / speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                lastFuture[event[2]] = pool.submit(self.runEvent, event,
+                                                   lastFuture.get(event[2]))
+        return time.time() - start
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def replay(args):
+    with open(args.trace) as f:
+        trace = json.load(f)
+    print('%d events of %d builds, at %sx' % (len(trace['events']), len(trace['builds']),
+                                             args.speed))
+    print('%-40s %-10s %8s %8s %8s %8s %8s' % ('database', 'write', 'count',
+                                               'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for url in args.db:
+        replayer = Replayer(url, args.threads)
+        wall = replayer.replay(trace, args.speed)
+        name = url.split('@')[-1][:40]
+        for kind, values in replayer.latencies.items():
+            print('%-40s %-10s %8d %8.1f %8.1f %8.1f %8.1f'
+                  % (name, kind, len(values), percentile(values, 50) * 1000,
+                     percentile(values, 95) * 1000, percentile(values, 99) * 1000,
+                     max(values or [0]) * 1000))
+        print('%-40s %d errors, %.1f s' % (name, len(replayer.errors), wall))
+        for error in replayer.errors[:5]:
+            print('    %s' % error)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    recordParser = subparsers.add_parser('record')
+    recordParser.add_argument('--db', required=True, help='database of the master')
+    recordParser.add_argument('--build', type=int, required=True,
+                              help='id of the orchestrator build')
+    recordParser.add_argument('--out', required=True)
+    replayParser = subparsers.add_parser('replay')
+    replayParser.add_argument('--db', action='append', required=True,
+                              help='target database (its buildbot tables are dropped)')
+    replayParser.add_argument('--trace', required=True)
+    replayParser.add_argument('--speed', type=float, default=600,
+                              help='times faster than the recorded run')
+    replayParser.add_argument('--threads', type=int, default=5,
+                              help='writers, like the db pool of the master')
+    args = parser.parse_args()
+    if args.action == 'record':
+        return record(args)
+    if args.action == 'replay':
+        return replay(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
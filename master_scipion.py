@@ -8,433 +8,199 @@ from buildbot.steps.source.git import Git
 from buildbot.config import BuilderConfig
 from buildbot.schedulers import triggerable
 from buildbot.schedulers.forcesched import ForceScheduler
+from buildbot.schedulers.basic import SingleBranchScheduler
+from buildbot.changes.gitpoller import GitPoller
 
 import settings
-from common_utils import changeConfVar, GenerateStagesCommand
+from common_utils import (GenerateStagesCommand, nextWorker, canStartBuild,
+                          RunShardStages, ScipionConfigStep, CheckPluginInstall,
+                          isPluginInstallNeeded, isPluginInstallToRecord,
+                          recordPluginInstallCmd, downloadWorkerScript,
+                          cachedInstallbCmd, condaEnvCmd, SetGroupProperties,
+                          splitSourceUrl, normalizeRepoUrl, isLocalRepo,
+                          discoveredTestsIfUnchanged, PluginRegistry, configCache,
+                          DiskJanitor, WorkerLoadProbe, PluginInstalled, installLock)
 
 # #############################################################################
 # ########################## COMMANDS & UTILS #################################
 # #############################################################################
 
-with open(settings.PLUGINS_JSON_FILE) as f:
-    # read in order, since we have taken into account dependencies in
-    # between plugins when completing the json file
-    scipionPlugins = json.load(f, object_pairs_hook=OrderedDict)
-    xmippPluginData = scipionPlugins.pop('scipion-em-xmipp')
-    locscalePluginData = scipionPlugins.pop("scipion-em-locscale")
-
-
-with open(settings.SDEVELPLUGINS_JSON_FILE) as f:
-    # read in order, since we have taken into account dependencies in
-    # between plugins when completing the json file
-    scipionSdevelPlugins = json.load(f, object_pairs_hook=OrderedDict)
-    # xmippSdevelPluginData = scipionSdevelPlugins.pop('scipion-em-xmipp')
-    locscaleSdevelPluginData = scipionSdevelPlugins.pop("scipion-em-locscale")
-    emSdevelPackageData = scipionSdevelPlugins.pop("scipion-em")
-    pyworkflowSdevelPackageData = scipionSdevelPlugins.pop("scipion-pyworkflow")
-    appSdevelPackageData = scipionSdevelPlugins.pop("scipion-app")
-
-# Remove config/scipion.conf
-removeScipionConf = ShellCommand(
-    command=['rm', '-f', 'config/scipion.conf'],
-    name='Clean Scipion Config',
-    description='Delete existing conf file at scipion HOME',
-    descriptionDone='Remove config/scipion.conf',
-    haltOnFailure=False)
+# Keys of the plugins json files in the registry
+PROD_PLUGINS = 'prod'
+SDEVEL_PLUGINS = 'sdevel'
 
-removeScipionDevelConf = ShellCommand(
-    command=['rm', '-f', 'config/scipion_devel.conf'],
-    name='Clean Scipion Config',
-    description='Delete existing conf file at scipion HOME',
-    descriptionDone='Remove config/scipion.conf',
-    haltOnFailure=False)
+# Entries of the json files that don't get a builder from the plugins loop:
+# xmipp is built in master_xmipp, locscale apart (eman) and the scipion
+# packages are installed with scipion.
+SEPARATE_PLUGINS = {
+    PROD_PLUGINS: ['scipion-em-xmipp', 'scipion-em-locscale'],
+    SDEVEL_PLUGINS: ['scipion-em-xmipp', 'scipion-em-locscale', 'scipion-em',
+                     'scipion-pyworkflow', 'scipion-app']}
 
+pluginRegistry = None
+
+
+def loadPluginRegistry():
+    """ Read the plugins json files (again). Returns the registry and the
+    (added, removed, changed) entries since the previous one """
+    global pluginRegistry
+    registry = PluginRegistry({PROD_PLUGINS: settings.PLUGINS_JSON_FILE,
+                               SDEVEL_PLUGINS: settings.SDEVELPLUGINS_JSON_FILE})
+    previous = pluginRegistry
+    if previous is not None and previous.hash == registry.hash:
+        return previous, (set(), set(), set())
+    pluginRegistry = registry
+    return registry, registry.diff(previous)
+
+
+def getPluginRegistry():
+    return pluginRegistry
+
+
+def pluginsKey(groupId):
+    return PROD_PLUGINS if groupId == settings.PROD_GROUP_ID else SDEVEL_PLUGINS
 
-removeScipionProdConf = ShellCommand(
-    command=['rm', '-f', 'config/scipion_prod.conf'],
-    name='Clean Scipion Config',
-    description='Delete existing conf file at scipion HOME',
-    descriptionDone='Remove config/scipion.conf',
-    haltOnFailure=False)
 
-# Remove HOME/.config/scipion/scipion.conf
-removeHomeConfig = ShellCommand(command=['bash', '-c',
-                                         util.Interpolate("rm %(prop:SCIPION_LOCAL_CONFIG)s")],
-                                name='Clean Scipion Config at USERS HOME',
-                                description='Delete existing conf file at users HOME',
-                                descriptionDone='Remove USER HOME scipion.conf',
-                                haltOnFailure=False)
-
-# Regenerate the scipion.config files
-configScipion = ShellCommand(
-    command=['./scipion', 'config', '--notify', '--overwrite'],
-    name='Scipion Config',
-    description='Create installation configuration files',
-    descriptionDone='Scipion config',
-    haltOnFailure=True)
-
-# Avoid notifications from BuildBot
-setNotifyAtFalse = ShellCommand(
-    command=['bash', '-c', util.Interpolate('sed -i -e '
-                                            '"s/MPI_LIBDIR = True/'
-                                            'SCIPION_NOTIFY = False/g" %(prop:SCIPION_LOCAL_CONFIG)s')],
-    name='Cancel notifications',
-    description='Do not notify usage. Server will be out of '
-                'the blacklist in order for the notify test to work',
-    descriptionDone='Disable notification',
-    haltOnFailure=True)
-
-setGeneralCuda = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCUDA = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CUDA)),
-    name='Set CUDA in scipion conf',
-    description='Set CUDA in scipion conf',
-    descriptionDone='Set CUDA in scipion conf',
-    haltOnFailure=True)
-
-setMpiLibPath = ShellCommand(
-    # command=changeConfVar.withArgs('MPI_LIBDIR', mpilibdir),
-    command=changeConfVar("MPI_LIBDIR", settings.MPI_LIBDIR, escapeSlash=True),
-    name='Change MPI_LIBDIR',
-    description='Add the right MPI_LIBDIR path',
-    descriptionDone='Added MPI_LIBDIR',
-    haltOnFailure=True)
-
-setMpiIncludePath = ShellCommand(
-    command=changeConfVar('MPI_INCLUDE', settings.MPI_INCLUDE, escapeSlash=True),
-    name='Change MPI_INCLUDE',
-    description='Add the right MPI_INCLUDE path',
-    descriptionDone='Added MPI_INCLUDE',
-    haltOnFailure=True)
-
-setMpiBinPath = ShellCommand(
-    command=changeConfVar('MPI_BINDIR', settings.MPI_BINDIR, escapeSlash=True),
-    name='Change MPI_BINDIR',
-    description='Add the right MPI_BINDIR path',
-    descriptionDone='Added MPI_BINDIR',
-    haltOnFailure=True)
-
-# Use a common home data tests folder to save storage
-setDataTestsDir = ShellCommand(
-    command=['sed', '-i', '-e',
-             's/SCIPION_TESTS = data\/tests/'
-             'SCIPION_TESTS = ~\/data\/tests/g',
-             'config/scipion.conf'],
-    name='Set data tests dir',
-    description='Using a common data tests dir',
-    descriptionDone='Change data tests dir',
-    haltOnFailure=True)
+def groupPlugins(groupId):
+    """ Plugins of the group with a builder of the plugins loop """
+    key = pluginsKey(groupId)
+    return pluginRegistry.plugins(key, exclude=SEPARATE_PLUGINS[key])
+
+
+def installedPlugins(groupId):
+    """ Plugins of the group and locscale, the plugins.json of the group """
+    plugins = groupPlugins(groupId)
+    plugins["scipion-em-locscale"] = pluginRegistry.entry(pluginsKey(groupId),
+                                                          "scipion-em-locscale")
+    return plugins
+
+
+def orchestratorPlugins(groupId):
+    """ Plugins triggered by the orchestrator of the group, in order: those
+    of the sdevel json file include xmipp (its builder is in master_xmipp) """
+    key = pluginsKey(groupId)
+    exclude = [name for name in SEPARATE_PLUGINS[key]
+               if key == PROD_PLUGINS or name != 'scipion-em-xmipp']
+    plugins = pluginRegistry.plugins(key, exclude=exclude)
+    plugins["scipion-em-locscale"] = pluginRegistry.entry(key, "scipion-em-locscale")
+    return plugins
+
+
+def cachedPluginConfig(kind, groupId, plugin, build, key=None):
+    """ build() config of the plugin, or the one of the previous reconfig
+    if the entry of the plugin didn't change since """
+    version = pluginRegistry.entryHash(key or pluginsKey(groupId), plugin)
+    return configCache.get((kind, groupId, plugin), version, build)
+
+
+loadPluginRegistry()
 
 
 # Use an internal dir to allow a branch-dependent project inspection
 @util.renderer
-def renderScipionUserDataCmd(props):
-    command = ['bash', '-c']
+def renderScipionUserData(props):
     userDataHome = props.getProperty('BUILD_GROUP_HOME')
-    userConfig = props.getProperty('SCIPION_LOCAL_CONFIG')
     if userDataHome:
-        command.append('sed -i -e '
-                       '"s/SCIPION_USER_DATA = ~\/ScipionUserData/'
-                       'SCIPION_USER_DATA = %s\/ScipionUserData/g" '
-                       '%s' % (userDataHome.replace('/', '\/'), userConfig))
-    return command
-
-setScipionUserData = ShellCommand(
-    command=renderScipionUserDataCmd,
-    name='Set ScipionUserData dir',
-    description='Using an independent ScipionUserData dir.',
-    descriptionDone='Change ScipionUserData dir',
-    haltOnFailure=True)
-
-setMotioncorrCudaSupport = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aMOTIONCOR2_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.MOTIONCOR2_CUDA_LIB_SUPPORT)),
-    name='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    description='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    descriptionDone='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    haltOnFailure=True)
-
-setEman2Home = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aEMAN2_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.EMAN2_HOME)),
-    name='Set EMAN2_HOME in scipion conf',
-    description='Set EMAN2_HOME in scipion conf',
-    descriptionDone='Set EMAN2_HOME in scipion conf',
-    haltOnFailure=True)
-
-setMotioncorrCuda = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aMOTIONCOR2_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.MOTIONCOR2_CUDA_LIB)),
-    name='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    description='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    descriptionDone='Set MOTIONCOR2_CUDA_LIB in scipion conf',
-    haltOnFailure=True)
-
-setCcp4Home = ShellCommand(
-    command=util.Interpolate('sed -ie "\$aCCP4_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CCP4_HOME)),
-    name='Set CCP4_HOME in scipion conf',
-    description='Set CCP4_HOME in scipion conf',
-    descriptionDone='Set CCP4_HOME in scipion conf',
-    haltOnFailure=True)
-
-setEM_ROOTSdevel = ShellCommand(
-    command=changeConfVar('EM_ROOT', settings.EM_ROOT,
-                          file=settings.SDEVEL_SCIPION_CONFIG_PATH,
-                          escapeSlash=True),
-    name='Change EM_ROOT',
-    description='Add the right EM_ROOT path',
-    descriptionDone='Added EM_ROOT',
-    haltOnFailure=True)
-
-setNYSBC_3DFSC_HOME = ShellCommand(
-    command=util.Interpolate('sed -ie "\$aNYSBC_3DFSC_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.NYSBC_3DFSC_HOME)),
-    name='Set NYSBC_3DFSC_HOME in scipion conf',
-    description='Set NYSBC_3DFSC_HOME in scipion conf',
-    descriptionDone='Set NYSBC_3DFSC_HOME in scipion conf',
-    haltOnFailure=True)
-
-setEnvActivationCMD = ShellCommand(
-    command=util.Interpolate('sed -ie "\$aCONDA_ACTIVATION_CMD = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CONDA_ACTIVATION_CMD)),
-    name='Set CONDA_ACTIVATION_CMD in scipion conf',
-    description='Set CONDA_ACTIVATION_CMD in scipion conf',
-    descriptionDone='Set CONDA_ACTIVATION_CMD in scipion conf',
-    haltOnFailure=True)
-
-setEnvActivationCMD_DEVEL = ShellCommand(
-    command=util.Interpolate('sed -ie "\$aCONDA_ACTIVATION_CMD = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CONDA_ACTIVATION_CMD_DEVEL)),
-    name='Set CONDA_ACTIVATION_CMD in scipion conf',
-    description='Set CONDA_ACTIVATION_CMD in scipion conf',
-    descriptionDone='Set CONDA_ACTIVATION_CMD in scipion conf',
-    haltOnFailure=True)
-
-
-setCryoloCuda = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCRYOLO_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CRYOLO_CUDA_LIB)),
-    name='Add CRYOLO_CUDA_LIB in scipion conf',
-    description='Add CRYOLO_CUDA_LIB in scipion conf',
-    descriptionDone='Add CRYOLO_CUDA_LIB in scipion conf',
-    haltOnFailure=True)
-
-setChimeraHome = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCHIMERA_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CHIMERA_HOME)),
-    name='Set CHIMERA_HOME in scipion conf',
-    description='Set CHIMERA_HOME in scipion conf',
-    descriptionDone='Set CHIMERA_HOME in scipion conf',
-    haltOnFailure=True)
-
-setPhenixHome = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aPHENIX_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.PHENIX_HOME)),
-    name='Add PHENIX_HOME in scipion conf',
-    description='Add PHENIX_HOME in scipion conf',
-    descriptionDone='Add PHENIX_HOME in scipion conf',
-    haltOnFailure=True)
-
-setCryosparcDir = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCRYOSPARC_DIR = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CRYOSPARC_DIR)),
-    name='Set CRYOSPARC_DIR in scipion conf',
-    description='Set CRYOSPARC_DIR in scipion conf',
-    descriptionDone='Set CRYOSPARC_DIR in scipion conf',
-    haltOnFailure=True)
-
-setCryosparcHome = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCRYOSPARC_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CRYOSPARC_DIR)),
-    name='Set CRYOSPARC_HOME in scipion conf',
-    description='Set CRYOSPARC_HOME in scipion conf',
-    descriptionDone='Set CRYOSPARC_HOME in scipion conf',
-    haltOnFailure=True)
-
-setCodeSpeedUrl = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCODESPEED_URL = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CODESPEED_URL)),
-    name='Add CODESPEED_URL in scipion conf',
-    description='Add CODESPEED_URL in scipion conf',
-    descriptionDone='Add CODESPEED_URL in scipion conf',
-    haltOnFailure=True)
-
-
-setCodeSpeedEnv = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCODESPEED_ENV = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CODESPEED_ENV)),
-    name='Add CODESPEED_ENV in scipion conf',
-    description='Add CODESPEED_ENV in scipion conf',
-    descriptionDone='Add CODESPEED_ENV in scipion conf',
-    haltOnFailure=True)
-
-
-setJjsoftHome = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aTOMO3D_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.TOMO3D_HOME)),
-    name='Add JJSOFT_HOME in scipion conf',
-    description='Add JJSOFT_HOME in scipion conf',
-    descriptionDone='Add JJSOFT_HOME in scipion conf',
-    haltOnFailure=True)
-
-setPysegHome = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aPYSEG_HOME = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.PYSEG_HOME)),
-    name='Add PYSEG_HOME in scipion conf',
-    description='Add PYSEG_HOME in scipion conf',
-    descriptionDone='Add PYSEG_HOME in scipion conf',
-    haltOnFailure=True)
-
-
-setBuildXmippTest = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aBUILD_TESTS = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.BUILD_TESTS)),
-    name='Add BUILD_TESTS in scipion conf',
-    description='Add BUILD_TESTS in scipion conf',
-    descriptionDone='Add BUILD_TESTS in scipion conf',
-    haltOnFailure=True)
-
-
-profilingProjectPath = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aPROFILING_PROJECTS_PATH = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.PROFILING_PROJECTS_PATH)),
-    name='Add PROFILING_PROJECTS_PATH in scipion conf',
-    description='Add PROFILING_PROJECTS_PATH in scipion conf',
-    descriptionDone='Add PROFILING_PROJECTS_PATH in scipion conf',
-    haltOnFailure=True)
-
-setCryosparcProjectDir = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCRYO_PROJECTS_DIR = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CRYOSPARC_DIR +'scipion_projects')),
-    name='Add CRYO_PROJECTS_DIR',
-    description='Add the right CRYO_PROJECTS_DIR path',
-    descriptionDone='Added CRYO_PROJECTS_DIR',
-    haltOnFailure=True)
-
-setCryosparcUser = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCRYOSPARC_USER = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CRYOSPARC_USER)),
-    name='Set CRYOSPARC_USER in scipion conf',
-    description='Set CRYOSPARC_USER in scipion conf',
-    descriptionDone='Set CRYOSPARC_USER in scipion conf',
-    haltOnFailure=True)
-
-setScipionScratchDir = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aSCIPION_SCRATCH = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.SCIPION_SCRATCH)),
-    name='Set SCIPION_SCRATCH in scipion conf',
-    description='Set SCIPION_SCRATCH in scipion conf',
-    descriptionDone='Set SCIPION_SCRATCH in scipion conf',
-    haltOnFailure=True)
-
-
-setMotincor2Bin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aMOTIONCOR2_BIN = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.MOTIONCOR2_BIN)),
-    name='Add the right MOTIONCOR2_BIN file',
-    description='Add the right MOTIONCOR2_BIN file',
-    descriptionDone='Add the right MOTIONCOR2_BIN file',
-    haltOnFailure=True)
-
-setMotincor2BinDevel = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aMOTIONCOR2_BIN = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.MOTIONCOR2_BIN_DEVEL)),
-    name='Add the right MOTIONCOR2_BIN file',
-    description='Add the right MOTIONCOR2_BIN file',
-    descriptionDone='Add the right MOTIONCOR2_BIN file',
-    haltOnFailure=True)
-
-setMotincor2BinSupport = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aMOTIONCOR2_BIN = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.MOTIONCOR2_BIN_SUPPORT)),
-    name='Add the right MOTIONCOR2_BIN file',
-    description='Add the right MOTIONCOR2_BIN file',
-    descriptionDone='Add the right MOTIONCOR2_BIN file',
-    haltOnFailure=True)
-
-setGctfBin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aGCTF = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.GCTF)),
-    name='Add the right GCTF Bin file',
-    description='Add the right GCTF bin file',
-    descriptionDone='Add the right GCTF bin file',
-    haltOnFailure=True)
-
-setGCTFCuda = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aGCTF_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.GCTF_CUDA_LIB)),
-    name='Add the GCTF_CUDA_LIB',
-    description='Add the GCTF_CUDA_LIB',
-    descriptionDone='Add the GCTF_CUDA_LIB',
-    haltOnFailure=True)
-
-setGautomatchBin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aGAUTOMATCH = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.GAUTOMATCH)),
-    name='Add the right GAUTOMATCH Bin file',
-    description='Add the right GAUTOMATCH bin file',
-    descriptionDone='Add the right GAUTOMATCH bin file',
-    haltOnFailure=True)
-
-setGautomatchCudaBin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aGAUTOMATCH_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.GAUTOMATCH_CUDA_LIB)),
-    name='Add the right GAUTOMATCH_CUDA_LIB Bin file',
-    description='Add the right GAUTOMATCH_CUDA_LIB bin file',
-    descriptionDone='Add the right GAUTOMATCH_CUDA_LIB bin file',
-    haltOnFailure=True)
-
-
-setRelionCudaLib = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aRELION_CUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.RELION_CUDA_LIB)),
-    name='Add the right RELION_CUDA_LIB Bin file',
-    description='Add the right RELION_CUDA_LIB bin file',
-    descriptionDone='Add the right RELION_CUDA_LIB bin file',
-    haltOnFailure=True)
-
-setRelionCudaBin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aRELION_CUDA_BIN = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.RELION_CUDA_BIN)),
-    name='Add the right RELION_CUDA_BIN Bin file',
-    description='Add the right RELION_CUDA_BIN bin file',
-    descriptionDone='Add the right RELION_CUDA_BIN bin file',
-    haltOnFailure=True)
-
-
-
-setSPIDERBin = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aSPIDER = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.SPIDER)),
-    name='Add the right SPIDER Bin file',
-    description='Add the right SPIDER bin file',
-    descriptionDone='Add the right SPIDER bin file',
-    haltOnFailure=True)
-
-setSPIDER_MPI = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aSPIDER_MPI = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.SPIDER_MPI)),
-    name='Add the right SPIDER_MPI file',
-    description='Add the right SPIDER_MPI file',
-    descriptionDone='Add the right SPIDER_MPI file',
-    haltOnFailure=True)
-
-setCUDA_LIB = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCUDA_LIB = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CUDA_LIB)),
-    name='Add the right CUDA_LIB file',
-    description='Add the right CUDA_LIB file',
-    descriptionDone='Add the right CUDA_LIB file',
-    haltOnFailure=True)
-
-setCUDA_BIN = ShellCommand(
-    command=util.Interpolate(
-        'sed -ie "\$aCUDA_BIN = {}" %(prop:SCIPION_LOCAL_CONFIG)s'.format(settings.CUDA_BIN)),
-    name='Add the right CUDA_BIN file',
-    description='Add the right CUDA_BIN file',
-    descriptionDone='Add the right CUDA_BIN file',
-    haltOnFailure=True)
-
-
-
-installEman212 = ShellCommand(command=['./scipion', 'installb', 'eman-2.12'],
+        return '%s/ScipionUserData' % userDataHome
+    return None
+
+
+# Keys set in the scipion config files by ScipionConfigStep, per group
+# (see the install factories for the files they go to)
+scipionConfigKeys = {
+    settings.PROD_GROUP_ID: OrderedDict([
+        # Avoid notifications from BuildBot
+        ('SCIPION_NOTIFY', 'False'),
+        ('CUDA', settings.CUDA),
+        ('SCIPION_USER_DATA', renderScipionUserData),
+        ('MOTIONCOR2_CUDA_LIB', settings.MOTIONCOR2_CUDA_LIB_SUPPORT),
+        ('CRYOLO_CUDA_LIB', settings.CRYOLO_CUDA_LIB),
+        ('PHENIX_HOME', settings.PHENIX_HOME),
+        ('CRYOSPARC_DIR', settings.CRYOSPARC_DIR),
+        ('CRYOSPARC_USER', settings.CRYOSPARC_USER),
+        ('MOTIONCOR2_BIN', settings.MOTIONCOR2_BIN_SUPPORT),
+        ('CCP4_HOME', settings.CCP4_HOME),
+        ('NYSBC_3DFSC_HOME', settings.NYSBC_3DFSC_HOME),
+        ('CONDA_ACTIVATION_CMD', settings.CONDA_ACTIVATION_CMD)]),
+    settings.SPROD_GROUP_ID: OrderedDict([
+        ('SCIPION_USER_DATA', renderScipionUserData),
+        ('SCIPION_NOTIFY', 'False'),
+        ('CUDA', settings.CUDA),
+        ('MPI_LIBDIR', settings.MPI_LIBDIR),
+        ('MPI_BINDIR', settings.MPI_BINDIR),
+        ('MPI_INCLUDE', settings.MPI_INCLUDE),
+        ('SCIPION_TESTS', settings.TEST_DATASETS_DIR),
+        ('CRYOLO_CUDA_LIB', settings.CRYOLO_CUDA_LIB),
+        ('CCP4_HOME', settings.CCP4_HOME),
+        ('CRYOSPARC_DIR', settings.CRYOSPARC_DIR),
+        ('CRYO_PROJECTS_DIR', settings.CRYOSPARC_DIR + 'scipion_projects'),
+        ('CRYOSPARC_HOME', settings.CRYOSPARC_DIR),
+        ('CODESPEED_URL', settings.CODESPEED_URL),
+        ('CODESPEED_ENV', settings.CODESPEED_ENV),
+        ('PROFILING_PROJECTS_PATH', settings.PROFILING_PROJECTS_PATH),
+        ('CRYOSPARC_USER', settings.CRYOSPARC_USER),
+        ('MOTIONCOR2_BIN', settings.MOTIONCOR2_BIN),
+        ('GCTF', settings.GCTF),
+        ('GCTF_CUDA_LIB', settings.GCTF_CUDA_LIB),
+        ('GAUTOMATCH', settings.GAUTOMATCH),
+        ('GAUTOMATCH_CUDA_LIB', settings.GAUTOMATCH_CUDA_LIB),
+        ('RELION_CUDA_BIN', settings.RELION_CUDA_BIN),
+        ('RELION_CUDA_LIB', settings.RELION_CUDA_LIB),
+        ('SPIDER', settings.SPIDER),
+        ('SPIDER_MPI', settings.SPIDER_MPI),
+        ('CUDA_BIN', settings.CUDA_BIN),
+        ('CUDA_LIB', settings.CUDA_LIB),
+        ('CHIMERA_HOME', settings.CHIMERA_HOME),
+        ('PHENIX_HOME', settings.PHENIX_HOME),
+        ('TOMO3D_HOME', settings.TOMO3D_HOME),
+        ('CONDA_ACTIVATION_CMD', settings.CONDA_ACTIVATION_CMD),
+        ('BUILD_TESTS', settings.BUILD_TESTS)]),
+    settings.SDEVEL_GROUP_ID: OrderedDict([
+        ('EM_ROOT', settings.EM_ROOT),
+        ('SCIPION_USER_DATA', renderScipionUserData),
+        ('SCIPION_NOTIFY', 'False'),
+        ('CUDA', settings.CUDA),
+        ('MPI_LIBDIR', settings.MPI_LIBDIR),
+        ('MPI_BINDIR', settings.MPI_BINDIR),
+        ('MPI_INCLUDE', settings.MPI_INCLUDE),
+        ('SCIPION_TESTS', settings.TEST_DATASETS_DIR),
+        ('CRYOLO_CUDA_LIB', settings.CRYOLO_CUDA_LIB),
+        ('CCP4_HOME', settings.CCP4_HOME),
+        ('CRYOSPARC_DIR', settings.CRYOSPARC_DIR),
+        ('CRYO_PROJECTS_DIR', settings.CRYOSPARC_DIR + 'scipion_projects'),
+        ('CRYOSPARC_HOME', settings.CRYOSPARC_DIR),
+        ('PYSEG_HOME', settings.PYSEG_HOME),
+        ('CODESPEED_URL', settings.CODESPEED_URL),
+        ('CODESPEED_ENV', settings.CODESPEED_ENV),
+        ('PROFILING_PROJECTS_PATH', settings.PROFILING_PROJECTS_PATH),
+        ('GCTF', settings.GCTF),
+        ('GCTF_CUDA_LIB', settings.GCTF_CUDA_LIB),
+        ('CRYOSPARC_USER', settings.CRYOSPARC_USER),
+        ('GAUTOMATCH', settings.GAUTOMATCH),
+        ('GAUTOMATCH_CUDA_LIB', settings.GAUTOMATCH_CUDA_LIB),
+        ('RELION_CUDA_BIN', settings.RELION_CUDA_BIN),
+        ('RELION_CUDA_LIB', settings.RELION_CUDA_LIB),
+        ('CHIMERA_HOME', settings.CHIMERA_HOME),
+        ('PHENIX_HOME', settings.PHENIX_HOME),
+        ('SPIDER', settings.SPIDER),
+        ('SPIDER_MPI', settings.SPIDER_MPI),
+        ('CUDA_BIN', settings.CUDA_BIN),
+        ('CUDA_LIB', settings.CUDA_LIB),
+        ('TOMO3D_HOME', settings.TOMO3D_HOME),
+        ('CONDA_ACTIVATION_CMD', settings.CONDA_ACTIVATION_CMD_DEVEL),
+        ('BUILD_TESTS', settings.BUILD_TESTS)])
+}
+
+# Keys of config/scipion.conf in the support group (the rest of them go
+# to SCIPION_LOCAL_CONFIG)
+supportScipionConfKeys = OrderedDict([
+    ('MPI_LIBDIR', settings.MPI_LIBDIR),
+    ('MPI_BINDIR', settings.MPI_BINDIR),
+    ('MPI_INCLUDE', settings.MPI_INCLUDE),
+    # Use a common home data tests folder to save storage
+    ('SCIPION_TESTS', settings.TEST_DATASETS_DIR)])
+
+installEman212 = ShellCommand(command=cachedInstallbCmd('./scipion', 'eman-2.12', ()),
                               name='Install eman-2.12',
                               description='Install eman-2.12',
                               descriptionDone='Installed eman-2.12',
@@ -507,11 +273,11 @@ checkPluginsDiffCmd = ('python ' +
 def addScipionGitAndConfigSteps(factorySteps, groupId):
     """ The initial steps are common in all builders.
          1. git pull in a certain branch.
-         2. remove scipion.config files.
-         3. regenerate scipion.config files
-         4. set notify at False
-         5. set dataTests folder to a common dir (to save space)
-         6. set ScipionUserData to an internal folder (to allow branch-dependent project inspection)
+         2. regenerate scipion.config files (if needed), setting the notify
+            at False, the dataTests folder to a common dir (to save space),
+            the ScipionUserData to an internal folder (to allow
+            branch-dependent project inspection) and the rest of
+            scipionConfigKeys
     """
     factorySteps.addStep(Git(repourl=settings.gitRepoURL,
                              branch=settings.branchsDict[groupId].get(settings.SCIPION_BUILD_ID, None),
@@ -519,17 +285,16 @@ def addScipionGitAndConfigSteps(factorySteps, groupId):
                              name='Scipion Git Repository Pull',
                              haltOnFailure=True))
 
-    factorySteps.addStep(removeScipionConf)
-    factorySteps.addStep(removeHomeConfig)
-    factorySteps.addStep(configScipion)
-    factorySteps.addStep(setNotifyAtFalse)
-    factorySteps.addStep(setGeneralCuda)
-    factorySteps.addStep(setMpiLibPath)
-    factorySteps.addStep(setMpiBinPath)
-    factorySteps.addStep(setMpiIncludePath)
-    factorySteps.addStep(setDataTestsDir)
+    factorySteps.addStep(
+        ScipionConfigStep(command=['./scipion', 'config', '--notify', '--overwrite'],
+                          configs=[('config/scipion.conf', supportScipionConfKeys),
+                                   (util.Property('SCIPION_LOCAL_CONFIG'),
+                                    scipionConfigKeys[groupId])],
+                          name='Scipion Config',
+                          description='Create installation configuration files',
+                          descriptionDone='Scipion config',
+                          haltOnFailure=True))
     # factorySteps.addStep(removeScipionUserData)  # to avoid old tests when are renamed
-    factorySteps.addStep(setScipionUserData)
 
     return factorySteps
 
@@ -577,22 +342,31 @@ def installScipionFactory(groupId):
                      descriptionDone='Test scipion installation',
                      haltOnFailure=True))
     installScipionFactorySteps.addStep(
-        steps.JSONStringDownload(dict(scipionPlugins, **{"scipion-em-locscale": locscalePluginData}),
-                                 workerdest="plugins.json"))
-    installScipionFactorySteps.addStep(setMotioncorrCudaSupport)
-    installScipionFactorySteps.addStep(setCryoloCuda)
-    installScipionFactorySteps.addStep(setPhenixHome)
-    installScipionFactorySteps.addStep(setCryosparcDir)
-    installScipionFactorySteps.addStep(setCryosparcUser)
-    installScipionFactorySteps.addStep(setMotincor2BinSupport)
-    installScipionFactorySteps.addStep(setCcp4Home)
-    installScipionFactorySteps.addStep(setNYSBC_3DFSC_HOME)
-    installScipionFactorySteps.addStep(setEnvActivationCMD)
-    # installScipionFactorySteps.addStep(setCryoloModel)
-    #installScipionFactorySteps.addStep(setCryoloEnvActivation)
+        steps.JSONStringDownload(installedPlugins(groupId), workerdest="plugins.json"))
     return installScipionFactorySteps
 
 
+sprodInstallCmd = ['installscipion', settings.SPROD_SCIPION_HOME, '-noAsk',
+                   '-n', settings.PROD_ENV, '-conda']
+sdevelInstallCmd = ['installscipion', settings.SDEVEL_SCIPION_HOME, '-noAsk',
+                    '-dev', '-n', settings.DEVEL_ENV, '-sciBranch', 'devel',
+                    '-conda', '-xmippBranch', 'devel']
+
+
+def addSaveCondaEnvSteps(factorySteps, envName, condaInit, installCmd):
+    """ Snapshot the conda environment just installed, so the clean up can
+    restore it instead of removing it """
+    factorySteps.addStep(downloadWorkerScript('condaenv.py'))
+    factorySteps.addStep(
+        ShellCommand(command=condaEnvCmd('save', envName, condaInit, installCmd),
+                     name='Save conda environment',
+                     description='Saving conda environment snapshot',
+                     descriptionDone='Conda environment saved',
+                     timeout=settings.timeOutInstall,
+                     flunkOnFailure=False,
+                     warnOnFailure=True))
+
+
 def installProdScipionFactory(groupId):
     installScipionFactorySteps = util.BuildFactory()
     installScipionFactorySteps.workdir = settings.SCIPION_BUILD_ID
@@ -616,16 +390,17 @@ def installProdScipionFactory(groupId):
                                                     )))
 
     # Install Scipion
-    scipionHome = settings.SPROD_SCIPION_HOME
     installScipionFactorySteps.addStep(
-        (ShellCommand(command=['installscipion', scipionHome, '-noAsk', '-n',
-                               'prodEnv', '-conda'],
+        (ShellCommand(command=sprodInstallCmd,
                       name='Install Scipion',
                       description='Install Scipion',
                       descriptionDone='Install Scipion',
+                      env={'CONDA_SOLVER': settings.CONDA_SOLVER},
                       timeout=settings.timeOutShort,
                       haltOnFailure=True
                       )))
+    addSaveCondaEnvSteps(installScipionFactorySteps, settings.PROD_ENV,
+                         settings.CONDA_ACTIVATION_CMD, sprodInstallCmd)
 
     installScipionFactorySteps.addStep(
         (ShellCommand(command=['chmod', '777', '-R', settings.SPROD_ENV_PATH],
@@ -636,59 +411,17 @@ def installProdScipionFactory(groupId):
                       )))
 
     installScipionFactorySteps.addStep(
-        steps.JSONStringDownload(dict(scipionSdevelPlugins, **{
-            "scipion-em-locscale": locscaleSdevelPluginData}),
-                                 workerdest="plugins.json"))
+        steps.JSONStringDownload(installedPlugins(groupId), workerdest="plugins.json"))
 
     # Scipion config
-    installScipionFactorySteps.addStep(removeScipionProdConf)
-    installScipionFactorySteps.addStep(removeHomeConfig)
     installScipionFactorySteps.addStep(
-        ShellCommand(command=sprodScipionConfig,
-                           name='Scipion Config',
-                           description='Create installation configuration files',
-                           descriptionDone='Scipion config',
-                           haltOnFailure=True))
-
-    installScipionFactorySteps.addStep(setScipionUserData)
-    installScipionFactorySteps.addStep(setNotifyAtFalse)
-    installScipionFactorySteps.addStep(setGeneralCuda)
-    installScipionFactorySteps.addStep(setMpiLibPath)
-    installScipionFactorySteps.addStep(setMpiBinPath)
-    installScipionFactorySteps.addStep(setMpiIncludePath)
-    installScipionFactorySteps.addStep(setDataTestsDir)
-    # Activating the Anaconda environment
-    # Set the anaconda environment
-    #installScipionFactorySteps.addStep(setMotioncorrCuda)
-    installScipionFactorySteps.addStep(setCryoloCuda)
-
-    installScipionFactorySteps.addStep(setCcp4Home)
-    # installScipionFactorySteps.addStep(setNYSBC_3DFSC_HOMESdevel)
-    # installScipionFactorySteps.addStep(setCryoloModelSdevel)
-    # installScipionFactorySteps.addStep(setCryoloEnvActivationSdevel)
-    installScipionFactorySteps.addStep(setCryosparcDir)
-    installScipionFactorySteps.addStep(setCryosparcProjectDir)
-    installScipionFactorySteps.addStep(setCryosparcHome)
-    installScipionFactorySteps.addStep(setCodeSpeedUrl)
-    installScipionFactorySteps.addStep(setCodeSpeedEnv)
-    installScipionFactorySteps.addStep(profilingProjectPath)
-    installScipionFactorySteps.addStep(setCryosparcUser)
-    installScipionFactorySteps.addStep(setMotincor2Bin)
-    installScipionFactorySteps.addStep(setGctfBin)
-    installScipionFactorySteps.addStep(setGCTFCuda)
-    installScipionFactorySteps.addStep(setGautomatchBin)
-    installScipionFactorySteps.addStep(setGautomatchCudaBin)
-    installScipionFactorySteps.addStep(setRelionCudaBin)
-    installScipionFactorySteps.addStep(setRelionCudaLib)
-    installScipionFactorySteps.addStep(setSPIDERBin)
-    installScipionFactorySteps.addStep(setSPIDER_MPI)
-    installScipionFactorySteps.addStep(setCUDA_BIN)
-    installScipionFactorySteps.addStep(setCUDA_LIB)
-    installScipionFactorySteps.addStep(setChimeraHome)
-    installScipionFactorySteps.addStep(setPhenixHome)
-    installScipionFactorySteps.addStep(setJjsoftHome)
-    installScipionFactorySteps.addStep(setEnvActivationCMD)
-    installScipionFactorySteps.addStep(setBuildXmippTest)
+        ScipionConfigStep(command=['bash', '-c', sprodScipionConfig],
+                          configs=[(settings.SPROD_SCIPION_CONFIG_PATH,
+                                    scipionConfigKeys[groupId])],
+                          name='Scipion Config',
+                          description='Create installation configuration files',
+                          descriptionDone='Scipion config',
+                          haltOnFailure=True))
     installScipionFactorySteps.addStep(
         ScipionCommandStep(command=sprodMoveScipionConfig,
                            name='Move Scipion Config file',
@@ -734,16 +467,17 @@ def installSDevelScipionFactory(groupId):
                       )))
 
     # Install Scipion
-    scipionHome = settings.SDEVEL_SCIPION_HOME
     installScipionFactorySteps.addStep(
-        (ShellCommand(command=['installscipion', scipionHome, '-noAsk', '-dev', '-n',
-                               'develEnv', '-sciBranch', 'devel', '-conda', '-xmippBranch', 'devel'],
+        (ShellCommand(command=sdevelInstallCmd,
                       name='Install Scipion',
                       description='Install Scipion',
                       descriptionDone='Install Scipion',
+                      env={'CONDA_SOLVER': settings.CONDA_SOLVER},
                       timeout=settings.timeOutShort,
                       haltOnFailure=True
                       )))
+    addSaveCondaEnvSteps(installScipionFactorySteps, settings.DEVEL_ENV,
+                         settings.CONDA_ACTIVATION_CMD_DEVEL, sdevelInstallCmd)
 
     # installScipionFactorySteps.addStep(
     #     (ShellCommand(command=['chmod', '777', '-R', settings.SDEVEL_ENV_PATH],
@@ -753,55 +487,17 @@ def installSDevelScipionFactory(groupId):
     #                   timeout=settings.timeOutShort
     #                   )))
 
-    xmippSdevelPluginData = scipionSdevelPlugins.pop('scipion-em-xmipp')
     installScipionFactorySteps.addStep(
-        steps.JSONStringDownload(dict(scipionSdevelPlugins, **{
-            "scipion-em-locscale": locscaleSdevelPluginData}),
-                                 workerdest="plugins.json"))
-
-    installScipionFactorySteps.addStep(removeScipionDevelConf)
-    installScipionFactorySteps.addStep(removeHomeConfig)
-    installScipionFactorySteps.addStep(ShellCommand(command=sdevelScipionConfig,
-                                                          name='Scipion Config',
-                                                          description='Create installation configuration files',
-                                                          descriptionDone='Scipion config',
-                                                          haltOnFailure=True))
-
-    installScipionFactorySteps.addStep(setEM_ROOTSdevel)
-    installScipionFactorySteps.addStep(setScipionUserData)
-    installScipionFactorySteps.addStep(setNotifyAtFalse)
-    installScipionFactorySteps.addStep(setGeneralCuda)
-    installScipionFactorySteps.addStep(setMpiLibPath)
-    installScipionFactorySteps.addStep(setMpiBinPath)
-    installScipionFactorySteps.addStep(setMpiIncludePath)
-    installScipionFactorySteps.addStep(setDataTestsDir)
-    # Activating the Anaconda environment
-    # Set the anaconda environment
-    installScipionFactorySteps.addStep(setCryoloCuda)
-    installScipionFactorySteps.addStep(setCcp4Home)
-    installScipionFactorySteps.addStep(setCryosparcDir)
-    installScipionFactorySteps.addStep(setCryosparcProjectDir)
-    installScipionFactorySteps.addStep(setCryosparcHome)
-    installScipionFactorySteps.addStep(setPysegHome)
-    installScipionFactorySteps.addStep(setCodeSpeedUrl)
-    installScipionFactorySteps.addStep(setCodeSpeedEnv)
-    installScipionFactorySteps.addStep(profilingProjectPath)
-    installScipionFactorySteps.addStep(setGctfBin)
-    installScipionFactorySteps.addStep(setGCTFCuda)
-    installScipionFactorySteps.addStep(setCryosparcUser)
-    installScipionFactorySteps.addStep(setGautomatchBin)
-    installScipionFactorySteps.addStep(setGautomatchCudaBin)
-    installScipionFactorySteps.addStep(setRelionCudaBin)
-    installScipionFactorySteps.addStep(setRelionCudaLib)
-    installScipionFactorySteps.addStep(setChimeraHome)
-    installScipionFactorySteps.addStep(setPhenixHome)
-    installScipionFactorySteps.addStep(setSPIDERBin)
-    installScipionFactorySteps.addStep(setSPIDER_MPI)
-    installScipionFactorySteps.addStep(setCUDA_BIN)
-    installScipionFactorySteps.addStep(setCUDA_LIB)
-    installScipionFactorySteps.addStep(setJjsoftHome)
-    installScipionFactorySteps.addStep(setEnvActivationCMD_DEVEL)
-    installScipionFactorySteps.addStep(setBuildXmippTest)
+        steps.JSONStringDownload(installedPlugins(groupId), workerdest="plugins.json"))
+
+    installScipionFactorySteps.addStep(
+        ScipionConfigStep(command=['bash', '-c', sdevelScipionConfig],
+                          configs=[(settings.SDEVEL_SCIPION_CONFIG_PATH,
+                                    scipionConfigKeys[groupId])],
+                          name='Scipion Config',
+                          description='Create installation configuration files',
+                          descriptionDone='Scipion config',
+                          haltOnFailure=True))
 
     installScipionFactorySteps.addStep(
     ScipionCommandStep(command=sdevelMoveScipionConfig,
@@ -835,8 +531,9 @@ def scipionTestFactory(groupId):
     emanVar = settings.EMAN212 if groupId == settings.PROD_GROUP_ID else settings.EMAN23
 
     if groupId == settings.PROD_GROUP_ID:
-        # add TestRelionExtractStreaming manually because it needs eman 2.12
+        # TestRelionExtractStreaming and TestBPV need eman 2.12
         wfRelionExtractStreaming = 'pyworkflow.tests.em.workflows.test_workflow_streaming.TestRelionExtractStreaming'
+        wfBPV = 'pyworkflow.tests.em.workflows.test_workflow_initialvolume.TestBPV'
 
         # gen stages
         genStagesCmd = ["./scipion", "test", "--show", "--grep", "pyworkflow", "--mode", "onlyclasses"]
@@ -848,24 +545,10 @@ def scipionTestFactory(groupId):
                                   haltOnFailure=False,
                                   targetTestSet='pyworkflow',
                                   stagePrefix=["./scipion", "test"],
+                                  groupId=groupId,
                                   blacklist=settings.SCIPION_TESTS_BLACKLIST,
-                                  stageEnvs={wfRelionExtractStreaming: emanVar}))
-
-        for pwLongTest in settings.SCIPION_LONG_TESTS:  # execute long tests at the end
-            if pwLongTest.endswith("TestBPV"):
-                scipionTestSteps.addStep(ShellCommand(command=['./scipion', 'test', pwLongTest],
-                                                      name=pwLongTest,
-                                                      description='Testing %s' % pwLongTest.split('.')[-1],
-                                                      descriptionDone=pwLongTest.split('.')[-1],
-                                                      timeout=settings.timeOutExecute,
-                                                      env=emanVar))
-                continue
-
-            scipionTestSteps.addStep(ShellCommand(command=['./scipion', 'test', pwLongTest],
-                                                  name=pwLongTest,
-                                                  description='Testing %s' % pwLongTest.split('.')[-1],
-                                                  descriptionDone=pwLongTest.split('.')[-1],
-                                                  timeout=settings.timeOutExecute))
+                                  stageEnvs={wfRelionExtractStreaming: emanVar,
+                                             wfBPV: emanVar}))
     else:
         scipionTestSteps.addStep(ShellCommand(
             command=['echo', 'SCIPION_HOME: ', util.Property('SCIPION_HOME')],
@@ -890,21 +573,90 @@ def scipionTestFactory(groupId):
                                       rootName='scipion3',
                                       haltOnFailure=False,
                                       targetTestSet=shortName,
+                                      groupId=groupId,
                                       blacklist=settings.SCIPION_TESTS_BLACKLIST))
 
     return scipionTestSteps
 
 
+# *****************************************************************************
+#                         TEST SHARD FACTORY
+# *****************************************************************************
+def stageShardFactory(groupId):
+    """ Run a shard of the test stages of a GenerateStagesCommand, given in
+    the SHARD_STAGES property, in the workdir of the parent build. """
+    shardSteps = util.BuildFactory()
+    shardSteps.workdir = util.Property('SHARD_WORKDIR')
+    shardSteps.addStep(RunShardStages(groupId=groupId,
+                                      name='Add shard stages',
+                                      description='Adding shard stages',
+                                      descriptionDone='Shard stages added'))
+    return shardSteps
+
+
+# *****************************************************************************
+#                         DISK JANITOR FACTORY
+# *****************************************************************************
+def diskJanitorFactory(groupId):
+    """ Free disk in the worker of the group before installing (see
+    DiskJanitor), it replaces the weekly clean up. The worker load is
+    probed again after it. """
+    janitorSteps = util.BuildFactory()
+    janitorSteps.addStep(SetGroupProperties(groupId,
+                                            name='Set %s properties' % groupId,
+                                            description='Setting %s properties' % groupId,
+                                            descriptionDone='%s properties set' % groupId,
+                                            haltOnFailure=False,
+                                            flunkOnFailure=False))
+    janitorSteps.addStep(downloadWorkerScript('diskjanitor.py'))
+    janitorSteps.addStep(DiskJanitor(groupId,
+                                     name='Free disk',
+                                     description='Evicting least recently used items',
+                                     descriptionDone='Disk freed',
+                                     timeout=settings.timeOutInstall,
+                                     haltOnFailure=False))
+    # the builds waiting for disk in this worker (see canStartBuild) need
+    # the free space after the eviction
+    janitorSteps.addStep(WorkerLoadProbe(path=util.Property('BUILD_GROUP_HOME'),
+                                         name='Probe worker load',
+                                         description='Probing worker load',
+                                         descriptionDone='Worker load probed',
+                                         alwaysRun=True,
+                                         haltOnFailure=False,
+                                         flunkOnFailure=False,
+                                         warnOnFailure=True))
+    return janitorSteps
+
+
 # *****************************************************************************
 #                         PLUGIN FACTORY
 # *****************************************************************************
+def pluginForceProperties(groupId):
+    """ Extra fields of the force form of the plugin builders """
+    return [util.FixedParameter(name='BUILD_GROUP', default=groupId),
+            util.BooleanParameter(name='FORCE_PLUGIN_INSTALL',
+                                  label='Reinstall the plugin even if its commit did not change',
+                                  default=False),
+            util.BooleanParameter(name='TEST_IMPACT',
+                                  label='Only run the tests affected by the changes since the last full run',
+                                  default=False),
+            util.BooleanParameter(name='RERUN_FAILED',
+                                  label='Only run the tests that failed in their last run',
+                                  default=False)]
+
+
 def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                   doInstall=True, extraBinaries=[], doTest=True,
                   deleteVirtualEnv='', binToRemove=[], moveFiles=[], bins=True,
-                  useUrl=False, url=None):
+                  useUrl=False, url=None, needsGpu=False):
     factorySteps = factorySteps or util.BuildFactory()
     factorySteps.workdir = util.Property('SCIPION_HOME')
     shortName = shortname or str(pluginName.rsplit('-', 1)[-1])  # todo: get module names more properly?
+    factorySteps.addStep(SetGroupProperties(groupId,
+                                            name='Set %s properties' % groupId,
+                                            description='Setting %s properties' % groupId,
+                                            descriptionDone='%s properties set' % groupId,
+                                            haltOnFailure=True))
     rootName = 'scipion3'
     if groupId == settings.PROD_GROUP_ID or groupId == settings.SPROD_GROUP_ID:
         scipionCmd = './scipion'
@@ -913,6 +665,14 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
             scipionCmd = './scipion3'
             rootName = 'scipion3'
 
+        if doInstall and url is not None:
+            factorySteps.addStep(CheckPluginInstall(pluginName, url, scipionCmd=scipionCmd,
+                                                    name='Check plugin %s commit' % shortName,
+                                                    description='Checking plugin %s commit' % shortName,
+                                                    descriptionDone='Checked plugin %s commit' % shortName,
+                                                    timeout=settings.timeOutShort,
+                                                    haltOnFailure=False))
+
         if deleteVirtualEnv:
             deleteEnv = (settings.CONDA_ACTIVATION_CMD +
                         "; conda env remove --name " + deleteVirtualEnv)
@@ -927,6 +687,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                               description='Removing %s virtual environment' % shortName,
                                               descriptionDone='Removing %s virtual environment' % shortName,
                                               timeout=settings.timeOutInstall,
+                                              doStepIf=isPluginInstallNeeded,
+                                              locks=[installLock(groupId)],
                                               haltOnFailure=False))
 
         if doInstall:
@@ -936,6 +698,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                                   description='Install plugin %s' % shortName,
                                                   descriptionDone='Installed plugin %s' % shortName,
                                                   timeout=settings.timeOutInstall,
+                                                  doStepIf=isPluginInstallNeeded,
+                                                  locks=[installLock(groupId)],
                                                   haltOnFailure=True))
             else:
                 pluginUrl = pluginName
@@ -947,6 +711,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                     description='Install plugin %s' % shortName,
                     descriptionDone='Installed plugin %s' % shortName,
                     timeout=settings.timeOutInstall,
+                    doStepIf=isPluginInstallNeeded,
+                    locks=[installLock(groupId)],
                     haltOnFailure=True))
             if groupId == settings.PROD_GROUP_ID:
                 factorySteps.addStep(ShellCommand(command=[scipionCmd, 'python', 'pyworkflow/install/inspect-plugins.py',
@@ -955,6 +721,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                                   description='Inspect plugin %s' % shortName,
                                                   descriptionDone='Inspected plugin %s' % shortName,
                                                   timeout=settings.timeOutInstall,
+                                                  doStepIf=isPluginInstallNeeded,
+                                                  locks=[installLock(groupId)],
                                                   haltOnFailure=False))
             else:
                 factorySteps.addStep(ShellCommand(command=[scipionCmd, 'inspect', shortName],
@@ -962,17 +730,32 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                                  description='Inspect plugin %s' % shortName,
                                                  descriptionDone='Inspected plugin %s' % shortName,
                                                  timeout=settings.timeOutInstall,
+                                                 doStepIf=isPluginInstallNeeded,
+                                                 locks=[installLock(groupId)],
                                                  haltOnFailure=False))
 
         if extraBinaries:
             extraBinaries = [extraBinaries] if isinstance(extraBinaries, str) else extraBinaries
+            factorySteps.addStep(downloadWorkerScript('emcache.py'))
             for binary in extraBinaries:
-                factorySteps.addStep(ShellCommand(command=[scipionCmd, 'installb', binary, '-j', '8'],
+                factorySteps.addStep(ShellCommand(command=cachedInstallbCmd(scipionCmd, binary),
                                                   name='Install extra package %s' % binary,
                                                   description='Install extra package  %s' % binary,
                                                   descriptionDone='Installed extra package  %s' % binary,
                                                   timeout=settings.timeOutInstall,
+                                                  doStepIf=isPluginInstallNeeded,
+                                                  locks=[installLock(groupId)],
                                                   haltOnFailure=True))
+
+        if doInstall and url is not None:
+            factorySteps.addStep(ShellCommand(command=recordPluginInstallCmd(pluginName),
+                                              name='Record plugin %s commit' % shortName,
+                                              description='Recording plugin %s commit' % shortName,
+                                              descriptionDone='Recorded plugin %s commit' % shortName,
+                                              doStepIf=isPluginInstallToRecord,
+                                              timeout=settings.timeOutShort,
+                                              haltOnFailure=False))
+
         if moveFiles:
             for file in moveFiles:
                 moveFileCmd = ('cp ' + settings.BUILDBOT_HOME + '/otherFiles/' + file +
@@ -985,6 +768,16 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                     timeout=settings.timeOutInstall,
                     haltOnFailure=True))
 
+        factorySteps.addStep(PluginInstalled(name='Plugin %s installed' % shortName,
+                                             description='Plugin %s installed' % shortName,
+                                             descriptionDone='Plugin %s installed' % shortName))
+
+        testImpact = None
+        if doTest and url is not None:
+            testImpact = {'package': shortName, 'url': url, 'scipionCmd': scipionCmd}
+            factorySteps.addStep(downloadWorkerScript('testimpact.py'))
+            factorySteps.addStep(downloadWorkerScript('envhash.py'))
+
         if doTest:
             factorySteps.addStep(
                 GenerateStagesCommand(command=[scipionCmd, "test", "--show", "--grep", shortName, '--mode', 'onlyclasses'],
@@ -994,11 +787,24 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                       stagePrefix=[scipionCmd, "test"],
                                       haltOnFailure=False,
                                       rootName=rootName,
+                                      groupId=groupId,
                                       blacklist=settings.SCIPION_TESTS_BLACKLIST,
+                                      needsGpu=needsGpu,
+                                      testImpact=testImpact,
+                                      discoveryCache=testImpact is not None,
+                                      discovered=discoveredTestsIfUnchanged,
                                       targetTestSet=shortName))
 
     elif groupId == settings.SDEVEL_GROUP_ID:
 
+        if doInstall and url is not None:
+            factorySteps.addStep(CheckPluginInstall(pluginName, url, scipionCmd=settings.SCIPION_CMD,
+                                                    name='Check plugin %s commit' % shortName,
+                                                    description='Checking plugin %s commit' % shortName,
+                                                    descriptionDone='Checked plugin %s commit' % shortName,
+                                                    timeout=settings.timeOutShort,
+                                                    haltOnFailure=False))
+
         if deleteVirtualEnv:
             deleteEnv = (settings.CONDA_ACTIVATION_CMD +
                         "; conda env remove --name " + deleteVirtualEnv)
@@ -1013,6 +819,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                               description='Removing %s virtual environment' % shortName,
                                               descriptionDone='Removing %s virtual environment' % shortName,
                                               timeout=settings.timeOutInstall,
+                                              doStepIf=isPluginInstallNeeded,
+                                              locks=[installLock(groupId)],
                                               haltOnFailure=False))
 
         if doInstall:
@@ -1026,6 +834,8 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                 description='Install plugin %s' % shortName,
                 descriptionDone='Installed plugin %s' % shortName,
                 timeout=settings.timeOutInstall,
+                doStepIf=isPluginInstallNeeded,
+                locks=[installLock(groupId)],
                 haltOnFailure=True))
 
             inspectCmd = (settings.SCIPION_CMD + ' inspect ' + shortName)
@@ -1035,16 +845,42 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                               description='Inspect plugin %s' % shortName,
                                               descriptionDone='Inspected plugin %s' % shortName,
                                               timeout=settings.timeOutInstall,
+                                              doStepIf=isPluginInstallNeeded,
+                                              locks=[installLock(groupId)],
                                               haltOnFailure=False))
 
         if extraBinaries:
+            factorySteps.addStep(downloadWorkerScript('emcache.py'))
             for binary in extraBinaries:
-                factorySteps.addStep(ScipionCommandStep(command=('%s installb %s -j 8') %(settings.SCIPION_CMD, binary),
+                factorySteps.addStep(ScipionCommandStep(command=' '.join(cachedInstallbCmd(settings.SCIPION_CMD, binary)),
                                                   name='Install extra package %s' % binary,
                                                   description='Install extra package  %s' % binary,
                                                   descriptionDone='Installed extra package  %s' % binary,
                                                   timeout=settings.timeOutInstall,
+                                                  doStepIf=isPluginInstallNeeded,
+                                                  locks=[installLock(groupId)],
                                                   haltOnFailure=False))
+
+        if doInstall and url is not None:
+            factorySteps.addStep(ShellCommand(command=recordPluginInstallCmd(pluginName),
+                                              name='Record plugin %s commit' % shortName,
+                                              description='Recording plugin %s commit' % shortName,
+                                              descriptionDone='Recorded plugin %s commit' % shortName,
+                                              doStepIf=isPluginInstallToRecord,
+                                              timeout=settings.timeOutShort,
+                                              haltOnFailure=False))
+
+        factorySteps.addStep(PluginInstalled(name='Plugin %s installed' % shortName,
+                                             description='Plugin %s installed' % shortName,
+                                             descriptionDone='Plugin %s installed' % shortName))
+
+        testImpact = None
+        if doTest and url is not None:
+            testImpact = {'package': shortName, 'url': url,
+                          'scipionCmd': settings.SCIPION_CMD}
+            factorySteps.addStep(downloadWorkerScript('testimpact.py'))
+            factorySteps.addStep(downloadWorkerScript('envhash.py'))
+
         if doTest:
             pluginsTestShowcmd = ['bash', '-c', './scipion3 test --show --grep ' +
                                   shortName + ' --mode onlyclasses']
@@ -1057,7 +893,12 @@ def pluginFactory(groupId, pluginName, factorySteps=None, shortname=None,
                                       stagePrefix=[settings.SCIPION_CMD, "test"],
                                       haltOnFailure=False,
                                       rootName=rootName,
+                                      groupId=groupId,
                                       blacklist=settings.SCIPION_TESTS_BLACKLIST,
+                                      needsGpu=needsGpu,
+                                      testImpact=testImpact,
+                                      discoveryCache=testImpact is not None,
+                                      discovered=discoveredTestsIfUnchanged,
                                       targetTestSet=shortName))
 
     return factorySteps
@@ -1100,19 +941,24 @@ def cleanUpFactory(groupId, rmXmipp=False):
                                           timeout=settings.timeOutInstall))
 
     if groupId != settings.PROD_GROUP_ID:
-        condaEnv = settings.CONDA_REMOVE_DEVEL_ENV
+        # restore the environment from its snapshot, it is only removed
+        # when there is none for the current installscipion command
+        envName = settings.DEVEL_ENV
         condaActivate = settings.CONDA_ACTIVATION_CMD_DEVEL
+        installCmd = sdevelInstallCmd
         if groupId == settings.SPROD_GROUP_ID:
-            condaEnv = settings.CONDA_REMOVE_PROD_ENV
+            envName = settings.PROD_ENV
             condaActivate = settings.CONDA_ACTIVATION_CMD
-
-        command = (condaActivate + ' ; ' +
-                   condaEnv)
-        cleanUpSteps.addStep(ScipionCommandStep(command=command,
-                                                name='Removing virtual enviroment',
-                                                description='Removing virtual enviroment',
-                                                descriptionDone='Removing virtual enviroment',
-                                                timeout=settings.timeOutInstall))
+            installCmd = sprodInstallCmd
+
+        cleanUpSteps.addStep(downloadWorkerScript('condaenv.py'))
+        cleanUpSteps.addStep(ShellCommand(command=condaEnvCmd('reset', envName,
+                                                              condaActivate,
+                                                              installCmd),
+                                          name='Resetting virtual enviroment',
+                                          description='Resetting virtual enviroment',
+                                          descriptionDone='Virtual enviroment reset',
+                                          timeout=settings.timeOutInstall))
 
     return cleanUpSteps
 
@@ -1251,11 +1097,7 @@ def docsFactory(groupId):
                                timeout=settings.timeOutInstall))
 
         # Generate the plugins documentation
-        plugins = {}
-        plugins.update(scipionSdevelPlugins)
-        plugins.update({"scipion-em-locscale": locscaleSdevelPluginData})
-
-        for plugin, pluginDict in plugins.items():
+        for plugin, pluginDict in installedPlugins(settings.SDEVEL_GROUP_ID).items():
             moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
             modulePath = os.path.join(settings.SCIPION_SDEVEL_ENV_PATH, moduleName)
 
@@ -1362,8 +1204,8 @@ def getLocscaleBuilder(groupId, env):
     builderFactory = util.BuildFactory()
 
     locscaleEnv = {}
-    worker = settings.WORKER1 if groupId == settings.SDEVEL_GROUP_ID or groupId == settings.SPROD_GROUP_ID else settings.WORKER
     if groupId == settings.PROD_GROUP_ID:
+        builderFactory.addStep(downloadWorkerScript('emcache.py'))
         builderFactory.addStep(installEman212)
         locscaleEnv.update(settings.EMAN212)
     else:
@@ -1371,10 +1213,13 @@ def getLocscaleBuilder(groupId, env):
 
     locscaleEnv.update(env)
 
+    locscalePluginData = pluginRegistry.entry(PROD_PLUGINS, 'scipion-em-locscale')
     name = str(locscalePluginData['name'])
     return BuilderConfig(name="%s_%s" % (name, groupId),
                          tags=[groupId, name],
-                         workernames=[worker],
+                         workernames=settings.WORKER_POOLS[groupId],
+                         nextWorker=nextWorker,
+                         canStartBuild=canStartBuild,
                          factory=pluginFactory(groupId, 'scipion-em-locscale', factorySteps=builderFactory),
                          workerbuilddir=groupId,
                          properties={'slackChannel': locscalePluginData.get('slackChannel', "")},
@@ -1393,7 +1238,9 @@ def getScipionBuilders(groupId):
         scipionBuilders.append(
             BuilderConfig(name=settings.SCIPION_INSTALL_PREFIX + groupId,
                           tags=[groupId],
-                          workernames=[settings.WORKER],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=installScipionFactory(groupId),
                           workerbuilddir=groupId,
                           properties={"slackChannel": settings.SCIPION_SLACK_CHANNEL},
@@ -1402,7 +1249,9 @@ def getScipionBuilders(groupId):
         scipionBuilders.append(
             BuilderConfig(name=settings.SCIPION_TESTS_PREFIX + groupId,
                           tags=[groupId],
-                          workernames=[settings.WORKER],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=scipionTestFactory(groupId),
                           workerbuilddir=groupId,
                           properties={'slackChannel': settings.SCIPION_SLACK_CHANNEL},
@@ -1412,7 +1261,9 @@ def getScipionBuilders(groupId):
         scipionBuilders.append(
             BuilderConfig(name=settings.CLEANUP_PREFIX + groupId,
                           tags=[groupId],
-                          workernames=[settings.WORKER],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=cleanUpFactory(groupId),
                           workerbuilddir=groupId,
                           properties={'slackChannel': settings.SCIPION_SLACK_CHANNEL},
@@ -1421,26 +1272,34 @@ def getScipionBuilders(groupId):
 
         # special locscale case, we need to install eman212
 
-        for plugin, pluginDict in scipionPlugins.items():
+        for plugin, pluginDict in groupPlugins(groupId).items():
             moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
             tags = [groupId, moduleName]
             doTests = pluginDict.get("DO_TESTS", True)
-            scipionBuilders.append(
+            scipionBuilders.append(cachedPluginConfig('builder', groupId, plugin, lambda: (
                 BuilderConfig(name="%s_%s" % (moduleName, groupId),
                               tags=tags,
-                              workernames=[settings.WORKER],
-                              factory=pluginFactory(groupId, plugin, shortname=moduleName, doTest=doTests),
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
+                              factory=pluginFactory(groupId, plugin, shortname=moduleName, doTest=doTests,
+                                                    url=pluginDict.get("pluginSourceUrl", None),
+                                                    needsGpu=pluginDict.get("needsGpu", False)),
                               workerbuilddir=groupId,
-                              properties={'slackChannel': scipionPlugins[plugin].get('slackChannel', "")},
+                              properties={'slackChannel': pluginDict.get('slackChannel', "")},
                               env=env)
-            )
+            )))
 
-        scipionBuilders.append(getLocscaleBuilder(groupId, env))
+        scipionBuilders.append(cachedPluginConfig(
+            'builder', groupId, 'scipion-em-locscale',
+            lambda: getLocscaleBuilder(groupId, env), key=PROD_PLUGINS))
 
         if settings.branchsDict[groupId].get(settings.DOCS_BUILD_ID, None) is not None:
             scipionBuilders.append(BuilderConfig(name="%s%s" % (settings.DOCS_PREFIX, groupId),
                                                  tags=["docs", groupId],
-                                                 workernames=[settings.WORKER],
+                                                 workernames=settings.WORKER_POOLS[groupId],
+                                                 nextWorker=nextWorker,
+                                                 canStartBuild=canStartBuild,
                                                  factory=docsFactory(groupId),
                                                  workerbuilddir=groupId,
                                                  properties={
@@ -1458,7 +1317,9 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name=settings.SCIPION_INSTALL_PREFIX + groupId,
                               tags=[groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=installSDevelScipionFactory(groupId),
                               workerbuilddir=groupId,
                               properties={
@@ -1473,7 +1334,9 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name=settings.SCIPION_INSTALL_PREFIX + groupId,
                               tags=[groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=installProdScipionFactory(groupId),
                               workerbuilddir=groupId,
                               properties={
@@ -1482,7 +1345,9 @@ def getScipionBuilders(groupId):
         scipionBuilders.append(
             BuilderConfig(name=settings.SCIPION_TESTS_PREFIX + groupId,
                           tags=[groupId],
-                          workernames=[settings.WORKER1],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=scipionTestFactory(groupId),
                           workerbuilddir=groupId,
                           properties={
@@ -1494,7 +1359,9 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name=settings.CLEANUP_PREFIX + groupId,
                               tags=[groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=cleanUpFactory(groupId, rmXmipp=True),
                               workerbuilddir=groupId,
                               properties={
@@ -1505,7 +1372,9 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name=settings.CLEANUP_PREFIX + groupId,
                               tags=[groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=cleanUpFactory(groupId),
                               workerbuilddir=groupId,
                               properties={
@@ -1513,7 +1382,7 @@ def getScipionBuilders(groupId):
                               env=env)
             )
 
-        for plugin, pluginDict in scipionSdevelPlugins.items():
+        for plugin, pluginDict in groupPlugins(groupId).items():
             moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
             tags = [groupId, moduleName]
             doTests = pluginDict.get("DO_TESTS", True)
@@ -1524,10 +1393,12 @@ def getScipionBuilders(groupId):
             bins = pluginDict.get("bins", True)
             useUrl = pluginDict.get("USE_URL_PROD", False)
             url = pluginDict.get("pluginSourceUrl", None)
-            scipionBuilders.append(
+            scipionBuilders.append(cachedPluginConfig('builder', groupId, plugin, lambda: (
                 BuilderConfig(name="%s_%s" % (moduleName, groupId),
                               tags=tags,
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=pluginFactory(groupId, plugin,
                                                     shortname=moduleName,
                                                     doTest=doTests,
@@ -1537,17 +1408,22 @@ def getScipionBuilders(groupId):
                                                     moveFiles=moveFiles,
                                                     bins=bins,
                                                     useUrl=useUrl,
-                                                    url=url),
+                                                    url=url,
+                                                    needsGpu=pluginDict.get("needsGpu", False)),
                               workerbuilddir=groupId,
-                              properties={'slackChannel': scipionSdevelPlugins[plugin].get('slackChannel', "")},
+                              properties={'slackChannel': pluginDict.get('slackChannel', "")},
                               env=env)
-            )
-        scipionBuilders.append(getLocscaleBuilder(groupId, env))
+            )))
+        scipionBuilders.append(cachedPluginConfig(
+            'builder', groupId, 'scipion-em-locscale',
+            lambda: getLocscaleBuilder(groupId, env), key=PROD_PLUGINS))
 
         if settings.branchsDict[groupId].get(settings.DOCS_BUILD_ID, None) is not None:
             scipionBuilders.append(BuilderConfig(name="%s%s" % (settings.DOCS_PREFIX, groupId),
                                                  tags=["docs", groupId],
-                                                 workernames=[settings.WORKER1],
+                                                 workernames=settings.WORKER_POOLS[groupId],
+                                                 nextWorker=nextWorker,
+                                                 canStartBuild=canStartBuild,
                                                  factory=docsFactory(groupId),
                                                  workerbuilddir=groupId,
                                                  properties={
@@ -1557,7 +1433,9 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name="%s%s" % (settings.WEBSITE_PREFIX, groupId),
                               tags=["web", groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=updateWebSite(groupId),
                               workerbuilddir=groupId,
                               properties={
@@ -1567,13 +1445,36 @@ def getScipionBuilders(groupId):
             scipionBuilders.append(
                 BuilderConfig(name="%s%s" % (settings.CHECK_PLUGINS_DIFF, groupId),
                               tags=["plugin_branch_diff", groupId],
-                              workernames=[settings.WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=checkPluginDiff(groupId),
                               workerbuilddir=groupId,
                               properties={
                                   'slackChannel': "buildbot"},
                               env=env))
 
+    scipionBuilders.append(
+        BuilderConfig(name=settings.DISK_JANITOR_PREFIX + groupId,
+                      tags=[groupId, 'janitor'],
+                      workernames=settings.WORKER_POOLS[groupId],
+                      nextWorker=nextWorker,
+                      canStartBuild=canStartBuild,
+                      factory=diskJanitorFactory(groupId),
+                      workerbuilddir=groupId,
+                      properties={'slackChannel': settings.SCIPION_SLACK_CHANNEL}))
+
+    scipionBuilders.append(
+        BuilderConfig(name=settings.TEST_SHARD_PREFIX + groupId,
+                      tags=[groupId],
+                      workernames=settings.WORKER_POOLS[groupId],
+                      nextWorker=nextWorker,
+                      canStartBuild=canStartBuild,
+                      factory=stageShardFactory(groupId),
+                      workerbuilddir=groupId,
+                      properties={'slackChannel': settings.SCIPION_SLACK_CHANNEL},
+                      env=env))
+
     return scipionBuilders
 
 
@@ -1609,70 +1510,91 @@ def checkPluginDiff(groupId):
     return checkPluginsDiffFactorySteps
 
 
-def getScipionSchedulers(groupId):
-    if groupId == settings.SDEVEL_GROUP_ID or groupId == settings.SPROD_GROUP_ID:
-        scipionSchedulerNames = [settings.SCIPION_INSTALL_PREFIX + groupId,
-                                 settings.SCIPION_TESTS_PREFIX + groupId,
-                                 settings.CLEANUP_PREFIX + groupId]
-
-        if settings.branchsDict[groupId].get(settings.DOCS_BUILD_ID, None) is not None:
-            scipionSchedulerNames.append("%s%s" % (settings.DOCS_PREFIX, groupId))
+def getPluginChangeScheduler(groupId, moduleName, url):
+    """ Scheduler running a TEST_IMPACT build of the plugin builder when
+    the branch of its source url gets pushes """
+    repo, branch = splitSourceUrl(url)
+    repoUrl = normalizeRepoUrl(repo)
+    filterArgs = {} if branch == 'HEAD' else {'branch': branch}
+    return SingleBranchScheduler(
+        name='%s%s_%s' % (settings.CHANGES_PREFIX, moduleName, groupId),
+        change_filter=util.ChangeFilter(
+            repository_fn=lambda repository: normalizeRepoUrl(repository) == repoUrl,
+            **filterArgs),
+        treeStableTimer=settings.CHANGES_TREE_STABLE_TIMER,
+        builderNames=["%s_%s" % (moduleName, groupId)],
+        properties={'BUILD_GROUP': groupId,
+                    'TEST_IMPACT': True})
+
+
+def getPluginPollers(groupIds):
+    """ GitPollers of the plugin repositories in the local file system (or
+    all of them if CHANGES_POLL_REMOTE), one per repository """
+    branches = OrderedDict()
+    for groupId in groupIds:
+        for pluginDict in groupPlugins(groupId).values():
+            url = pluginDict.get("pluginSourceUrl")
+            if url and (isLocalRepo(url) or settings.CHANGES_POLL_REMOTE):
+                repo, branch = splitSourceUrl(url)
+                branches.setdefault(repo, set()).add(branch)
+    return [GitPoller(repourl=repo,
+                      branches=sorted(repoBranches - {'HEAD'}) or True,
+                      workdir='gitpoller-%s' % os.path.basename(repo.rstrip('/')),
+                      pollInterval=settings.CHANGES_POLL_INTERVAL,
+                      pollAtLaunch=True)
+            for repo, repoBranches in branches.items()]
+
+
+def getPluginSchedulers(groupId, moduleName, pluginDict):
+    builderName = "%s_%s" % (moduleName, groupId)
+    schedulers = [triggerable.Triggerable(name=builderName, builderNames=[builderName]),
+                  ForceScheduler(name='%s%s' % (settings.FORCE_BUILDER_PREFIX, builderName),
+                                 builderNames=[builderName],
+                                 properties=pluginForceProperties(groupId))]
+    if pluginDict.get("pluginSourceUrl"):
+        schedulers.append(getPluginChangeScheduler(
+            groupId, moduleName, pluginDict["pluginSourceUrl"]))
+    return schedulers
 
-        if groupId == settings.SDEVEL_GROUP_ID:
-            scipionSchedulerNames.append("%s%s" % (settings.WEBSITE_PREFIX,
-                                                   groupId))
-            scipionSchedulerNames.append("%s%s" % (settings.CHECK_PLUGINS_DIFF,
-                                                   groupId))
-
-        schedulers = []
-        for name in scipionSchedulerNames:
-            schedulers.append(triggerable.Triggerable(name=name,
-                                                      builderNames=[name]))
-            schedulers.append(
-                ForceScheduler(name='%s%s' % (settings.FORCE_BUILDER_PREFIX, name),
-                               builderNames=[name]))
-
-        plugins = {}
-        plugins.update(scipionSdevelPlugins)
-        plugins.update({"scipion-em-locscale": locscaleSdevelPluginData})
-        for plugin, pluginDict in plugins.items():
-            moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
-            schedulers.append(
-                triggerable.Triggerable(name="%s_%s" % (moduleName, groupId),
-                                        builderNames=[
-                                            "%s_%s" % (moduleName, groupId)]))
 
-            forceSchedulerName = '%s%s_%s' % (
-            settings.FORCE_BUILDER_PREFIX, moduleName, groupId)
-            schedulers.append(
-                ForceScheduler(name=forceSchedulerName,
-                               builderNames=["%s_%s" % (moduleName, groupId)]))
+def getBuilderSchedulers(name):
+    return [triggerable.Triggerable(name=name, builderNames=[name]),
+            ForceScheduler(name='%s%s' % (settings.FORCE_BUILDER_PREFIX, name),
+                           builderNames=[name])]
 
-    else:
-        scipionSchedulerNames = [settings.SCIPION_INSTALL_PREFIX + groupId,
-                                 settings.SCIPION_TESTS_PREFIX + groupId,
-                                 settings.CLEANUP_PREFIX + groupId]
 
-        if settings.branchsDict[groupId].get(settings.DOCS_BUILD_ID, None) is not None:
-            scipionSchedulerNames.append("%s%s" % (settings.DOCS_PREFIX, groupId))
-        schedulers = []
-        for name in scipionSchedulerNames:
-            schedulers.append(triggerable.Triggerable(name=name,
-                                                      builderNames=[name]))
-            schedulers.append(ForceScheduler(name='%s%s' % (settings.FORCE_BUILDER_PREFIX, name),
-                                             builderNames=[name]))
-
-        plugins = {}
-        plugins.update(scipionPlugins)
-        plugins.update({"scipion-em-locscale": locscalePluginData})
-        for plugin, pluginDict in plugins.items():
-            moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
-            schedulers.append(triggerable.Triggerable(name="%s_%s" % (moduleName, groupId),
-                                                      builderNames=["%s_%s" % (moduleName, groupId)]))
+def getScipionSchedulers(groupId):
+    """ Schedulers of the builders of the group. Those of the plugins whose
+    entry didn't change, and the rest, are the ones of the last reconfig, so
+    that buildbot leaves them running """
+    scipionSchedulerNames = [settings.SCIPION_INSTALL_PREFIX + groupId,
+                             settings.SCIPION_TESTS_PREFIX + groupId,
+                             settings.CLEANUP_PREFIX + groupId]
 
-            forceSchedulerName = '%s%s_%s' % (settings.FORCE_BUILDER_PREFIX, moduleName, groupId)
-            schedulers.append(
-                ForceScheduler(name=forceSchedulerName,
-                               builderNames=["%s_%s" % (moduleName, groupId)]))
+    if settings.branchsDict[groupId].get(settings.DOCS_BUILD_ID, None) is not None:
+        scipionSchedulerNames.append("%s%s" % (settings.DOCS_PREFIX, groupId))
 
+    if groupId == settings.SDEVEL_GROUP_ID:
+        scipionSchedulerNames.append("%s%s" % (settings.WEBSITE_PREFIX, groupId))
+        scipionSchedulerNames.append("%s%s" % (settings.CHECK_PLUGINS_DIFF, groupId))
+
+    schedulers = []
+    for name in scipionSchedulerNames:
+        schedulers += configCache.get(('schedulers', name), None,
+                                      lambda: getBuilderSchedulers(name))
+
+    for plugin, pluginDict in installedPlugins(groupId).items():
+        moduleName = str(pluginDict.get("name", plugin.rsplit('-', 1)[-1]))
+        schedulers += cachedPluginConfig('schedulers', groupId, plugin,
+                                         lambda: getPluginSchedulers(groupId, moduleName,
+                                                                     pluginDict))
+
+    name = settings.DISK_JANITOR_PREFIX + groupId
+    schedulers += configCache.get(('schedulers', name), None,
+                                  lambda: getBuilderSchedulers(name))
+
+    name = settings.TEST_SHARD_PREFIX + groupId
+    schedulers += configCache.get(('schedulers', name), None,
+                                  lambda: [triggerable.Triggerable(name=name,
+                                                                   builderNames=[name])])
     return schedulers
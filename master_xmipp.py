@@ -9,14 +9,16 @@ from buildbot.schedulers.forcesched import ForceScheduler
 from buildbot.steps.source.git import Git
 
 import settings
-from settings import (WORKER, XMIPP_SLACK_CHANNEL,
+from settings import (XMIPP_SLACK_CHANNEL,
                       XMIPP_TESTS, XMIPP_BUNDLE_TESTS, EMAN212,
                       FORCE_BUILDER_PREFIX, PROD_GROUP_ID,
                       LD_LIBRARY_PATH, timeOutShort, SDEVEL_GROUP_ID,
                       SPROD_GROUP_ID, PROD_LD_LIBRARY_PATH, PROD_SCIPION_CMD,
-                      XMIPP_INSTALL_PREFIX, XMIPP_DOCS_PREFIX, WORKER1)
-from common_utils import GenerateStagesCommand, changeConfVar
-from master_scipion import pluginFactory, xmippPluginData, ScipionCommandStep
+                      XMIPP_INSTALL_PREFIX, XMIPP_DOCS_PREFIX)
+from common_utils import (GenerateStagesCommand, changeConfVar, nextWorker,
+                          canStartBuild, downloadWorkerScript, cachedInstallbCmd)
+from master_scipion import (pluginFactory, getPluginRegistry, PROD_PLUGINS,
+                            ScipionCommandStep)
 
 
 # #############################################################################
@@ -69,9 +71,13 @@ def xmippBundleFactory(groupId):
                               pattern='./xmipp test (.*)',
                               rootName=settings.XMIPP_CMD,
                               timeout=settings.timeOutExecute,
+                              groupId=groupId,
                               blacklist=settings.SCIPION_TESTS_BLACKLIST,
+                              discoveredProperty='XMIPP_TESTS_SHOW',
                               env=util.Property('env')))
 
+    # same discovery, with the functions pattern
+
     xmippTestSteps.addStep(
         GenerateStagesCommand(command=["bash", "-c", command],
                               name="Generate test stages for Xmipp functions",
@@ -81,7 +87,9 @@ def xmippBundleFactory(groupId):
                               timeout=settings.timeOutExecute,
                               pattern='xmipp_test_(.*)',
                               rootName=settings.XMIPP_CMD,
+                              groupId=groupId,
                               blacklist=settings.SCIPION_TESTS_BLACKLIST,
+                              discovered=util.Property('XMIPP_TESTS_SHOW'),
                               env=util.Property('env')))
 
     return xmippTestSteps
@@ -103,7 +111,9 @@ def xmippTestFactory(groupId):
                           "xmipp3.tests.test_protocols_gpuCorr_semiStreaming.TestGpuCorrSemiStreaming",
                           "xmipp3.tests.test_protocols_gpuCorr_fullStreaming.TestGpuCorrFullStreaming"]
 
-    envs = {gpucorrcls: EMAN212 for gpucorrcls in gpucorrclassifiers}
+    # gpuCorr tests need eman 2.12 and a GPU
+    envs = {gpucorrcls: dict(EMAN212, CUDA_VISIBLE_DEVICES=settings.GPU_SLOT)
+            for gpucorrcls in gpucorrclassifiers}
 
     if groupId == PROD_GROUP_ID:
         scipionCmd = "./scipion"
@@ -116,19 +126,21 @@ def xmippTestFactory(groupId):
                                   stagePrefix=[scipionCmd, "test"],
                                   targetTestSet='xmipp3',
                                   timeout=settings.timeOutExecute,
+                                  groupId=groupId,
                                   blacklist=settings.SCIPION_TESTS_BLACKLIST,
                                   stageEnvs=envs))
 
     else:
 
-        deepLearningToolkitCmd = ["bash", "-c", "./scipion3 installb deepLearningToolkit"]
+        xmippTestSteps.addStep(downloadWorkerScript('emcache.py'))
+        deepLearningToolkitCmd = cachedInstallbCmd('./scipion3', 'deepLearningToolkit', ())
         xmippTestSteps.addStep(ShellCommand(command=deepLearningToolkitCmd,
                                             name='Installing deepLearningToolkit',
                                             description='Installing deepLearningToolkit',
                                             descriptionDone='Installing deepLearningToolkit',
                                             timeout=timeOutShort))
 
-        nmaCmd = ["bash", "-c", "./scipion3 installb nma"]
+        nmaCmd = cachedInstallbCmd('./scipion3', 'nma', ())
         xmippTestSteps.addStep(ShellCommand(command=nmaCmd,
                                             name='Installing nma',
                                             description='Installing nma',
@@ -147,6 +159,7 @@ def xmippTestFactory(groupId):
                 targetTestSet='xmipp3',
                 rootName='scipion3',
                 timeout=settings.timeOutExecute,
+                groupId=groupId,
                 blacklist=settings.SCIPION_TESTS_BLACKLIST,
                 stageEnvs=envs))
 
@@ -270,7 +283,9 @@ def getXmippBuilders(groupId):
             extraBinaries = ['xmippSrc', 'deepLearningToolkit', 'nma']
         builders.append(
             BuilderConfig(name=XMIPP_INSTALL_PREFIX + groupId,
-                          workernames=[WORKER],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           tags=[groupId],
                           factory=pluginFactory(groupId, 'scipion-em-xmipp', shortname='xmipp3', doTest=False,
                                                 extraBinaries=extraBinaries),
@@ -282,10 +297,13 @@ def getXmippBuilders(groupId):
         builders.append(
             BuilderConfig(name="%s%s" % (XMIPP_TESTS, groupId),
                           tags=[groupId, XMIPP_TESTS],
-                          workernames=[WORKER],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=pluginFactory(groupId,'scipion-em-xmipp', shortname='xmipp3', doInstall=False),
                           workerbuilddir=groupId,
-                          properties={'slackChannel': xmippPluginData.get('slackChannel', "")},
+                          properties={'slackChannel': getPluginRegistry().entry(
+                              PROD_PLUGINS, 'scipion-em-xmipp').get('slackChannel', "")},
                           env=env)
         )
 
@@ -303,11 +321,12 @@ def getXmippBuilders(groupId):
             env['EM_ROOT'] = settings.SPROD_EM_ROOT
             env['LD_LIBRARY_PATH'] = PROD_LD_LIBRARY_PATH
 
-        worker = WORKER if groupId == PROD_GROUP_ID else WORKER1
         builders.append(
             BuilderConfig(name=XMIPP_TESTS + groupId,
                           tags=[groupId],
-                          workernames=[worker],
+                          workernames=settings.WORKER_POOLS[groupId],
+                          nextWorker=nextWorker,
+                          canStartBuild=canStartBuild,
                           factory=xmippTestFactory(groupId),
                           workerbuilddir=groupId,
                           properties=props,
@@ -320,7 +339,9 @@ def getXmippBuilders(groupId):
                 builders.append(
                     BuilderConfig(name="%s%s" % (settings.XMIPP_DOCS_PREFIX, groupId),
                                   tags=["xmippDocs", groupId],
-                                  workernames=[settings.WORKER1],
+                                  workernames=settings.WORKER_POOLS[groupId],
+                                  nextWorker=nextWorker,
+                                  canStartBuild=canStartBuild,
                                   factory=docsFactory(groupId),
                                   workerbuilddir=groupId,
                                   properties={
@@ -333,7 +354,9 @@ def getXmippBuilders(groupId):
             builders.append(
                 BuilderConfig(name=XMIPP_BUNDLE_TESTS + groupId,
                               tags=[groupId],
-                              workernames=[WORKER1],
+                              workernames=settings.WORKER_POOLS[groupId],
+                              nextWorker=nextWorker,
+                              canStartBuild=canStartBuild,
                               factory=xmippBundleFactory(groupId),
                               workerbuilddir=groupId,
                               env=bundleEnv,
@@ -0,0 +1,138 @@
+""" DependencyTrigger with fake schedulers, run with
+python -m unittest discover tests (from the master folder) """
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buildbot.process import buildstep  # noqa: E402
+from buildbot.process.results import CANCELLED, SUCCESS  # noqa: E402
+from twisted.internet import defer  # noqa: E402
+
+import common_utils  # noqa: E402
+
+BUILDBOT_URL = 'http://buildbot/'
+
+
+class FakeScheduler(object):
+
+    def __init__(self, name, triggered, onTrigger=None):
+        self.name = name
+        self.triggered = triggered
+        self.onTrigger = onTrigger
+        self.results = defer.Deferred()
+
+    def trigger(self, waited_for, sourcestamps=None, set_props=None,
+                parent_buildid=None, parent_relationship=None):
+        self.triggered.append(self.name)
+        if self.onTrigger is not None:
+            self.onTrigger()
+        brid = len(self.triggered)
+        return defer.succeed((brid, {1: brid})), self.results
+
+    def finish(self):
+        self.results.callback((SUCCESS, {1: 0}))
+
+
+class FakeConfig(object):
+    buildbotURL = BUILDBOT_URL
+
+
+class FakeMaster(object):
+    config = FakeConfig()
+
+
+class FakeBuild(object):
+    buildid = 1
+    master = FakeMaster()
+
+
+class DependencyTriggerTest(unittest.TestCase):
+
+    def makeTrigger(self, names, onTrigger=None, **kwargs):
+        """ Step of a DependencyTrigger as built for a build, with the
+        schedulers, the urls and the build results faked """
+        self.triggered = []
+        self.urls = []
+        self.schedulers = {name: FakeScheduler(name, self.triggered, onTrigger)
+                           for name in names}
+        trigger = buildstep.create_step_from_step_or_factory(
+            common_utils.DependencyTrigger(schedulerNames=names, waitForFinish=True,
+                                           **kwargs))
+        trigger.build = FakeBuild()
+        trigger.master = trigger.build.master
+        trigger.getSchedulerByName = self.schedulers.get
+        trigger.prepareSourcestampListForTrigger = lambda: []
+        trigger.addURL = lambda name, url: defer.succeed(self.urls.append((name, url)))
+        trigger._add_results = lambda brid: None
+        trigger.updateSummary = lambda: None
+        trigger.addBuildUrls = lambda rclist: defer.succeed(None)
+        return trigger
+
+    def test_parallel(self):
+        trigger = self.makeTrigger(['a', 'b'], maxParallel=2)
+        d = trigger.run()
+        # both triggered before any of them finishes
+        self.assertEqual(self.triggered, ['a', 'b'])
+        self.assertFalse(d.called)
+        self.schedulers['b'].finish()
+        self.schedulers['a'].finish()
+        self.assertTrue(d.called)
+        self.assertEqual(d.result, SUCCESS)
+        self.assertEqual(self.urls, [('a #1', BUILDBOT_URL + '#/buildrequests/1'),
+                                     ('b #2', BUILDBOT_URL + '#/buildrequests/2')])
+
+    def test_interrupt(self):
+        trigger = self.makeTrigger(['a', 'b'], maxParallel=2,
+                                   onTrigger=lambda: setattr(trigger, 'ended', True))
+        d = trigger.run()
+        # interrupted while triggering a, b is not triggered
+        self.assertEqual(self.triggered, ['a'])
+        self.assertEqual(d.result, CANCELLED)
+
+    def test_dependencies(self):
+        trigger = self.makeTrigger(['a', 'b'], maxParallel=2, dependencies={'b': ['a']})
+        d = trigger.run()
+        self.assertEqual(self.triggered, ['a'])
+        self.schedulers['a'].finish()
+        self.assertEqual(self.triggered, ['a', 'b'])
+        self.schedulers['b'].finish()
+        self.assertEqual(d.result, SUCCESS)
+
+    def test_max_parallel(self):
+        trigger = self.makeTrigger(['a', 'b', 'c'], maxParallel=2)
+        d = trigger.run()
+        self.assertEqual(self.triggered, ['a', 'b'])
+        self.schedulers['a'].finish()
+        self.assertEqual(self.triggered, ['a', 'b', 'c'])
+        self.schedulers['b'].finish()
+        self.schedulers['c'].finish()
+        self.assertEqual(d.result, SUCCESS)
+
+    def test_pipeline_installs(self):
+        trigger = self.makeTrigger(['a', 'b', 'c', 'd'], maxParallel=3,
+                                   dependencies={'d': ['a']}, pipelineInstalls=True)
+        d = trigger.run()
+        # one install at a time
+        self.assertEqual(self.triggered, ['a'])
+        common_utils.installPipeline.done(trigger.getInstallKey('a'))
+        self.assertEqual(self.triggered, ['a', 'b'])
+        common_utils.installPipeline.done(trigger.getInstallKey('b'))
+        self.assertEqual(self.triggered, ['a', 'b', 'c'])
+        common_utils.installPipeline.done(trigger.getInstallKey('c'))
+        # the install slot counts in maxParallel
+        self.assertEqual(self.triggered, ['a', 'b', 'c'])
+        self.schedulers['b'].finish()
+        # d only needs a installed, not finished
+        self.assertEqual(self.triggered, ['a', 'b', 'c', 'd'])
+        # a build ending without PluginInstalled (e.g. a failed install)
+        self.schedulers['d'].finish()
+        self.schedulers['a'].finish()
+        self.schedulers['c'].finish()
+        self.assertEqual(d.result, SUCCESS)
+        self.assertEqual(common_utils.installPipeline.waiting, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
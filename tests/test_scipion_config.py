@@ -0,0 +1,48 @@
+""" ScipionConfigStep run in a fake build, run with
+python -m unittest discover tests (from the master folder) """
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# before buildbot.test, which turns the warnings into errors
+import common_utils  # noqa: E402
+from buildbot.process.results import SUCCESS  # noqa: E402
+from buildbot.test.reactor import TestReactorMixin  # noqa: E402
+from buildbot.test.steps import ExpectShell, TestBuildStepMixin  # noqa: E402
+from twisted.trial import unittest  # noqa: E402
+
+CONFIG_COMMAND = ['./scipion3', 'config', '--overwrite']
+
+
+class ScipionConfigStepTest(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setup_test_reactor()
+        return self.setup_test_build_step()
+
+    def catShell(self, path, write=None):
+        return ExpectShell(workdir='wkdir',
+                           command=['bash', '-c', 'cat %s%s' % ('> ' if write else '', path)],
+                           initial_stdin=write)
+
+    def test_generate_config(self):
+        self.setup_step(common_utils.ScipionConfigStep(
+            configs=[('config/scipion.conf', {'A': '1'})], command=CONFIG_COMMAND,
+            name='Config'))
+        self.expect_commands(
+            self.catShell('config/scipion.conf').exit(1),
+            ExpectShell(workdir='wkdir', command=CONFIG_COMMAND).exit(0),
+            self.catShell('config/scipion.conf').update('stdout', 'B = 2\n').exit(0),
+            self.catShell('config/scipion.conf', write='B = 2\nA = 1\n').exit(0))
+        self.expect_outcome(result=SUCCESS)
+        return self.run_step()
+
+    def test_config_unchanged(self):
+        self.setup_step(common_utils.ScipionConfigStep(
+            configs=[('config/scipion.conf', {'A': '1'})], command=CONFIG_COMMAND,
+            name='Config'))
+        self.expect_commands(
+            self.catShell('config/scipion.conf').update('stdout', 'A = 1\n').exit(0))
+        self.expect_outcome(result=SUCCESS)
+        return self.run_step()
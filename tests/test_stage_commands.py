@@ -0,0 +1,183 @@
+""" Test stage steps run in a fake build, run with
+python -m unittest discover tests (from the master folder) """
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# before buildbot.test, which turns the warnings into errors
+import common_utils  # noqa: E402
+from buildbot.process.results import FAILURE, SUCCESS, WARNINGS  # noqa: E402
+from buildbot.test.reactor import TestReactorMixin  # noqa: E402
+from buildbot.test.steps import ExpectShell, TestBuildStepMixin  # noqa: E402
+from twisted.internet import defer  # noqa: E402
+from twisted.trial import unittest  # noqa: E402
+
+STAGE = 'pwem.tests.test_a.TestA'
+STAGE_COMMAND = ['./scipion3', 'test', STAGE]
+BATCH = ['pwem.tests.test_a.TestA', 'pwem.tests.test_b.TestB']
+BATCH_COMMAND = ['./scipion3', 'test'] + BATCH
+DISCOVERY_COMMAND = ['./scipion3', 'test', '--show', '--grep', 'pwem', '--mode', 'onlyclasses']
+
+
+class StageCommandTest(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setup_test_reactor()
+        # the stage stores are json files in the master basedir
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        self.addCleanup(os.chdir, cwd)
+        for store in [common_utils.stageHistory, common_utils.stageMethods,
+                      common_utils.stageOutcomes, common_utils.stageDatasets,
+                      common_utils.discoveryCache]:
+            self.patch(store, '_data', None)
+        return self.setup_test_build_step()
+
+    def test_prefetch_then_stage(self):
+        self.setup_step(common_utils.TestStageCommand(groupId='devel', command=STAGE_COMMAND,
+                                                      prefetch=['mda'], name='TestA'))
+        self.expect_commands(
+            ExpectShell(workdir='wkdir',
+                        command=common_utils.datasetsCmd('prefetch', ['mda']),
+                        timeout=common_utils.settings.timeOutShort)
+            .exit(0),
+            ExpectShell(workdir='wkdir', command=STAGE_COMMAND)
+            .exit(1))
+        self.expect_outcome(result=FAILURE)
+        return self.run_step()
+
+    def test_stage_without_prefetch(self):
+        self.setup_step(common_utils.TestStageCommand(groupId='devel', command=STAGE_COMMAND,
+                                                      name='TestA'))
+        self.expect_commands(
+            ExpectShell(workdir='wkdir', command=STAGE_COMMAND)
+            .exit(0))
+        self.expect_outcome(result=SUCCESS)
+        return self.run_step()
+
+    def setupBatch(self, **kwargs):
+        self.setup_step(common_utils.TestStageCommand(groupId='devel', command=BATCH_COMMAND,
+                                                      stages=BATCH, name='Batch', **kwargs))
+        self.added = []
+        self.build.addStepsAfterCurrentStep = self.added.extend
+
+    def addedResults(self):
+        return [(step.name, step.result) for step in self.added]
+
+    @defer.inlineCallbacks
+    def test_retry_flaky_batch(self):
+        for ok in [True, False, True]:
+            common_utils.stageOutcomes.addOutcome('devel', BATCH[0], ok)
+        self.setupBatch()
+        self.expect_commands(
+            ExpectShell(workdir='wkdir', command=BATCH_COMMAND)
+            .stdout('[ FAILED ] TestA.test1\n[ RUN   OK ] TestB.test1\n')
+            .exit(1),
+            ExpectShell(workdir='wkdir', command=BATCH_COMMAND)
+            .log('retry', stdout='[ RUN   OK ] TestA.test1\n[ RUN   OK ] TestB.test1\n')
+            .exit(0))
+        self.expect_outcome(result=WARNINGS)
+        yield self.run_step()
+        # TestA only passed on the retry
+        self.assertEqual(self.addedResults(), [(BATCH[0], WARNINGS), (BATCH[1], SUCCESS)])
+
+    @defer.inlineCallbacks
+    def test_quarantined_batch(self):
+        self.setupBatch(quarantined=True)
+        self.expect_commands(
+            ExpectShell(workdir='wkdir', command=BATCH_COMMAND)
+            .stdout('[ FAILED ] TestA.test1\n[ RUN   OK ] TestB.test1\n')
+            .exit(1))
+        self.expect_outcome(result=WARNINGS)
+        yield self.run_step()
+        self.assertEqual(self.addedResults(), [(BATCH[0], WARNINGS), (BATCH[1], SUCCESS)])
+
+    def setupGenerateStages(self, **kwargs):
+        self.setup_step(common_utils.GenerateStagesCommand(
+            command=DISCOVERY_COMMAND, groupId='devel', targetTestSet='pwem',
+            rootName='pwem', stagePrefix=['./scipion3', 'test'], name='Generate', **kwargs))
+        self.added = []
+        self.build.addStepsAfterCurrentStep = self.added.extend
+
+    @defer.inlineCallbacks
+    def test_discovery_cache(self):
+        self.setupGenerateStages(discoveryCache=True)
+        self.build.setProperty('PLUGIN_COMMIT', 'abc', 'test')
+        self.expect_commands(
+            ExpectShell(workdir='wkdir', command=common_utils.envHashCmd('./scipion3'),
+                        timeout=common_utils.timeOutExecute)
+            .log('environment hash', stdout='envhash\n')
+            .exit(0),
+            ExpectShell(workdir='wkdir', command=DISCOVERY_COMMAND,
+                        timeout=common_utils.timeOutExecute)
+            .stdout('test %s\n' % STAGE)
+            .exit(0))
+        self.expect_outcome(result=SUCCESS)
+        yield self.run_step()
+        name = 'devel ' + ' '.join(DISCOVERY_COMMAND)
+        self.assertEqual(common_utils.discoveryCache.get(name, 'abc envhash '),
+                         ('test %s\n' % STAGE, True))
+        self.assertEqual([step.get_step_factory().kwargs['command'] for step in self.added],
+                         [STAGE_COMMAND])
+
+
+class ShardTriggerTest(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setup_test_reactor()
+        return self.setup_test_build_step()
+
+    @defer.inlineCallbacks
+    def test_shards_in_parent_worker(self):
+        self.setup_step(common_utils.ShardTrigger(schedulerNames=['Test_shard_devel'],
+                                                  shards=[['a'], ['b']], waitForFinish=True,
+                                                  workdir='scipion'))
+        for prop, value in [('workername', 'worker1'), ('SCIPION_HOME', '/devel/scipion'),
+                            ('BUILD_GROUP', 'devel'), ('BUILD_GROUP_HOME', '/devel')]:
+            self.build.setProperty(prop, value, 'test')
+        schedulers = yield self.get_nth_step(0).getSchedulersAndProperties()
+        self.assertEqual([sch['props_to_set']['SHARD_STAGES'] for sch in schedulers],
+                         [['a'], ['b']])
+        for sch in schedulers:
+            props = sch['props_to_set']
+            self.assertEqual(props['ORCHESTRATOR_WORKER'], 'worker1')
+            self.assertEqual(props['SCIPION_HOME'], '/devel/scipion')
+            self.assertEqual(props['BUILD_GROUP'], 'devel')
+            self.assertEqual(props['SHARD_WORKDIR'], 'scipion')
+
+
+class CheckPluginInstallTest(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setup_test_reactor()
+        return self.setup_test_build_step()
+
+    def checkInstall(self, installedCommit):
+        self.setup_step(common_utils.CheckPluginInstall(
+            'scipion-em-a', 'https://github.com/x/scipion-em-a.git', scipionCmd='./scipion3'))
+        self.build.setProperty('DISCOVERED_TESTS', 'test a.tests.test_a.TestA', 'test')
+        command = ('git ls-remote https://github.com/x/scipion-em-a.git HEAD | head -1 | cut -f1 ; '
+                   'if ./scipion3 python -m pip show scipion-em-a > /dev/null 2>&1 ; then '
+                   'grep "^scipion-em-a " %s 2>/dev/null | cut -d" " -f2 ; fi'
+                   % common_utils.settings.PLUGIN_INSTALL_LEDGER)
+        self.expect_commands(
+            ExpectShell(workdir='wkdir', command=['bash', '-c', command])
+            .stdout('abc\n' + installedCommit)
+            .exit(0))
+        self.expect_outcome(result=SUCCESS)
+        return self.run_step()
+
+    @defer.inlineCallbacks
+    def test_unchanged_keeps_discovery(self):
+        yield self.checkInstall('abc\n')
+        self.assertEqual(self.get_nth_step(0).getProperty('PLUGIN_INSTALL_SKIPPED'), True)
+        self.assertEqual(self.get_nth_step(0).getProperty('DISCOVERED_TESTS'),
+                         'test a.tests.test_a.TestA')
+
+    @defer.inlineCallbacks
+    def test_reinstall_drops_discovery(self):
+        yield self.checkInstall('old\n')
+        self.assertEqual(self.get_nth_step(0).getProperty('PLUGIN_INSTALL_SKIPPED'), False)
+        self.assertEqual(self.get_nth_step(0).getProperty('DISCOVERED_TESTS'), None)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+""" Worker side cache of the conda environments created by installscipion.
+
+Instead of removing the environment in the clean up and letting installscipion
+solve it again, the environment is saved after a good install as a packed
+snapshot, together with its lockfile ('conda list --explicit --md5' plus the
+non editable 'pip freeze'). Snapshots are keyed by a hash of the lockfile, so
+a new solve with other packages makes a new snapshot, and they record the
+spec they were installed with: the installscipion command line and the
+scipion-installer version of its lockfile. The clean up exports the lockfile
+of the current environment to get its spec; when it finds a snapshot of that
+spec solved less than --max-age days ago, the environment is restored from it
+(the newest one); without snapshot but with a lockfile, it is created from the
+lockfile, which needs no solve; otherwise it is removed as before, and
+installscipion solves it again. A missing environment is left to
+installscipion.
+
+Usage:
+    condaenv.py save --cache DIR --env develEnv --conda-init CMD \\
+        --spec 'installscipion ...' [--keep N]
+    condaenv.py reset --cache DIR --env develEnv --conda-init CMD \\
+        --spec 'installscipion ...' [--max-age DAYS]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+
+def conda(args, condaInit, **kwargs):
+    """ Run a conda command after the conda initialization """
+    cmd = '%s ; conda %s' % (condaInit, args)
+    print(cmd)
+    sys.stdout.flush()
+    return subprocess.call(['bash', '-c', cmd], **kwargs)
+
+
+def condaOutput(args, condaInit):
+    return subprocess.check_output(['bash', '-c', '%s ; conda %s' % (condaInit, args)],
+                                   universal_newlines=True)
+
+
+def envPrefix(envName, condaInit):
+    """ Path of the environment, None if it does not exist """
+    envs = json.loads(condaOutput('env list --json', condaInit))['envs']
+    for prefix in envs:
+        if os.path.basename(prefix) == envName:
+            return prefix
+    return None
+
+
+def envPython(prefix):
+    return os.path.join(prefix, 'bin', 'python')
+
+
+def installerVersion(pipFile):
+    """ scipion-installer version in the pip freeze of a lockfile, '' if
+    not found """
+    with open(pipFile) as f:
+        for line in f:
+            name, _, version = line.strip().partition('==')
+            if name.lower().replace('_', '-') == 'scipion-installer':
+                return version
+    return ''
+
+
+def specKey(spec, pipFile):
+    return hashlib.sha256(('%s\n%s' % (spec, installerVersion(pipFile)))
+                          .encode()).hexdigest()[:16]
+
+
+def fileHash(*paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def tarCompressor():
+    return ['-I', 'pigz'] if shutil.which('pigz') else ['-z']
+
+
+class EnvCache(object):
+    """ Files of an environment snapshot in the cache, key being the hash of
+        its lockfile: <env>-<key>.json (prefix, spec, solved and last use
+        times), <env>-<key>.lock (conda explicit), <env>-<key>.pip (pip
+        freeze) and <env>-<key>.tar.gz (packed env). <env>.restored has the
+        key of the snapshot the environment was last restored from. """
+
+    def __init__(self, path, envName, key=None):
+        self.path = path
+        self.envName = envName
+        self.base = os.path.join(path, '%s-%s' % (envName, key))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @classmethod
+    def latest(cls, path, envName, spec, maxAge):
+        """ Newest snapshot of the spec solved less than maxAge days ago """
+        found = []
+        for cache in cls.all(path, envName):
+            meta = cache.meta()
+            if (meta.get('spec') == spec
+                    and time.time() - meta.get('solved', 0) < maxAge * 24 * 3600):
+                found.append((meta['time'], cache.base, cache))
+        return max(found)[2] if found else None
+
+    @classmethod
+    def all(cls, path, envName):
+        metaFiles = glob.glob(os.path.join(path, envName + '-*.json'))
+        return [cls(path, envName, f[:-len('.json')].rsplit('-', 1)[1])
+                for f in metaFiles]
+
+    @property
+    def key(self):
+        return self.base.rsplit('-', 1)[1]
+
+    def file(self, ext):
+        return self.base + ext
+
+    def hasSnapshot(self):
+        return all(os.path.exists(self.file(ext))
+                   for ext in ['.json', '.tar.gz'])
+
+    def hasLock(self):
+        return all(os.path.exists(self.file(ext))
+                   for ext in ['.json', '.lock', '.pip'])
+
+    def meta(self):
+        with open(self.file('.json')) as f:
+            return json.load(f)
+
+    def writeMeta(self, meta):
+        with open(self.file('.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def restoredKey(self):
+        """ Key of the snapshot the environment was restored from, if any """
+        try:
+            with open(os.path.join(self.path, self.envName + '.restored')) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def setRestored(self, key):
+        restored = os.path.join(self.path, self.envName + '.restored')
+        if key is None:
+            if os.path.exists(restored):
+                os.remove(restored)
+            return
+        with open(restored, 'w') as f:
+            f.write(key)
+
+    def export(self, prefix, condaInit):
+        """ Write the lockfile of the environment in this entry and return the
+        entry of its hash, None on error """
+        with open(self.file('.lock'), 'w') as f:
+            if conda('list -p %s --explicit --md5' % prefix, condaInit,
+                     stdout=f) != 0:
+                return None
+        try:
+            freeze = subprocess.check_output(
+                [envPython(prefix), '-m', 'pip', 'freeze', '--exclude-editable'],
+                universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        with open(self.file('.pip'), 'w') as f:
+            # conda packages are already in the explicit list
+            f.writelines(line + '\n' for line in freeze.splitlines()
+                         if ' @ file://' not in line)
+        return EnvCache(self.path, self.envName,
+                        fileHash(self.file('.lock'), self.file('.pip')))
+
+    def remove(self):
+        for f in glob.glob(self.base + '.*'):
+            os.remove(f)
+
+    def save(self, prefix, spec, tmp):
+        """ Move the exported lockfile of tmp here and pack the environment """
+        print('Packing %s' % prefix)
+        sys.stdout.flush()
+        rc = subprocess.call(['tar'] + tarCompressor() +
+                             ['-cf', self.file('.tar.gz.tmp'),
+                              '-C', os.path.dirname(prefix),
+                              os.path.basename(prefix)])
+        if rc != 0:
+            return rc
+        os.rename(self.file('.tar.gz.tmp'), self.file('.tar.gz'))
+        for ext in ['.lock', '.pip']:
+            os.rename(tmp.file(ext), self.file(ext))
+        now = time.time()
+        self.writeMeta({'prefix': prefix, 'spec': spec, 'solved': now,
+                        'time': now})
+        return 0
+
+    def restore(self):
+        """ Unpack the snapshot in the environment prefix """
+        prefix = self.meta()['prefix']
+        print('Restoring %s from %s' % (prefix, self.file('.tar.gz')))
+        sys.stdout.flush()
+        shutil.rmtree(prefix, ignore_errors=True)
+        return subprocess.call(['tar'] + tarCompressor() +
+                               ['-xf', self.file('.tar.gz'),
+                                '-C', os.path.dirname(prefix)])
+
+    def create(self, condaInit):
+        """ Create the environment from the lockfile, without solving """
+        prefix = self.meta()['prefix']
+        shutil.rmtree(prefix, ignore_errors=True)
+        rc = conda('create -y -p %s --file %s' % (prefix, self.file('.lock')),
+                   condaInit)
+        if rc != 0:
+            return rc
+        return subprocess.call([os.path.join(prefix, 'bin', 'python'), '-m',
+                                'pip', 'install', '--no-deps', '-r',
+                                self.file('.pip')])
+
+    def prune(self, keep):
+        """ Remove the oldest snapshots of the environment """
+        metas = [(cache.meta()['time'], cache.base)
+                 for cache in EnvCache.all(self.path, self.envName)]
+        for _, base in sorted(metas, reverse=True)[keep:]:
+            print('Removing old snapshot %s' % base)
+            for f in glob.glob(base + '.*'):
+                os.remove(f)
+
+
+def save(args):
+    prefix = envPrefix(args.env, args.conda_init)
+    if prefix is None:
+        print('Environment %s not found' % args.env)
+        return 1
+    tmp = EnvCache(args.cache, args.env, 'tmp')
+    cache = tmp.export(prefix, args.conda_init)
+    if cache is None:
+        tmp.remove()
+        return 1
+    spec = specKey(args.spec, tmp.file('.pip'))
+    if cache.hasSnapshot():
+        print('Snapshot %s is up to date' % cache.base)
+        meta = cache.meta()
+        meta['spec'] = spec
+        meta['time'] = time.time()
+        if cache.restoredKey() != cache.key:
+            # installscipion solved it again, with the same result
+            meta['solved'] = meta['time']
+        cache.writeMeta(meta)
+        rc = 0
+    else:
+        rc = cache.save(prefix, spec, tmp)
+    tmp.remove()
+    cache.setRestored(None)
+    cache.prune(args.keep)
+    return rc
+
+
+def reset(args):
+    prefix = envPrefix(args.env, args.conda_init)
+    if prefix is None:
+        # no lockfile to know its spec, installscipion solves it
+        EnvCache(args.cache, args.env).setRestored(None)
+        print('Environment %s not found, nothing to restore' % args.env)
+        return 0
+    # spec of the current environment, from its lockfile
+    tmp = EnvCache(args.cache, args.env, 'tmp')
+    exported = tmp.export(prefix, args.conda_init) is not None
+    spec = specKey(args.spec, tmp.file('.pip')) if exported else None
+    tmp.remove()
+    cache = (EnvCache.latest(args.cache, args.env, spec, args.max_age)
+             if spec is not None else None)
+    if cache is not None:
+        if cache.hasSnapshot() and cache.restore() == 0:
+            cache.setRestored(cache.key)
+            return 0
+        if cache.hasLock() and cache.create(args.conda_init) == 0:
+            cache.setRestored(cache.key)
+            return 0
+    EnvCache(args.cache, args.env).setRestored(None)
+    print('No recent snapshot for %s, removing it' % args.env)
+    return conda('env remove -y -n %s' % args.env, args.conda_init)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    saveParser = subparsers.add_parser('save')
+    saveParser.add_argument('--keep', type=int, default=2,
+                            help='snapshots kept per environment')
+    resetParser = subparsers.add_parser('reset')
+    resetParser.add_argument('--max-age', type=float, default=7,
+                             help='days after which a snapshot is solved again')
+    for p in [saveParser, resetParser]:
+        p.add_argument('--cache', required=True)
+        p.add_argument('--env', required=True)
+        p.add_argument('--conda-init', required=True)
+        p.add_argument('--spec', required=True,
+                       help='installscipion command line')
+    args = parser.parse_args()
+    if args.action == 'save':
+        return save(args)
+    if args.action == 'reset':
+        return reset(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
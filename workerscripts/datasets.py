@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+""" Content addressed store of the scipion test datasets of a worker.
+
+Each dataset has a MANIFEST ('file md5' lines) next to its files in the test
+data url (as used by 'scipion testdata'). The store keeps every file once,
+by md5 (objects/ab/abcdef...), and the datasets in the tests folder
+(SCIPION_TESTS) are made of hardlinks to those objects, so identical files
+of several datasets (or versions of a dataset) are stored once. 'sync'
+downloads the missing files of the datasets in parallel, resuming partial
+downloads, checks their md5 before adding them to the store and links them
+in the tests folder. Files already there with the right md5 are adopted by
+the store instead of downloaded again. A new dataset only appears in the
+tests folder once it is complete. Datasets and objects are locked while
+they are synced, so that groups running at the same time never download
+the same data twice (the second one waits and then finds it).
+
+'prefetch' gets ready the datasets of the next test stages while the
+current one runs: the missing ones are synced, and the files of all of them
+are read ahead into the page cache (up to --cache GB). With --detach it
+returns at once and goes on in the background (log in the store).
+
+Usage:
+    datasets.py sync --store DIR --tests DIR --url URL [--jobs N] [--local] -- NAME [...]
+    datasets.py prefetch --store DIR --tests DIR --url URL [--jobs N] [--cache GB] \\
+        [--detach] -- NAME [...]
+    datasets.py verify --store DIR --tests DIR -- NAME [...]
+"""
+import argparse
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+MANIFEST = 'MANIFEST'
+CHUNK = 1024 * 1024
+RETRIES = 5
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def parseManifest(text):
+    files = []
+    for line in text.splitlines():
+        if line.strip():
+            fname, md5 = line.strip().split()
+            files.append((fname, md5))
+    return files
+
+
+def fetchManifest(url, name):
+    with urlopen('%s/%s/%s' % (url, name, MANIFEST), timeout=60) as response:
+        return response.read().decode()
+
+
+class Lock(object):
+    """ Exclusive flock of path while in the context """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+class DatasetStore(object):
+
+    def __init__(self, path, tests, url=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.tests = os.path.abspath(os.path.expanduser(tests))
+        self.url = url
+        self.copyWarned = False
+        for folder in [self.path, os.path.join(self.path, 'locks'), self.tests]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def objectPath(self, md5):
+        return os.path.join(self.path, 'objects', md5[:2], md5)
+
+    def download(self, name, fname, md5):
+        """ Download the file to the store, resuming from its .part """
+        target = self.objectPath(md5)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        part = target + '.part'
+        with Lock(target + '.lock'):
+            if os.path.exists(target):
+                # downloaded meanwhile by someone else
+                return 0
+            url = '%s/%s/%s' % (self.url, name, quote(fname))
+            for attempt in range(RETRIES):
+                offset = os.path.getsize(part) if os.path.exists(part) else 0
+                request = Request(url)
+                if offset:
+                    request.add_header('Range', 'bytes=%d-' % offset)
+                try:
+                    with urlopen(request, timeout=60) as response:
+                        mode = 'ab' if offset and response.status == 206 else 'wb'
+                        with open(part, mode) as f:
+                            for block in iter(lambda: response.read(CHUNK), b''):
+                                f.write(block)
+                except HTTPError as e:
+                    if e.code == 416:
+                        # nothing left to download
+                        pass
+                    elif e.code == 404:
+                        raise
+                    else:
+                        time.sleep(2 ** attempt)
+                        continue
+                except (URLError, OSError) as e:
+                    print('%s/%s: %s, resuming' % (name, fname, e))
+                    time.sleep(2 ** attempt)
+                    continue
+                if md5sum(part) == md5:
+                    os.chmod(part, 0o444)
+                    os.rename(part, target)
+                    return os.path.getsize(target)
+                print('%s/%s: wrong md5, downloading it again' % (name, fname))
+                os.remove(part)
+            raise IOError('Could not download %s/%s' % (name, fname))
+
+    def link(self, source, target):
+        """ Make target a hardlink of source (atomically) """
+        tmp = '%s.tmp%d' % (target, os.getpid())
+        try:
+            os.link(source, tmp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            if not self.copyWarned:
+                print('The store is not in the file system of the tests folder, copying')
+                self.copyWarned = True
+            shutil.copy2(source, tmp)
+        os.replace(tmp, target)
+
+    def adopt(self, path, md5):
+        """ Add to the store a file of the tests folder with the right md5 """
+        target = self.objectPath(md5)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with Lock(target + '.lock'):
+            if not os.path.exists(target):
+                try:
+                    os.link(path, target)
+                    os.chmod(target, 0o444)
+                except OSError:
+                    return False
+        return True
+
+    def sync(self, name, jobs):
+        with Lock(os.path.join(self.path, 'locks', name + '.lock')):
+            return self._sync(name, jobs)
+
+    def _sync(self, name, jobs):
+        manifestText = fetchManifest(self.url, name)
+        files = parseManifest(manifestText)
+        final = os.path.join(self.tests, name)
+        # a new dataset is built aside and only moved in place when complete
+        folder = final if os.path.isdir(final) else final + '.partial'
+        stats = {'linked': 0, 'adopted': 0, 'downloaded': 0, 'bytes': 0}
+
+        toDownload = {}
+        for fname, md5 in files:
+            path = os.path.join(folder, fname)
+            obj = self.objectPath(md5)
+            if os.path.exists(path) and os.path.exists(obj) and os.path.samefile(path, obj):
+                continue
+            if (not os.path.exists(obj) and os.path.isfile(path)
+                    and md5sum(path) == md5 and self.adopt(path, md5)):
+                stats['adopted'] += 1
+                continue
+            if not os.path.exists(obj):
+                toDownload[md5] = fname
+
+        with ThreadPoolExecutor(jobs) as pool:
+            futures = {md5: pool.submit(self.download, name, fname, md5)
+                       for md5, fname in toDownload.items()}
+            for md5, future in futures.items():
+                stats['bytes'] += future.result()
+                stats['downloaded'] += 1
+
+        for fname, md5 in files:
+            path = os.path.join(folder, fname)
+            obj = self.objectPath(md5)
+            if os.path.exists(path) and os.path.samefile(path, obj):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.link(obj, path)
+            stats['linked'] += 1
+
+        with open(os.path.join(folder, MANIFEST), 'w') as f:
+            f.write(manifestText)
+        if folder != final:
+            os.rename(folder, final)
+        print('%s: %d files, %d downloaded (%0.2f GB), %d adopted, %d linked'
+              % (name, len(files), stats['downloaded'], stats['bytes'] / 1024.0 ** 3,
+                 stats['adopted'], stats['linked']))
+
+    def prefetch(self, name, jobs):
+        """ Sync the dataset unless it is already in the tests folder """
+        with Lock(os.path.join(self.path, 'locks', name + '.lock')):
+            if not os.path.exists(os.path.join(self.tests, name, MANIFEST)):
+                self._sync(name, jobs)
+
+    def warm(self, name, budget):
+        """ Ask the kernel to read ahead the files of the dataset, up to
+        budget bytes. Return the bytes left. """
+        for root, dirs, files in os.walk(os.path.join(self.tests, name)):
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                size = os.path.getsize(path)
+                if size > budget:
+                    return budget
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+                budget -= size
+        return budget
+
+    def verify(self, name):
+        """ Check the md5 of the files of the dataset; the wrong ones are
+        removed (with their object) so that the next sync fetches them """
+        folder = os.path.join(self.tests, name)
+        manifest = os.path.join(folder, MANIFEST)
+        if not os.path.exists(manifest):
+            print('%s: not in %s' % (name, self.tests))
+            return False
+        with Lock(os.path.join(self.path, 'locks', name + '.lock')):
+            with open(manifest) as f:
+                files = parseManifest(f.read())
+            bad = 0
+            for fname, md5 in files:
+                path = os.path.join(folder, fname)
+                if os.path.isfile(path) and md5sum(path) == md5:
+                    continue
+                bad += 1
+                print('%s/%s: missing or wrong md5' % (name, fname))
+                obj = self.objectPath(md5)
+                for p in [path, obj]:
+                    if os.path.isfile(p) and md5sum(p) != md5:
+                        os.remove(p)
+        print('%s: %d files, %d wrong' % (name, len(files), bad))
+        return bad == 0
+
+
+def localDatasets(tests):
+    """ Datasets already in the tests folder (downloaded by the tests) """
+    tests = os.path.expanduser(tests)
+    if not os.path.isdir(tests):
+        return []
+    return sorted(name for name in os.listdir(tests)
+                  if os.path.exists(os.path.join(tests, name, MANIFEST)))
+
+
+def sync(args):
+    store = DatasetStore(args.store, args.tests, args.url)
+    names = list(args.names)
+    if args.local:
+        names += [name for name in localDatasets(args.tests) if name not in names]
+    failed = []
+    for name in names:
+        try:
+            store.sync(name, args.jobs)
+        except Exception as e:
+            print('%s: %s' % (name, e))
+            failed.append(name)
+        sys.stdout.flush()
+    if failed:
+        print('Datasets not synced: %s' % ' '.join(failed))
+        return 1
+    return 0
+
+
+def detach(logPath):
+    """ Go on in a background process (out of the session of the caller)
+    writing to logPath. Return False in the caller. """
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return False
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    log = os.open(logPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    for fd in [1, 2]:
+        os.dup2(log, fd)
+    return True
+
+
+def prefetch(args):
+    store = DatasetStore(args.store, args.tests, args.url)
+    if args.detach:
+        logPath = os.path.join(store.path, 'prefetch.log')
+        if not detach(logPath):
+            print('Prefetching %s in the background, log in %s'
+                  % (' '.join(args.names), logPath))
+            return 0
+        print('%s prefetch %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), ' '.join(args.names)))
+    budget = args.cache * 1024 ** 3
+    failed = []
+    # in the order they are needed
+    for name in args.names:
+        try:
+            store.prefetch(name, args.jobs)
+            budget = store.warm(name, budget)
+        except Exception as e:
+            print('%s: %s' % (name, e))
+            failed.append(name)
+        sys.stdout.flush()
+    if args.detach:
+        os._exit(1 if failed else 0)
+    return 1 if failed else 0
+
+
+def verify(args):
+    store = DatasetStore(args.store, args.tests)
+    names = args.names or localDatasets(args.tests)
+    results = [store.verify(name) for name in names]
+    return 0 if all(results) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    syncParser = subparsers.add_parser('sync')
+    syncParser.add_argument('--local', action='store_true',
+                            help='sync also the datasets already in the tests folder')
+    prefetchParser = subparsers.add_parser('prefetch')
+    prefetchParser.add_argument('--cache', type=float, default=8,
+                                help='GB read ahead into the page cache')
+    prefetchParser.add_argument('--detach', action='store_true',
+                                help='prefetch in the background')
+    for p in [syncParser, prefetchParser]:
+        p.add_argument('--url', required=True, help='test data url')
+        p.add_argument('--jobs', type=int, default=4, help='parallel downloads')
+    verifyParser = subparsers.add_parser('verify')
+    for p in [syncParser, prefetchParser, verifyParser]:
+        p.add_argument('--store', required=True)
+        p.add_argument('--tests', required=True, help='SCIPION_TESTS folder')
+        p.add_argument('names', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.action in ['sync', 'prefetch', 'verify'] and args.names and args.names[0] == '--':
+        args.names = args.names[1:]
+    if args.action == 'sync':
+        return sync(args)
+    if args.action == 'prefetch':
+        return prefetch(args)
+    if args.action == 'verify':
+        return verify(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
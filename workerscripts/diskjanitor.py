@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+""" Free disk in a worker evicting the least recently used build items.
+
+The items are folders given as paths or glob patterns: the trees of each
+group (scipion, scipion-em, xmipp-bundle...), the ScipionUserData test
+projects, the scratch and the CryoSPARC projects. Their last use is the
+newest of the times they were passed as --use and the modification times of
+the folder and its direct children. 'run' evicts items, least recently used
+first, until the file system of --path has --free GB available. Items passed
+as --use (those of the build running the janitor), items used in the last
+--min-age hours and items in another file system are never evicted. The
+state file keeps the last use and the size of the items (measured when they
+are evicted, or by 'status').
+
+Usage:
+    diskjanitor.py run --state FILE --path DIR --free GB [--min-age HOURS] \\
+        [--use DIR ...] [--dry-run] -- ITEM [ITEM ...]
+    diskjanitor.py status --state FILE -- ITEM [ITEM ...]
+"""
+import argparse
+import fcntl
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+
+EXIT_TARGET_MISSED = 2
+
+
+def folderSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                try:
+                    size += os.lstat(fp).st_size
+                except OSError:
+                    pass
+    return size
+
+
+def freeGb(path):
+    return shutil.disk_usage(path).free / 1024.0 ** 3
+
+
+def modificationTime(path):
+    """ Newest mtime of the folder and its direct children """
+    newest = os.stat(path).st_mtime
+    try:
+        for entry in os.scandir(path):
+            try:
+                newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+            except OSError:
+                pass
+    except OSError:
+        pass
+    return newest
+
+
+def expandItems(patterns):
+    items = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = os.path.abspath(path)
+            if os.path.isdir(path) and not os.path.islink(path) and path not in items:
+                items.append(path)
+    return items
+
+
+class JanitorState(object):
+    """ {'used': {path: time}, 'sizes': {path: [bytes, time]}}
+    Must be used as a context manager, it holds the state lock. """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def __enter__(self):
+        self.lockFile = open(self.path + '.lock', 'w')
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        self.data = {'used': {}, 'sizes': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.data = json.load(f)
+        return self
+
+    def __exit__(self, *args):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+        fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+
+    def use(self, path):
+        self.data['used'][path] = time.time()
+
+    def lastUse(self, path):
+        return max(self.data['used'].get(path, 0), modificationTime(path))
+
+    def measure(self, path):
+        size = folderSize(path)
+        self.data['sizes'][path] = [size, time.time()]
+        return size
+
+    def forget(self, path):
+        self.data['used'].pop(path, None)
+        self.data['sizes'].pop(path, None)
+
+    def prune(self):
+        """ Forget the items that don't exist anymore """
+        for key in ['used', 'sizes']:
+            for path in list(self.data[key]):
+                if not os.path.exists(path):
+                    del self.data[key][path]
+
+
+def isProtected(path, usedPaths):
+    """ Used paths, the folders containing them and their contents """
+    return any(path == used or path.startswith(used + os.sep) or
+               used.startswith(path + os.sep) for used in usedPaths)
+
+
+def formatItem(path, lastUse, size=None):
+    sizeText = '%8.1f GB' % (size / 1024.0 ** 3) if size is not None else '%11s' % '?'
+    return '%s %s  %s' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(lastUse)),
+                          sizeText, path)
+
+
+def run(args):
+    path = os.path.abspath(os.path.expanduser(args.path))
+    device = os.stat(path).st_dev
+    usedPaths = [os.path.abspath(os.path.expanduser(p)) for p in args.use]
+    minLastUse = time.time() - args.min_age * 3600
+    with JanitorState(args.state) as state:
+        for used in usedPaths:
+            if os.path.exists(used):
+                state.use(used)
+        state.prune()
+        free = freeGb(path)
+        print('%0.1f GB free in %s, target %0.1f GB' % (free, path, args.free))
+        if free >= args.free:
+            return 0
+
+        candidates = []
+        for item in expandItems(args.items):
+            if os.stat(item).st_dev != device or isProtected(item, usedPaths):
+                continue
+            lastUse = state.lastUse(item)
+            if lastUse < minLastUse:
+                candidates.append((lastUse, item))
+        candidates.sort()
+
+        for lastUse, item in candidates:
+            if free >= args.free:
+                break
+            size = state.measure(item)
+            print('Evicting %s' % formatItem(item, lastUse, size))
+            sys.stdout.flush()
+            if not args.dry_run:
+                shutil.rmtree(item, ignore_errors=True)
+                state.forget(item)
+                free = freeGb(path)
+            else:
+                free += size / 1024.0 ** 3
+
+    print('%0.1f GB free in %s%s' % (free, path, ' (dry run)' if args.dry_run else ''))
+    if free < args.free:
+        print('Target not met: the items left are in use or used in the last %s hours'
+              % args.min_age)
+        return EXIT_TARGET_MISSED
+    return 0
+
+
+def status(args):
+    with JanitorState(args.state) as state:
+        state.prune()
+        items = expandItems(args.items)
+        total = 0
+        for item in sorted(items, key=state.lastUse):
+            size = state.measure(item)
+            total += size
+            print(formatItem(item, state.lastUse(item), size))
+    print('%d items, %0.1f GB' % (len(items), total / 1024.0 ** 3))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    runParser = subparsers.add_parser('run')
+    runParser.add_argument('--path', required=True,
+                           help='folder in the file system to free')
+    runParser.add_argument('--free', type=float, required=True,
+                           help='free space target in GB')
+    runParser.add_argument('--min-age', type=float, default=12,
+                           help='hours since the last use before an item can be evicted')
+    runParser.add_argument('--use', nargs='*', default=[],
+                           help='folders used by this build, never evicted')
+    runParser.add_argument('--dry-run', action='store_true')
+    statusParser = subparsers.add_parser('status')
+    for p in [runParser, statusParser]:
+        p.add_argument('--state', required=True)
+        p.add_argument('items', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.action in ['run', 'status'] and args.items and args.items[0] == '--':
+        args.items = args.items[1:]
+    if args.action == 'run':
+        return run(args)
+    if args.action == 'status':
+        return status(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+""" Worker side cache of the EM packages installed by 'scipion installb'.
+
+The cache is shared by all the groups (devel, prod, support...) of a worker.
+It keeps a copy of the folders that each installb creates under software/em
+(their names carry the version, e.g. eman-2.12) and, before running installb
+again, restores them in the group software/em with reflinks (a copy when the
+file system has none), so installb finds the package already installed.
+Hardlinks are faster but the group trees then share the files with the cache,
+and a package writing in its own folder changes the cached copy as well.
+Folders created by a new version are added to the cache. Entries not used by
+any group are evicted, least recently used first, when the cache goes over its
+size budget.
+
+Usage:
+    emcache.py installb --cache DIR --em-root software/em --name eman-2.12 \\
+        [--budget GB] [--link reflink|hardlink] -- ./scipion3 installb eman-2.12 -j 8
+    emcache.py evict --cache DIR [--budget GB]
+"""
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+INDEX = 'index.json'
+LOCK = '.lock'
+
+
+def folderSize(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fp = os.path.join(root, f)
+            if not os.path.islink(fp):
+                size += os.lstat(fp).st_size
+    return size
+
+
+def linkTree(src, dst, link):
+    """ Copy the folder src as dst sharing the file contents when possible:
+    copy on write with reflink, same files with hardlink """
+    tmp = dst + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    args = ['-al'] if link == 'hardlink' else ['-a', '--reflink=auto']
+    if subprocess.call(['cp'] + args + [src, tmp]) != 0:
+        # e.g. hardlinks across file systems
+        shutil.rmtree(tmp, ignore_errors=True)
+        subprocess.check_call(['cp', '-a', src, tmp])
+    os.rename(tmp, dst)
+
+
+class EmCache(object):
+    """ Index of the cache:
+        {'entries': {folder: {'size', 'lastUsed', 'refs': [emRoots]}},
+         'packages': {installbName: [folders]}}
+    Must be used as a context manager, it holds the cache lock. """
+
+    def __init__(self, path, budget, link='reflink'):
+        self.path = path
+        self.budget = budget * 1024 ** 3
+        self.link = link
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __enter__(self):
+        self.lockFile = open(os.path.join(self.path, LOCK), 'w')
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        indexPath = os.path.join(self.path, INDEX)
+        self.index = {'entries': {}, 'packages': {}}
+        if os.path.exists(indexPath):
+            with open(indexPath) as f:
+                self.index = json.load(f)
+        return self
+
+    def __exit__(self, *args):
+        indexPath = os.path.join(self.path, INDEX)
+        with open(indexPath + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.rename(indexPath + '.tmp', indexPath)
+        fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+
+    @property
+    def entries(self):
+        return self.index['entries']
+
+    def addRef(self, folder, emRoot):
+        entry = self.entries[folder]
+        entry['lastUsed'] = time.time()
+        if emRoot not in entry['refs']:
+            entry['refs'].append(emRoot)
+
+    def restore(self, name, emRoot):
+        """ Link in emRoot the cached folders of the package """
+        restored = []
+        for folder in self.index['packages'].get(name, []):
+            target = os.path.join(emRoot, folder)
+            if folder in self.entries and not os.path.exists(target):
+                print('Restoring %s from the cache' % folder)
+                linkTree(os.path.join(self.path, folder), target, self.link)
+                restored.append(folder)
+            if folder in self.entries:
+                self.addRef(folder, emRoot)
+        return restored
+
+    def store(self, name, emRoot, folders):
+        """ Add to the cache the folders that installb created """
+        for folder in folders:
+            if folder not in self.entries:
+                print('Adding %s to the cache' % folder)
+                cached = os.path.join(self.path, folder)
+                linkTree(os.path.join(emRoot, folder), cached, self.link)
+                self.entries[folder] = {'size': folderSize(cached),
+                                        'lastUsed': time.time(),
+                                        'refs': []}
+            self.addRef(folder, emRoot)
+        self.index['packages'][name] = sorted(folders)
+
+    def evict(self):
+        """ Remove the least recently used folders that are not in use by
+        any emRoot until the cache is within its budget """
+        for entry in self.entries.values():
+            entry['refs'] = [emRoot for emRoot in entry['refs']
+                             if os.path.exists(emRoot)]
+        total = sum(entry['size'] for entry in self.entries.values())
+        unused = sorted([folder for folder, entry in self.entries.items()
+                         if not self.isReferenced(folder)],
+                        key=lambda folder: self.entries[folder]['lastUsed'])
+        for folder in unused:
+            if total <= self.budget:
+                break
+            print('Evicting %s from the cache' % folder)
+            shutil.rmtree(os.path.join(self.path, folder), ignore_errors=True)
+            total -= self.entries.pop(folder)['size']
+        for name, folders in list(self.index['packages'].items()):
+            if any(folder not in self.entries for folder in folders):
+                del self.index['packages'][name]
+
+    def isReferenced(self, folder):
+        return any(os.path.exists(os.path.join(emRoot, folder))
+                   for emRoot in self.entries[folder]['refs'])
+
+
+def listFolders(emRoot):
+    if not os.path.isdir(emRoot):
+        return set()
+    return set(f for f in os.listdir(emRoot)
+               if os.path.isdir(os.path.join(emRoot, f)) and not f.endswith('.tmp'))
+
+
+def installb(args):
+    emRoot = os.path.abspath(args.em_root)
+    with EmCache(args.cache, args.budget, args.link) as cache:
+        restored = cache.restore(args.name, emRoot)
+
+    before = listFolders(emRoot)
+    sys.stdout.flush()
+    rc = subprocess.call(args.command)
+    if rc != 0:
+        return rc
+
+    created = listFolders(emRoot) - before
+    with EmCache(args.cache, args.budget, args.link) as cache:
+        folders = created or (set(restored) |
+                              set(cache.index['packages'].get(args.name, [])))
+        cache.store(args.name, emRoot, [f for f in folders
+                                        if os.path.exists(os.path.join(emRoot, f))])
+        cache.evict()
+    return 0
+
+
+def evict(args):
+    with EmCache(args.cache, args.budget) as cache:
+        cache.evict()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    installbParser = subparsers.add_parser('installb')
+    installbParser.add_argument('--name', required=True)
+    installbParser.add_argument('--em-root', default='software/em')
+    installbParser.add_argument('--link', default='reflink',
+                                choices=['reflink', 'hardlink'])
+    installbParser.add_argument('command', nargs=argparse.REMAINDER)
+    evictParser = subparsers.add_parser('evict')
+    for p in [installbParser, evictParser]:
+        p.add_argument('--cache', required=True)
+        p.add_argument('--budget', type=float, default=100,
+                       help='size of the cache in GB')
+    args = parser.parse_args()
+    if args.action == 'installb':
+        if args.command and args.command[0] == '--':
+            args.command = args.command[1:]
+        return installb(args)
+    if args.action == 'evict':
+        return evict(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" Print a hash of the python environment of a scipion installation.
+
+It changes when a package is installed, upgraded or removed in the
+environment, when the commit of a package installed in editable mode
+changes, or when any of the --extra files changes. It is computed from file
+names, sizes and modification times, without starting the scipion python
+nor importing anything from it.
+
+Usage:
+    envhash.py --scipion ./scipion3 [--extra installed_plugins.txt ...]
+"""
+import argparse
+import glob
+import hashlib
+import os
+import sys
+
+
+def scipionPython(scipion):
+    """ Python of the scipion launcher shebang, None if it is not a path """
+    try:
+        with open(scipion) as f:
+            line = f.readline()
+    except (IOError, UnicodeDecodeError):
+        return None
+    python = line[2:].strip().split(' ')[0] if line.startswith('#!') else ''
+    if not os.path.isabs(python) or os.path.basename(python) == 'env':
+        return None
+    return python
+
+
+def gitHead(path):
+    """ Commit checked out in the git repository containing path """
+    while path and path != os.path.dirname(path):
+        head = os.path.join(path, '.git', 'HEAD')
+        if os.path.exists(head):
+            with open(head) as f:
+                ref = f.read().strip()
+            if ref.startswith('ref: '):
+                refFile = os.path.join(path, '.git', ref[5:])
+                if os.path.exists(refFile):
+                    with open(refFile) as f:
+                        return f.read().strip()
+            return ref
+        path = os.path.dirname(path)
+    return ''
+
+
+def editablePaths(sitePackages):
+    """ Source folders of the packages installed in editable mode """
+    paths = []
+    for link in glob.glob(os.path.join(sitePackages, '*.egg-link')):
+        with open(link) as f:
+            paths.append(f.readline().strip())
+    for pth in glob.glob(os.path.join(sitePackages, '*.pth')):
+        with open(pth) as f:
+            paths.extend(line.strip() for line in f
+                         if os.path.isabs(line.strip()))
+    return paths
+
+
+def envHash(scipion, extra):
+    h = hashlib.sha256()
+    python = scipionPython(scipion)
+    if python is not None:
+        prefix = os.path.dirname(os.path.dirname(os.path.realpath(python)))
+        for sitePackages in sorted(glob.glob(os.path.join(prefix, 'lib', 'python*',
+                                                          'site-packages'))):
+            for entry in sorted(os.listdir(sitePackages)):
+                st = os.lstat(os.path.join(sitePackages, entry))
+                h.update(('%s %d %d\n' % (entry, st.st_size, st.st_mtime)).encode())
+            for path in sorted(editablePaths(sitePackages)):
+                h.update(('%s %s\n' % (path, gitHead(path))).encode())
+    for path in [scipion] + extra:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scipion', default='./scipion3')
+    parser.add_argument('--extra', nargs='*', default=[])
+    args = parser.parse_args()
+    print(envHash(args.scipion, args.extra))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
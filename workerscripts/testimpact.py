@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+""" Worker side map from the source files of a plugin to its test modules.
+
+The map is built from the imports of the installed plugin package: a test
+module is affected by every module of the package it imports, directly or
+not. It is saved with the commit it was built from after a green full run,
+and used by later builds to select only the test modules affected by the
+files changed since that commit. When the map is missing or too old, or a
+change cannot be mapped (new modules, data files, setup.py...), ALL is
+printed and the full suite must be run.
+
+Usage:
+    testimpact.py map --scipion ./scipion3 --package relion --commit SHA \\
+        --map FILE
+    testimpact.py select --map FILE --repo URL --mirrors DIR --commit SHA \\
+        [--max-age DAYS]
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+
+ALL = 'ALL'
+TEST_PACKAGES = ('tests', 'test')
+# changes in these files don't affect the tests
+IGNORED_EXTENSIONS = ('.md', '.rst', '.txt', '.png', '.jpg', '.svg')
+IGNORED_PREFIXES = ('.github/', 'docs/', 'doc/', 'LICENSE', 'CHANGES')
+
+
+def packageDir(scipion, package):
+    out = subprocess.check_output(
+        [scipion, 'python', '-c',
+         'import os, %s; print(os.path.dirname(%s.__file__))' % (package, package)],
+        universal_newlines=True)
+    return out.strip().splitlines()[-1]
+
+
+def moduleFiles(pkgDir, package):
+    """ {module: path relative to the repository} of the package """
+    modules = {}
+    for root, dirs, files in os.walk(pkgDir):
+        dirs[:] = [d for d in dirs if not d.startswith(('.', '__'))]
+        for f in files:
+            if f.endswith('.py'):
+                rel = os.path.relpath(os.path.join(root, f), pkgDir)
+                parts = [package] + rel[:-3].split(os.sep)
+                if parts[-1] == '__init__':
+                    parts = parts[:-1]
+                modules['.'.join(parts)] = os.path.join(package, rel)
+    return modules
+
+
+def imports(path, module, isPackage, modules):
+    """ Modules of the package imported by the module in path """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                parent = module.split('.')
+                parent = parent[:len(parent) - node.level + (1 if isPackage else 0)]
+                base = '.'.join(parent + ([base] if base else []))
+            names.add(base)
+            names.update('%s.%s' % (base, alias.name) for alias in node.names)
+    found = set()
+    for name in names:
+        # importing a.b.c also imports a and a.b
+        parts = name.split('.')
+        for i in range(1, len(parts) + 1):
+            if '.'.join(parts[:i]) in modules:
+                found.add('.'.join(parts[:i]))
+    return found
+
+
+def isTestModule(module):
+    return any(part in TEST_PACKAGES for part in module.split('.')[1:-1])
+
+
+def buildMap(pkgDir, package):
+    modules = moduleFiles(pkgDir, package)
+    graph = {}
+    for module, rel in modules.items():
+        path = os.path.join(os.path.dirname(pkgDir), rel)
+        try:
+            graph[module] = imports(path, module, rel.endswith('__init__.py'),
+                                    modules)
+        except SyntaxError:
+            graph[module] = set()
+    files = {}
+    for test in sorted(m for m in modules if isTestModule(m)):
+        seen, pending = set(), [test]
+        while pending:
+            module = pending.pop()
+            if module not in seen:
+                seen.add(module)
+                pending.extend(graph.get(module, ()))
+                # and its parent packages
+                parent = module.rpartition('.')[0]
+                if parent in modules:
+                    pending.append(parent)
+        for module in seen:
+            files.setdefault(modules[module], []).append(test)
+    return files
+
+
+def writeMap(args):
+    files = buildMap(packageDir(args.scipion, args.package), args.package)
+    mapDir = os.path.dirname(os.path.abspath(args.map))
+    if not os.path.isdir(mapDir):
+        os.makedirs(mapDir)
+    with open(args.map + '.tmp', 'w') as f:
+        json.dump({'commit': args.commit, 'time': time.time(),
+                   'package': args.package, 'files': files}, f, indent=1)
+    os.rename(args.map + '.tmp', args.map)
+    print('Mapped %d files of %s at %s' % (len(files), args.package, args.commit))
+    return 0
+
+
+def changedFiles(repo, mirrors, base, head):
+    """ Files changed between two commits, using a bare mirror of the repo """
+    mirror = os.path.join(mirrors, os.path.basename(repo.rstrip('/')))
+    if not mirror.endswith('.git'):
+        mirror += '.git'
+    if not os.path.isdir(mirror):
+        subprocess.check_call(['git', 'init', '-q', '--bare', mirror])
+    subprocess.check_call(['git', '-C', mirror, 'fetch', '-q', repo,
+                           '+refs/heads/*:refs/heads/*'])
+    out = subprocess.check_output(['git', '-C', mirror, 'diff', '--name-only',
+                                   base, head], universal_newlines=True)
+    return [f for f in out.splitlines() if f]
+
+
+def affectedModules(impactMap, changed):
+    """ Test modules affected by the changed files, None if unknown """
+    package = impactMap['package']
+    affected = set()
+    for f in changed:
+        if f in impactMap['files']:
+            affected.update(impactMap['files'][f])
+        elif f.startswith(package + '/') and f.endswith('.py'):
+            module = f[:-3].replace('/', '.')
+            if not isTestModule(module):
+                print('# %s is not in the map' % f)
+                return None
+            affected.add(module)  # a new test module
+        elif f.endswith(IGNORED_EXTENSIONS) and not f.startswith(package + '/') \
+                and not os.path.basename(f).startswith('requirements'):
+            continue
+        elif f.startswith(IGNORED_PREFIXES):
+            continue
+        else:
+            print('# %s can not be mapped' % f)
+            return None
+    return affected
+
+
+def select(args):
+    if not os.path.exists(args.map):
+        print('# no test impact map')
+        print(ALL)
+        return 0
+    with open(args.map) as f:
+        impactMap = json.load(f)
+    if time.time() - impactMap['time'] > args.max_age * 24 * 3600:
+        print('# test impact map older than %s days' % args.max_age)
+        print(ALL)
+        return 0
+    try:
+        changed = changedFiles(args.repo, args.mirrors, impactMap['commit'],
+                               args.commit)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('# can not diff %s..%s: %s' % (impactMap['commit'], args.commit, e))
+        print(ALL)
+        return 0
+    print('# %d files changed since %s' % (len(changed), impactMap['commit']))
+    affected = affectedModules(impactMap, changed)
+    if affected is None:
+        print(ALL)
+    else:
+        for module in sorted(affected):
+            print(module)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    mapParser = subparsers.add_parser('map')
+    mapParser.add_argument('--scipion', default='./scipion3')
+    mapParser.add_argument('--package', required=True)
+    selectParser = subparsers.add_parser('select')
+    selectParser.add_argument('--repo', required=True)
+    selectParser.add_argument('--mirrors', required=True)
+    selectParser.add_argument('--max-age', type=float, default=14,
+                              help='days after which the map is stale')
+    for p in [mapParser, selectParser]:
+        p.add_argument('--map', required=True)
+        p.add_argument('--commit', required=True)
+    args = parser.parse_args()
+    if args.action == 'map':
+        return writeMap(args)
+    if args.action == 'select':
+        return select(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
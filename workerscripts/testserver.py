@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+""" Warm runner of scipion test classes.
+
+The server is started once per build with the scipion python
+('./scipion3 python testserver.py serve ...'), imports pyworkflow, pwem and
+all the plugins, and listens on a unix socket. For every request it forks a
+fresh child that runs 'scipion3 test <classes>' (pw_run_tests.py) in the
+already loaded interpreter. The client ('testserver.py run', started with
+any python3) relays the output and exit code of the child as its own, and
+the child is killed if the client goes away (e.g. the step times out). When
+there is no server, the client runs the --fallback command instead.
+
+Usage:
+    ./scipion3 python testserver.py serve --socket PATH [--idle SECS]
+    testserver.py run --socket PATH --fallback './scipion3 test' \\
+        [--env VAR ...] -- relion.tests.test_a.TestA [...]
+    testserver.py stop --socket PATH
+"""
+import argparse
+import json
+import os
+import selectors
+import shlex
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import time
+
+OUTPUT = b'O'
+EXIT = b'X'
+
+
+def sendFrame(conn, kind, data):
+    conn.sendall(kind + struct.pack('!I', len(data)) + data)
+
+
+def recvExactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+# *****************************************************************************
+#               SERVER
+# *****************************************************************************
+def preload():
+    """ Import everything a test class run would import """
+    import pyworkflow.tests  # noqa
+    try:
+        from pwem import Domain
+        Domain.getPlugins()
+    except Exception as e:
+        print('Plugins not preloaded: %s' % e)
+    import pyworkflow
+    return os.path.join(os.path.dirname(pyworkflow.__file__), 'apps',
+                        'pw_run_tests.py')
+
+
+def runTests(runTestsScript, request, writeFd):
+    """ Body of the forked child """
+    import runpy
+    os.setpgid(0, 0)
+    os.dup2(writeFd, 1)
+    os.dup2(writeFd, 2)
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        os.environ.update(request['env'])
+        sys.argv = [runTestsScript] + request['tests']
+        runpy.run_path(runTestsScript, run_name='__main__')
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+class TestRequestHandler(socketserver.BaseRequestHandler):
+    """ Runs in a process forked from the warm server, forks the child
+    running the tests and relays its output """
+
+    def handle(self):
+        conn = self.request
+        line = b''
+        while not line.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                return
+            line += chunk
+        request = json.loads(line.decode())
+        readFd, writeFd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(readFd)
+            runTests(self.server.runTestsScript, request, writeFd)
+        os.close(writeFd)
+
+        deadline = time.time() + request.get('timeout', 24 * 3600)
+        selector = selectors.DefaultSelector()
+        selector.register(readFd, selectors.EVENT_READ)
+        selector.register(conn, selectors.EVENT_READ)
+        killed = False
+        try:
+            while True:
+                events = selector.select(timeout=max(0, deadline - time.time()))
+                if not events:
+                    print('Test timeout, killing %s' % request['tests'])
+                    os.killpg(pid, signal.SIGKILL)
+                    killed = True
+                    break
+                if any(key.fileobj is conn for key, _ in events):
+                    # the client went away
+                    os.killpg(pid, signal.SIGKILL)
+                    killed = True
+                    break
+                data = os.read(readFd, 65536)
+                if not data:
+                    break
+                sendFrame(conn, OUTPUT, data)
+        except (OSError, EOFError):
+            os.killpg(pid, signal.SIGKILL)
+            killed = True
+        _, status = os.waitpid(pid, 0)
+        os.close(readFd)
+        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+        if not killed:
+            sendFrame(conn, EXIT, struct.pack('!i', code))
+
+
+class TestServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    max_children = 64
+    idle = False
+
+    def handle_timeout(self):
+        socketserver.ForkingMixIn.handle_timeout(self)
+        if not self.active_children:
+            self.idle = True
+
+
+def serve(args):
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    readyRead, readyWrite = os.pipe()
+    if args.daemon and os.fork() != 0:
+        # wait until the server is listening
+        os.close(readyWrite)
+        with os.fdopen(readyRead) as ready:
+            message = ready.read()
+        print(message)
+        return 0 if message.startswith('ready') else 1
+    os.close(readyRead)
+    if args.daemon:
+        os.setsid()
+    try:
+        start = time.time()
+        runTestsScript = preload()
+        server = TestServer(args.socket, TestRequestHandler)
+    except BaseException as e:
+        os.write(readyWrite, ('Can not start the test server: %s' % e).encode())
+        os._exit(1)
+    server.runTestsScript = runTestsScript
+    server.timeout = args.idle
+    with open(args.socket + '.pid', 'w') as f:
+        f.write(str(os.getpid()))
+    os.write(readyWrite, ('ready in %0.1f secs, pid %d'
+                          % (time.time() - start, os.getpid())).encode())
+    os.close(readyWrite)
+    if args.daemon:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in [0, 1, 2]:
+            os.dup2(devnull, fd)
+    try:
+        while not server.idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        for path in [args.socket, args.socket + '.pid']:
+            if os.path.exists(path):
+                os.remove(path)
+    return 0
+
+
+# *****************************************************************************
+#               CLIENT
+# *****************************************************************************
+def run(args):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(args.socket)
+    except OSError:
+        print('No test server at %s, running %s' % (args.socket, args.fallback))
+        sys.stdout.flush()
+        return subprocess.call(shlex.split(args.fallback) + args.tests)
+
+    request = {'tests': args.tests,
+               'cwd': os.getcwd(),
+               'env': {var: os.environ[var] for var in args.env if var in os.environ},
+               'timeout': args.timeout}
+    conn.sendall(json.dumps(request).encode() + b'\n')
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        while True:
+            kind, size = struct.unpack('!cI', recvExactly(conn, 5))
+            data = recvExactly(conn, size)
+            if kind == EXIT:
+                return struct.unpack('!i', data)[0]
+            out.write(data)
+            out.flush()
+    except EOFError:
+        print('The test server closed the connection')
+        return 1
+
+
+def stop(args):
+    pidFile = args.socket + '.pid'
+    if not os.path.exists(pidFile):
+        print('No test server at %s' % args.socket)
+        return 0
+    with open(pidFile) as f:
+        pid = int(f.read())
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+    for path in [args.socket, pidFile]:
+        if os.path.exists(path):
+            os.remove(path)
+    print('Test server %d stopped' % pid)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    serveParser = subparsers.add_parser('serve')
+    serveParser.add_argument('--daemon', action='store_true')
+    serveParser.add_argument('--idle', type=float, default=3600,
+                             help='seconds without requests before exiting')
+    runParser = subparsers.add_parser('run')
+    runParser.add_argument('--fallback', default='./scipion3 test')
+    runParser.add_argument('--env', nargs='*', default=[],
+                           help='variables passed to the test run')
+    runParser.add_argument('--timeout', type=float, default=24 * 3600)
+    runParser.add_argument('tests', nargs=argparse.REMAINDER)
+    stopParser = subparsers.add_parser('stop')
+    for p in [serveParser, runParser, stopParser]:
+        p.add_argument('--socket', required=True)
+    args = parser.parse_args()
+    if args.action == 'serve':
+        return serve(args)
+    if args.action == 'run':
+        if args.tests and args.tests[0] == '--':
+            args.tests = args.tests[1:]
+        return run(args)
+    if args.action == 'stop':
+        return stop(args)
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())